@@ -87,6 +87,9 @@ class HTTPException(Exception):
         Exception.__init__(self, code, msg)
         self.error_code = code
         self.msg = msg
+        # Same attribute name as boto's S3ResponseError, which is what
+        # request handlers look for when reporting a failed query
+        self.status = code
         
 class NoSuchBucket(HTTPException):
     error_code = httplib.NOT_FOUND
@@ -100,4 +103,24 @@ class BucketNotEmpty(HTTPException):
     error_code = httplib.CONFLICT
     msg = "Bucket Not Empty"
 
+class BadDigest(HTTPException):
+    error_code = httplib.BAD_REQUEST
+    msg = "The Content-MD5 you specified did not match what we received"
 
+
+
+class NoSuchUpload(HTTPException):
+    error_code = httplib.NOT_FOUND
+    msg = "The specified multipart upload does not exist"
+
+class InvalidPart(HTTPException):
+    error_code = httplib.BAD_REQUEST
+    msg = "One or more of the specified parts could not be found"
+
+class InvalidPartOrder(HTTPException):
+    error_code = httplib.BAD_REQUEST
+    msg = "The list of parts was not in ascending order"
+
+class MalformedXML(HTTPException):
+    error_code = httplib.BAD_REQUEST
+    msg = "The XML you provided was not well-formed"
@@ -34,17 +34,41 @@
 # official policies, either expressed or implied, of Cornell University.
 # 
 
-import sys
+# Erasure coding libraries by name.  Each provides Encoder(k, m) and 
+# Decoder(k, m) with zfec's interface, and codes exactly as zfec does, so
+# shares written with one can be read with any other.
+codecs = {}
 try:
     import zfec
-except ImportError, e:
-    print >> sys.stderr, """Fatal error: Cannot import zfec erasure coding library.
-Zfec can be obtained from http://pypi.python.org/pypi/zfec
-"""
-    sys.exit(1)
-
-import struct, hashlib, base64
+    codecs['zfec'] = zfec
+except ImportError:
+    pass
+try:
+    import gf256
+    codecs['numpy'] = gf256
+except ImportError:
+    pass
+
+if 'zfec' in codecs:
+    default_codec = 'zfec'
+else:
+    default_codec = 'numpy'
+
+def get_codec(name=None):
+    if name is None:
+        name = default_codec
+    try:
+        return codecs[name]
+    except KeyError:
+        raise Exception("Erasure coding library %s is not available.  Zfec can be obtained from "
+                        "http://pypi.python.org/pypi/zfec; the numpy codec needs NumPy." % name)
+
+import struct, hashlib, base64, binascii, uuid, mmap, zlib
+from multiprocessing import Process, Pipe
+from threading import Lock
+from Queue import Queue
 from racs.util.stats import *
+from racs.exceptions import *
 
 METABYTES = 3
 
@@ -62,6 +86,117 @@ def div_ceil(n, d):
     """
     return (n/d) + (n%d != 0)
 
+# Share layout
+#
+# An object is cut into stripes of stripe_size bytes (a multiple of k).  Each
+# stripe is padded to a multiple of k, split into k segments and encoded into
+# m blocks of stripe_size/k bytes.  Share i is a ShareMeta header followed by
+# block i of every stripe, in order.  The last stripe is only padded up to a
+# multiple of k, so its blocks may be shorter.
+#
+# Every object records the stripe size it was written with in its FECMeta.
+# Objects written before striping are a single stripe covering the whole
+# object, and have stripe_size 0; an object no larger than one stripe is
+# laid out the same way either way.
+
+def stripe_block_sizes(size, stripe_size, k):
+    """
+    The length of each stripe's blocks, in stripe order.
+    """
+    if not stripe_size:
+        return [div_ceil(size, k)]
+    full, rest = divmod(size, stripe_size)
+    sizes = [stripe_size / k] * full
+    if rest:
+        sizes.append(div_ceil(rest, k))
+    return sizes
+
+def effective_stripe_size(fecmeta, k):
+    # Unstriped objects are a single stripe
+    return fecmeta.stripe_size or div_ceil(fecmeta.size, k) * k
+
+def stripe_block_size(fecmeta, k, stripe):
+    stripe_size = effective_stripe_size(fecmeta, k)
+    if stripe < fecmeta.size / stripe_size:
+        return stripe_size / k
+    return div_ceil(fecmeta.size % stripe_size, k)
+
+def plan_range(fecmeta, k, first, last):
+    """
+    Map bytes first..last (inclusive) of an object onto its shares.
+
+    Coding works column by column: byte t of every block depends only on
+    byte t of the stripe's k segments.  So a byte range of the object only
+    needs the matching columns of each stripe it touches, and those columns
+    sit next to each other in every share.
+
+    @return: (offset, length, windows).  offset and length give the bytes to
+        read from each share, counting its header.  windows lists
+        (stripe, first column, end column) for each stripe in that data.
+    """
+    stripe_size = effective_stripe_size(fecmeta, k)
+    first_stripe, u = divmod(first, stripe_size)
+    last_stripe, v = divmod(last, stripe_size)
+    windows = []
+    for stripe in xrange(first_stripe, last_stripe+1):
+        b = stripe_block_size(fecmeta, k, stripe)
+        lo, hi = 0, b
+        if stripe == first_stripe and stripe == last_stripe:
+            if u / b == v / b:
+                # within one segment
+                lo, hi = u % b, v % b + 1
+        elif stripe == first_stripe:
+            if u / b == k - 1:
+                lo = u % b
+        elif stripe == last_stripe:
+            if v / b == 0:
+                hi = v % b + 1
+        windows.append((stripe, lo, hi))
+    offset = ShareMeta.meta_length + first_stripe * (stripe_size / k) + windows[0][1]
+    length = sum([w[2] - w[1] for w in windows])
+    return offset, length, windows
+
+def share_block_sizes(fecmeta, k):
+    """
+    The pieces of each share, in order: the ShareMeta header, then the
+    block of each stripe.
+    """
+    return [ShareMeta.meta_length] + stripe_block_sizes(fecmeta.size, fecmeta.stripe_size, k)
+
+def share_size(size, stripe_size, k):
+    """
+    The number of bytes in each share (including its ShareMeta header)
+    of an object of the given size.
+    """
+    return ShareMeta.meta_length + sum(stripe_block_sizes(size, stripe_size, k))
+
+def split_segments(data, k):
+    """
+    Cut data into the k equal segments zfec encodes, padding the end
+    with zeros.
+
+    Segments are read-only buffers over data rather than copies of it;
+    only a segment running past the end of data is copied, to pad it.
+    (zfec reads its inputs through the old buffer interface, which
+    memoryview doesn't provide in Python 2.)
+    """
+    chunksize = div_ceil(len(data), k)
+    segments = []
+    for i in xrange(k):
+        start = i * chunksize
+        if start + chunksize <= len(data):
+            segments.append(buffer(data, start, chunksize))
+        else:
+            tail = data[start:]
+            segments.append(tail + '\0' * (chunksize - len(tail)))
+    return segments
+
+def read_exactly(stream, n):
+    data = stream.read(n)
+    if len(data) != n:
+        raise IOError("Share truncated: expected %s bytes, got %s" % (n, len(data)))
+    return data
+
 class FECMeta:
     short_header = 'racsmeta'
     header = 'x-amz-meta-'+short_header
@@ -71,28 +206,104 @@ class FECMeta:
     _fields = "size md5".split()
     meta_length = struct.calcsize(_fmt)
 
-    def __init__(self, size, md5):
+    # Striped objects also record their stripe size.  The packed formats
+    # differ in length, which is how read() tells them apart.
+    _striped_fmt = '!Q32sI'
+    _striped_fields = "size md5 stripe_size".split()
+
+    # Objects put together by a multipart upload hold no data themselves.
+    # Their FECMeta is a manifest: the parts are stored as objects of their
+    # own (see part_key), all part_size bytes long except perhaps the last.
+    # md5 is the hash of the parts' binary md5s, as S3 computes it.
+    _multipart_fmt = '!Q32sI32sIQ'
+    _multipart_fields = "size md5 stripe_size upload_id parts part_size".split()
+
+    # Small objects may be stored as whole replicas rather than erasure 
+    # coded: every share then holds all of the data, and any one of them
+    # is enough to read it.
+    ERASURE_CODED, REPLICATED = 0, 1
+    _replicated_fmt = '!Q32sIB'
+    _replicated_fields = "size md5 stripe_size scheme".split()
+
+    def __init__(self, size, md5, stripe_size=0, upload_id=None, parts=0, part_size=0, scheme=ERASURE_CODED):
         self.size = size # size of original file
         self.md5 = md5
+        self.stripe_size = stripe_size # 0 for a single unstriped codeword
+        self.upload_id = upload_id
+        self.parts = parts # 0 unless this is a multipart manifest
+        self.part_size = part_size
+        self.scheme = scheme
 
     @classmethod
     def read(cls, packed):
         packed = base64.b64decode(packed)
-        kw = dict(zip(cls._fields,struct.unpack(cls._fmt, packed)))
+        if len(packed) == struct.calcsize(cls._multipart_fmt):
+            fmt, fields = cls._multipart_fmt, cls._multipart_fields
+        elif len(packed) == struct.calcsize(cls._replicated_fmt):
+            fmt, fields = cls._replicated_fmt, cls._replicated_fields
+        elif len(packed) == struct.calcsize(cls._striped_fmt):
+            fmt, fields = cls._striped_fmt, cls._striped_fields
+        else:
+            fmt, fields = cls._fmt, cls._fields
+        kw = dict(zip(fields,struct.unpack(fmt, packed)))
         return cls(**kw)
 
+    def spans_stripes(self):
+        # True if the object has more than one stripe to decode
+        return self.stripe_size and self.size > self.stripe_size
+
+    def replicated(self):
+        return self.scheme == self.REPLICATED
+
+    def needed_shares(self, k):
+        # How many shares it takes to read the object
+        if self.replicated():
+            return 1
+        return k
+
+    def etag(self):
+        if self.parts:
+            return '"%s-%s"' % (self.md5, self.parts)
+        return '"%s"' % self.md5
+
+    def part_layout(self):
+        """
+        (part number, offset, size) of each part of a multipart object.
+        """
+        return [(n, (n-1) * self.part_size, min(self.part_size, self.size - (n-1) * self.part_size))
+                for n in xrange(1, self.parts+1)]
+
     def __len__(self):
-        return self.meta_length
+        return len(base64.b64decode(str(self)))
     
     def __str__(self):
-        values = [getattr(self, field) for field in self._fields]
-        packed = struct.pack(self._fmt, *values)
+        if self.parts:
+            fmt, fields = self._multipart_fmt, self._multipart_fields
+        elif self.replicated():
+            fmt, fields = self._replicated_fmt, self._replicated_fields
+        elif self.stripe_size:
+            fmt, fields = self._striped_fmt, self._striped_fields
+        else:
+            fmt, fields = self._fmt, self._fields
+        values = [getattr(self, field) for field in fields]
+        packed = struct.pack(fmt, *values)
         return base64.b64encode(packed)
 
 
 class ShareMeta:
     # Metainformation stored in each encoded share
     # (not to be confused with metadata headers. ShareMeta is part of the share!)
+
+    # The share number is also stored in each share's metadata under this
+    # header, so that ranged reads don't have to fetch the share header
+    short_header = 'racsshare'
+
+    # ... and the CRC-32 of the whole share, header included.  It goes in
+    # the metadata rather than the share header because a streamed share's
+    # header is written before its data has been seen.  Shares written
+    # before checksums have none and are taken as they are.
+    checksum_header = 'racscrc'
+
     _fmt = 'B'
     _fields = ['sharenum']
     meta_length = struct.calcsize(_fmt)
@@ -107,8 +318,10 @@ class ShareMeta:
 
     @classmethod
     def prepend_to(cls, block, **metakw):
+        # block may be a buffer over the caller's data; concatenating onto
+        # a buffer copies it into the share just once
         s = cls(**metakw)
-        return str(s) + block
+        return buffer(str(s)) + block
 
     @classmethod
     def read(cls, packed):
@@ -123,11 +336,239 @@ class ShareMeta:
         return struct.pack(self._fmt, *values)
 
 
+# Metadata headers used by RACS itself, not to be passed on to clients
+racs_headers = (FECMeta.short_header, ShareMeta.short_header, ShareMeta.checksum_header)
+
+def share_headers(headers, sharenum, checksum=None):
+    h = dict(headers)
+    h[ShareMeta.short_header] = str(sharenum)
+    if checksum is not None:
+        h[ShareMeta.checksum_header] = checksum
+    return h
+
+def share_crc(data, crc=0):
+    # Running CRC-32 of share data.  (zlib's CRC-32 rather than CRC-32C,
+    # which Python 2 has no built-in implementation of.)
+    return zlib.crc32(data, crc)
+
+def format_crc(crc):
+    return '%08x' % (crc & 0xffffffff)
+
+def share_checksum(share):
+    return format_crc(share_crc(share))
+
+def expected_checksum(metadata):
+    # None for shares written before checksums
+    return (metadata or {}).get(ShareMeta.checksum_header)
+
+def share_intact(share, metadata):
+    """
+    False if the share doesn't match the checksum in its metadata.
+    """
+    expected = expected_checksum(metadata)
+    return expected is None or share_checksum(share) == expected
+
+def share_range_intact(data, sharenum, metadata, fecmeta, k, offset):
+    """
+    False if data, read from share sharenum at offset, is all of the share
+    after its header and doesn't match the checksum in its metadata.  A
+    range short of that can't be checked.
+    """
+    if offset != ShareMeta.meta_length or \
+            offset + len(data) != share_size(fecmeta.size, fecmeta.stripe_size, k):
+        return True
+    return share_intact(str(ShareMeta(sharenum)) + data, metadata)
+
+
+# Parts of multipart uploads are stored under this prefix, which is left
+# out of bucket listings
+multipart_prefix = '.racs-parts/'
+
+def part_key(upload_id, part_number):
+    return '%s%s/%05d' % (multipart_prefix, upload_id, part_number)
+
+class MultipartUpload(object):
+    """
+    A multipart upload in progress.  Each part is encoded and stored like
+    an object of its own, under part_key(); completing the upload writes
+    the manifest FECMeta under the object's own key.
+    """
+    def __init__(self, bucket, key, content_type=None, headers=None):
+        self.upload_id = uuid.uuid4().hex
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.parts = {} # part number -> FECMeta of the uploaded part
+
+    def part_key(self, part_number):
+        return part_key(self.upload_id, part_number)
+
+    def manifest(self, etags):
+        """
+        Check the part list of a CompleteMultipartUpload request against
+        the parts uploaded, and build the object's FECMeta.
+
+        @param etags: (part number, etag) of each part, in order
+        """
+        if not etags:
+            raise MalformedXML()
+        numbers = [n for n, etag in etags]
+        if numbers != sorted(numbers):
+            raise InvalidPartOrder()
+        if numbers != range(1, len(numbers)+1):
+            raise InvalidPart(msg="Parts must be numbered 1, 2, 3, ... without gaps")
+
+        parts = []
+        for n, etag in etags:
+            fecmeta = self.parts.get(n)
+            if fecmeta is None or etag.strip('"') != fecmeta.md5:
+                raise InvalidPart()
+            parts.append(fecmeta)
+
+        part_size = parts[0].size
+        for fecmeta in parts[1:-1]:
+            if fecmeta.size != part_size:
+                raise InvalidPart(msg="All parts but the last must be the same size")
+        if parts[-1].size > part_size:
+            raise InvalidPart(msg="The last part may not be larger than the others")
+
+        md5 = hashlib.md5(''.join([binascii.unhexlify(fecmeta.md5) for fecmeta in parts]))
+        return FECMeta(size = sum([fecmeta.size for fecmeta in parts]), md5 = md5.hexdigest(),
+                       upload_id = self.upload_id, parts = len(parts), part_size = part_size)
+
+
+def coding_worker(conn, parent_conn, slot, k, m, output, codec):
+    # Body of a CodingPool worker process.  Jobs arrive on conn; their data
+    # is in slot, and results are written back to slot from offset output.
+    # Share i is coded the same way whatever the number of shares, so the
+    # worker's codec for m shares also serves any fewer.
+    # The worker exits when the server's end of the pipe goes away, so it
+    # must not hold that end open itself.
+    parent_conn.close()
+    encoder = get_codec(codec).Encoder(k, m)
+    decoder = get_codec(codec).Decoder(k, m)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        try:
+            if job[0] == 'encode':
+                # stripe of n bytes in, its parity blocks k..shares-1 out
+                n, shares = job[1], job[2]
+                blocks = encoder.encode(split_segments(buffer(slot, 0, n), k), range(k, shares))
+            else:
+                # k blocks in, the k segments of the stripe out
+                sharenums, blocksize = job[1], job[2]
+                blocks = decoder.decode([buffer(slot, i*blocksize, blocksize) for i in xrange(k)], sharenums)
+            pos = output
+            for block in blocks:
+                slot[pos:pos+len(block)] = str(block)
+                pos += len(block)
+            conn.send(None)
+        except Exception, e:
+            conn.send(repr(e))
+
+class CodingWorker(object):
+    def __init__(self, k, m, size, output, codec=None):
+        self.slot = mmap.mmap(-1, size)
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=coding_worker, args=(child_conn, self.conn, self.slot, k, m, output, codec))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def run(self, job):
+        self.conn.send(job)
+        error = self.conn.recv()
+        if error is not None:
+            raise Exception("Coding worker %s failed: %s" % (self.process.pid, error))
+
+class CodingPool(object):
+    """
+    Encodes and decodes stripes in worker processes.  zfec holds the GIL
+    while it works, so coding in request threads uses one core however
+    many requests are running.
+
+    Each worker has a slot of shared memory big enough for one stripe of
+    slot_size bytes and its blocks.  The stripe goes into the slot and
+    only the job description goes down the pipe; the worker writes its
+    results back into the slot.  Stripes smaller than min_bytes are not
+    worth the round trip and are coded in the calling thread.
+
+    The pool codes objects of up to m shares.
+    """
+    min_bytes = 64*1024
+
+    def __init__(self, k, m, slot_size, processes, codec=None):
+        self.k = k
+        self.m = m
+        block = div_ceil(slot_size, k)
+        self.input_size = k * block
+        self.output = self.input_size
+        size = self.input_size + max(k, m-k) * block
+        self.idle = Queue()
+        for i in xrange(processes):
+            self.idle.put(CodingWorker(k, m, size, self.output, codec))
+
+    def takes(self, nbytes):
+        return self.min_bytes <= nbytes <= self.input_size
+
+    def covers(self, k, m):
+        return k == self.k and m <= self.m
+
+    def encode(self, stripe, m):
+        """
+        @return: the m-k parity blocks of stripe
+        """
+        blocksize = div_ceil(len(stripe), self.k)
+        worker = self.idle.get()
+        try:
+            worker.slot[0:len(stripe)] = stripe
+            worker.run(('encode', len(stripe), m))
+            return [worker.slot[self.output+i*blocksize:self.output+(i+1)*blocksize]
+                    for i in xrange(m - self.k)]
+        finally:
+            self.idle.put(worker)
+
+    def decode(self, blocks, sharenums):
+        """
+        @return: the stripe coded into k blocks, with its padding
+        """
+        blocksize = len(blocks[0])
+        worker = self.idle.get()
+        try:
+            for i, block in enumerate(blocks):
+                worker.slot[i*blocksize:(i+1)*blocksize] = block
+            worker.run(('decode', sharenums, blocksize))
+            return worker.slot[self.output:self.output+self.k*blocksize]
+        finally:
+            self.idle.put(worker)
+
+
 class Encoder(object):
-    def __init__(self, k, m):
-        self.fec = zfec.Encoder(k, m)
+    def __init__(self, k, m, stripe_size=0, pool=None, codec=None):
+        self.fec = get_codec(codec).Encoder(k, m)
         self.k = k
         self.m = m
+        self.stripe_size = stripe_size
+        self.pool = pool
+
+    def encode_blocks(self, data):
+        # The first k blocks may be buffers over data
+        segments = split_segments(data, self.k)
+        if self.pool is not None and self.pool.takes(len(data)):
+            return segments + self.pool.encode(data, self.m)
+        return self.fec.encode(segments)
+
+    def encode_stripe(self, data):
+        """
+        Encode one stripe, without share headers.
+
+        @return: m blocks of len(data)/k bytes (rounded up)
+        """
+        return [str(block) for block in self.encode_blocks(data)]
 
     def encode(self, data, md5=None):
         """
@@ -144,22 +585,16 @@ class Encoder(object):
             md5 = m.hexdigest()
         
         osize = len(data)
-        # pad data
-        padding_bytes = compute_padding(self.fec.k, osize)
-        
-        padded_data = data + '\0' * padding_bytes
-
-        if len(padded_data) % self.fec.k != 0:
-            raise Exception # sanity check
+        # The first k blocks are the segments themselves, still buffers
+        # over data; prepend_to makes the only copy of them
+        blocks = self.encode_blocks(data)
 
-        chunksize = (osize + padding_bytes) / self.fec.k
-
-        #chunksize = div_ceil(len(data), self.fec.k)
-        #l = [ data[i*chunksize:(i+1)*chunksize] + "\x00" * min(chunksize, (((i+1)*chunksize)-osize)) for i in range(self.fec.k) ]
-        segments = [ padded_data[i*chunksize:(i+1)*chunksize] for i in xrange(self.fec.k) ]
-        blocks = self.fec.encode(segments)
-
-        fecmeta = FECMeta(size = osize, md5 = md5)
+        # Data that fits in a stripe is recorded as a striped object, so
+        # that it reads the same way as larger objects
+        stripe_size = 0
+        if osize <= self.stripe_size:
+            stripe_size = self.stripe_size
+        fecmeta = FECMeta(size = osize, md5 = md5, stripe_size = stripe_size)
 
         for i,block in enumerate(blocks):
             blocks[i] = ShareMeta.prepend_to(block, sharenum = i)
@@ -183,11 +618,134 @@ class Encoder(object):
 
         return blocks, fecmeta
 
+    def replicate(self, data, md5=None):
+        """
+        Store data whole in each of the m shares, rather than erasure coded.
+
+        @return: m shares and the FECMeta of a replicated object
+        """
+        if md5 is None:
+            md5 = hashlib.md5(data).hexdigest()
+        shares = [ShareMeta.prepend_to(data, sharenum = i) for i in xrange(self.m)]
+        fecmeta = FECMeta(size = len(data), md5 = md5, scheme = FECMeta.REPLICATED)
+        record_event("racs:replicate bytes", len(data))()
+        return shares, fecmeta
+
+
+class CodecCache(object):
+    """
+    Encoders and Decoders by (k, m), made on first use and shared by all
+    requests.  m follows the set of active repositories, which can change
+    while the server runs.
+    """
+    def __init__(self, stripe_size=0, pool=None, codec=None):
+        self.stripe_size = stripe_size
+        self.pool = pool
+        self.codec = codec
+        self.lock = Lock()
+        self.encoders = {}
+        self.decoders = {}
+
+    def encoder(self, k, m):
+        return self.get(self.encoders, k, m, lambda pool: Encoder(k, m, self.stripe_size, pool, self.codec))
+
+    def decoder(self, k, m):
+        return self.get(self.decoders, k, m, lambda pool: Decoder(k, m, pool, self.codec))
+
+    def get(self, codecs, k, m, make):
+        self.lock.acquire()
+        try:
+            codec = codecs.get((k, m))
+            if codec is None:
+                pool = self.pool
+                if pool is not None and not pool.covers(k, m):
+                    pool = None
+                codec = codecs[(k, m)] = make(pool)
+            return codec
+        finally:
+            self.lock.release()
+
+
+class StripedEncoder(object):
+    """
+    Encodes an object one stripe at a time, as its bytes arrive.  The
+    caller writes headers() to the front of each share, then feeds each 
+    stripe (stripe_size bytes, except the last) through encode() and 
+    appends block i to share i.  finish() returns the FECMeta once the 
+    whole object has gone through.  size may be None if it isn't known 
+    in advance.  md5 is given if the caller is already hashing the
+    stripes as they are read.
+    """
+    def __init__(self, encoder, size, stripe_size, md5=None):
+        if stripe_size % encoder.k != 0:
+            raise Exception("stripe size %s is not a multiple of k=%s" % (stripe_size, encoder.k))
+        self.encoder = encoder
+        self.size = size
+        self.stripe_size = stripe_size
+        self.hashing = md5 is None
+        self.md5 = md5 or hashlib.md5()
+        self.nbytes = 0
+        self.elapsed = 0.0
+        self.crcs = [share_crc(header) for header in self.headers()]
+
+    def headers(self):
+        return [str(ShareMeta(sharenum = i)) for i in xrange(self.encoder.m)]
+
+    def checksums(self):
+        # of each whole share, once every stripe has gone through
+        return [format_crc(crc) for crc in self.crcs]
+
+    def share_size(self):
+        if self.size is None:
+            return None
+        return share_size(self.size, self.stripe_size, self.encoder.k)
+
+    def encode(self, stripe):
+        elapsed = Stopwatch()
+        if self.hashing:
+            self.md5.update(stripe)
+        self.nbytes += len(stripe)
+        blocks = self.encoder.encode_stripe(stripe)
+        self.crcs = [share_crc(block, crc) for block, crc in zip(blocks, self.crcs)]
+        self.elapsed += elapsed()
+        return blocks
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def finish(self):
+        if self.size is not None and self.nbytes != self.size:
+            raise Exception("striped encoder got %s bytes, expected %s" % (self.nbytes, self.size))
+        record_event("zfec:encode bytes", self.nbytes)()
+        record_event("zfec:encode time", self.elapsed)()
+        return FECMeta(size = self.nbytes, md5 = self.hexdigest(), stripe_size = self.stripe_size)
 
 
 class Decoder(object):
-    def __init__(self, k, m):
-        self.fec = zfec.Decoder(k, m)
+    def __init__(self, k, m, pool=None, codec=None):
+        self.fec = get_codec(codec).Decoder(k, m)
+        self.k = k
+        self.pool = pool
+        self.primary_sharenums = range(k)
+
+    def primary_segments(self, blocks, sharenums):
+        # zfec is systematic: shares 0..k-1 hold the segments themselves,
+        # so when those are the shares at hand there is nothing to decode.
+        # Returns None otherwise.
+        if sorted(sharenums) != self.primary_sharenums:
+            return None
+        if sharenums == self.primary_sharenums:
+            return blocks
+        return [block for n, block in sorted(zip(sharenums, blocks))]
+
+    def decode_blocks(self, blocks, sharenums):
+        # One stripe (or a whole unstriped object), padding included
+        segments = self.primary_segments(blocks, sharenums)
+        if segments is not None:
+            return ''.join(segments)
+        if self.pool is not None and self.pool.takes(len(blocks[0]) * self.k):
+            return self.pool.decode(blocks, sharenums)
+        return ''.join(self.fec.decode(blocks, sharenums))
 
     def decode(self, shares, fecmeta): #, sharenums, padlen):
         """
@@ -203,12 +761,18 @@ class Decoder(object):
             sharenums.append(meta.sharenum)
             raw_shares.append(share)
 
-        padding_bytes = compute_padding(self.fec.k, fecmeta.size) 
+        if fecmeta.replicated():
+            # Each share is a whole copy
+            data = raw_shares[0]
+        elif fecmeta.stripe_size:
+            data = self.decode_stripes(raw_shares, sharenums, fecmeta)
+        else:
+            padding_bytes = compute_padding(self.fec.k, fecmeta.size) 
 
-        data = ''.join(self.fec.decode(raw_shares, sharenums))
+            data = self.decode_blocks(raw_shares, sharenums)
 
-        if padding_bytes > 0: 
-            data = data[:-padding_bytes]
+            if padding_bytes > 0: 
+                data = data[:-padding_bytes]
 
         if len(data) != fecmeta.size:
             raise Exception # Sanity check
@@ -217,3 +781,83 @@ class Decoder(object):
         record_event("zfec:decode time", elapsed())()
 
         return data
+
+    def decode_range(self, blocks, sharenums, fecmeta, first, last):
+        """
+        Decode bytes first..last (inclusive) of an object from k pieces of
+        share data, each read at the offset and length given by plan_range.
+        """
+        elapsed = Stopwatch()
+        k = fecmeta.needed_shares(self.k)
+        offset, length, windows = plan_range(fecmeta, k, first, last)
+        for block in blocks:
+            if len(block) != length:
+                raise IOError("Share range truncated: expected %s bytes, got %s" % (length, len(block)))
+        if fecmeta.replicated():
+            # A replica's range is the bytes themselves
+            return blocks[0]
+
+        stripe_size = effective_stripe_size(fecmeta, self.k)
+        pieces = []
+        pos = 0
+        for stripe, lo, hi in windows:
+            b = stripe_block_size(fecmeta, self.k, stripe)
+            columns = [block[pos:pos+hi-lo] for block in blocks]
+            segments = self.primary_segments(columns, sharenums) or self.fec.decode(columns, sharenums)
+            pos += hi - lo
+            for j, segment in enumerate(segments):
+                # segment holds object bytes start .. start+hi-lo-1
+                start = stripe * stripe_size + j * b + lo
+                a = max(first - start, 0)
+                z = min(last + 1 - start, hi - lo)
+                if a < z:
+                    pieces.append(segment[a:z])
+        data = ''.join(pieces)
+
+        record_event("zfec:decode bytes", len(data))()
+        record_event("zfec:decode time", elapsed())()
+        return data
+
+    def decode_stream(self, streams, fecmeta, checksums=None):
+        """
+        Decode a striped object from k share streams (file-like objects
+        positioned at the start of their shares), yielding the object's data
+        one stripe at a time.  Only one stripe of each share is held at once.
+
+        @param checksums: the expected_checksum() of each share, if known.
+            A share's CRC can only be checked once all of it has been read,
+            so the last stripe is held back until they match.
+        """
+        elapsed = Stopwatch()
+        sharenums = []
+        crcs = []
+        for stream in streams:
+            header = read_exactly(stream, ShareMeta.meta_length)
+            sharenums.append(ShareMeta.read(header).sharenum)
+            crcs.append(share_crc(header))
+
+        remaining = fecmeta.size
+        sizes = stripe_block_sizes(fecmeta.size, fecmeta.stripe_size, self.k)
+        for i, blocksize in enumerate(sizes):
+            blocks = [read_exactly(stream, blocksize) for stream in streams]
+            if checksums:
+                crcs = [share_crc(block, crc) for block, crc in zip(blocks, crcs)]
+                if i == len(sizes) - 1:
+                    for sharenum, crc, expected in zip(sharenums, crcs, checksums):
+                        if expected is not None and format_crc(crc) != expected:
+                            raise IOError("Share %s does not match its checksum" % sharenum)
+            data = self.decode_blocks(blocks, sharenums)[:remaining]
+            remaining -= len(data)
+            yield data
+
+        record_event("zfec:decode bytes", fecmeta.size)()
+        record_event("zfec:decode time", elapsed())()
+
+    def decode_stripes(self, raw_shares, sharenums, fecmeta):
+        stripes = []
+        offset = 0
+        for blocksize in stripe_block_sizes(fecmeta.size, fecmeta.stripe_size, self.k):
+            blocks = [share[offset:offset+blocksize] for share in raw_shares]
+            stripes.append(self.decode_blocks(blocks, sharenums))
+            offset += blocksize
+        return ''.join(stripes)[:fecmeta.size]
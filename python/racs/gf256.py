@@ -0,0 +1,212 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+"""
+Reed-Solomon erasure coding over GF(256) in NumPy, with zfec's interface.
+
+The code is the one zfec uses (Luigi Rizzo's systematic Vandermonde
+code): the field is built on the polynomial x^8+x^4+x^3+x^2+1, share i
+< k is segment i itself, and parity share i is row i of the encoding
+matrix applied to the segments.  Shares written through either library
+can be read through the other.
+
+Multiplication is a lookup in a 64 KB table, one row per coefficient, so
+coding a block is a NumPy take() and an XOR per coefficient.
+"""
+
+from threading import Lock
+import numpy
+
+# exp and log tables of the field, exp doubled up to skip a modulo
+gf_exp = [0] * 510
+gf_log = [0] * 256
+x = 1
+for i in xrange(255):
+    gf_exp[i] = gf_exp[i + 255] = x
+    gf_log[x] = i
+    x <<= 1
+    if x & 0x100:
+        x ^= 0x11d
+del x, i
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return gf_exp[gf_log[a] + gf_log[b]]
+
+def gf_inverse(a):
+    return gf_exp[255 - gf_log[a]]
+
+# mul_table[c] maps each byte b to c*b
+mul_table = numpy.zeros((256, 256), dtype=numpy.uint8)
+for c in xrange(1, 256):
+    mul_table[c] = [gf_mul(c, b) for b in xrange(256)]
+
+def invert_matrix(rows):
+    """
+    Inverse of a square matrix (a list of rows) by Gauss-Jordan elimination.
+    """
+    n = len(rows)
+    a = [list(row) + [int(i == j) for j in xrange(n)] for i, row in enumerate(rows)]
+    for col in xrange(n):
+        pivot = col
+        while a[pivot][col] == 0:
+            pivot += 1
+            if pivot == n:
+                raise ValueError("matrix is singular")
+        a[col], a[pivot] = a[pivot], a[col]
+        scale = gf_inverse(a[col][col])
+        a[col] = [gf_mul(scale, v) for v in a[col]]
+        for r in xrange(n):
+            if r != col and a[r][col]:
+                f = a[r][col]
+                a[r] = [v ^ gf_mul(f, p) for v, p in zip(a[r], a[col])]
+    return [row[n:] for row in a]
+
+def matrix_multiply(a, b):
+    return [[reduce(lambda acc, t: acc ^ gf_mul(t[0], t[1]), zip(row, col), 0) 
+             for col in zip(*b)] for row in a]
+
+def encoding_matrix(k, m):
+    """
+    The m x k systematic encoding matrix: a Vandermonde matrix made 
+    systematic by multiplying it by the inverse of its top k rows.
+    """
+    vandermonde = [[int(col == 0) for col in xrange(k)]]
+    for row in xrange(m - 1):
+        vandermonde.append([gf_exp[(row * col) % 255] for col in xrange(k)])
+    top = invert_matrix(vandermonde[:k])
+    identity = [[int(i == j) for j in xrange(k)] for i in xrange(k)]
+    return identity + matrix_multiply(vandermonde[k:], top)
+
+def combine(coefficients, blocks):
+    # sum of coefficient * block over GF(256), as a string
+    acc = None
+    for c, block in zip(coefficients, blocks):
+        if c == 0:
+            continue
+        if c == 1:
+            term = block
+        else:
+            term = mul_table[c].take(block)
+        if acc is None:
+            acc = term.copy()
+        else:
+            numpy.bitwise_xor(acc, term, acc)
+    if acc is None:
+        acc = numpy.zeros(len(blocks[0]), dtype=numpy.uint8)
+    return acc.tostring()
+
+def as_array(block):
+    return numpy.frombuffer(block, dtype=numpy.uint8)
+
+def check_parameters(k, m):
+    if not 1 <= k <= m <= 256:
+        raise ValueError("need 1 <= k <= m <= 256, got k=%s m=%s" % (k, m))
+
+
+class Encoder(object):
+    def __init__(self, k, m):
+        check_parameters(k, m)
+        self.k = k
+        self.m = m
+        self.matrix = encoding_matrix(k, m)
+
+    def encode(self, segments, blocknums=None):
+        """
+        @param segments: k strings or buffers of equal length
+        @param blocknums: the shares wanted, all m by default
+
+        @return: the blocks of those shares.  Segments are returned as they
+            were passed in.
+        """
+        if blocknums is None:
+            blocknums = range(self.m)
+        arrays = None
+        blocks = []
+        for n in blocknums:
+            if n < self.k:
+                blocks.append(segments[n])
+                continue
+            if arrays is None:
+                arrays = [as_array(segment) for segment in segments]
+            blocks.append(combine(self.matrix[n], arrays))
+        return blocks
+
+
+class Decoder(object):
+    def __init__(self, k, m):
+        check_parameters(k, m)
+        self.k = k
+        self.m = m
+        self.matrix = encoding_matrix(k, m)
+        # Decoding matrices by the shares they decode from
+        self.lock = Lock()
+        self.inverses = {}
+
+    def inverse(self, sharenums):
+        key = tuple(sharenums)
+        inverse = self.inverses.get(key)
+        if inverse is None:
+            inverse = invert_matrix([self.matrix[n] for n in sharenums])
+            self.lock.acquire()
+            try:
+                self.inverses[key] = inverse
+            finally:
+                self.lock.release()
+        return inverse
+
+    def decode(self, blocks, sharenums):
+        """
+        @param blocks: k blocks of equal length
+        @param sharenums: the share number of each block
+
+        @return: the k segments.  Those among blocks are returned as they 
+            were passed in.
+        """
+        if len(blocks) != self.k or len(sharenums) != self.k:
+            raise ValueError("need %s blocks, got %s" % (self.k, len(blocks)))
+        present = dict([(n, block) for n, block in zip(sharenums, blocks) if n < self.k])
+        if len(present) == self.k:
+            return [present[n] for n in xrange(self.k)]
+        inverse = self.inverse(sharenums)
+        arrays = [as_array(block) for block in blocks]
+        segments = []
+        for i in xrange(self.k):
+            if i in present:
+                segments.append(present[i])
+            else:
+                segments.append(combine(inverse[i], arrays))
+        return segments
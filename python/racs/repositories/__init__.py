@@ -48,3 +48,5 @@ try:
     from rackspace.rs import *
 except ImportError:
     pass
+
+from packed import *
@@ -40,9 +40,10 @@ from racs.exceptions import *
 from racs.util.s3 import *
 from racs.util.misc import *
 from racs.util.stats import *
+from racs.util.streams import read_cancellable
 
 import cPickle as pickle
-import os, sys, re
+import os, sys, re, hashlib, uuid
 from os.path import abspath, join
 #from os import mkdir, rmdir, remove, listdir
 
@@ -51,6 +52,7 @@ for f in [
     os.mkdir,
     os.rmdir,
     os.remove,
+    os.rename,
     os.listdir,
     open,
     ]:
@@ -125,9 +127,16 @@ class FSRepository(Repository):
 
         self.bucket_path(bucket,True)
         kp = self.key_path(bucket,key)
-        f = open(kp,'wb')
-        f.write(data)
-        f.close()
+        tp = self.temp_path(kp)
+        f = open(tp,'wb')
+        try:
+            f.write(data)
+            f.close()
+        except:
+            f.close()
+            remove(tp)
+            raise
+        rename(tp,kp)
         
         etag = compute_etag(data)
         owner = None
@@ -137,6 +146,44 @@ class FSRepository(Repository):
                          elapsed = elapsed(),
                          bytes = len(data))
 
+    @record
+    def put_object_stream(self, bucket, key, stream, size, content_type=None, headers={}):
+        elapsed = Stopwatch()
+
+        self.bucket_path(bucket,True)
+        kp = self.key_path(bucket,key)
+        md5 = hashlib.md5()
+        nbytes = 0
+        tp = self.temp_path(kp)
+        f = open(tp,'wb')
+        try:
+            for block in stream:
+                f.write(block)
+                md5.update(block)
+                nbytes += len(block)
+            f.close()
+            if size is not None and nbytes != size:
+                raise Exception("put_object_stream: expected %s bytes, stream ended after %s" % (size, nbytes))
+        except:
+            f.close()
+            remove(tp)
+            raise
+        # Only a complete object replaces the old one
+        rename(tp,kp)
+
+        etag = '"%s"' % md5.hexdigest()
+        owner = None
+        self.write_meta(bucket,key,content_type,headers, etag, owner)
+
+        record_operation("fsrepo:put_object",
+                         elapsed = elapsed(),
+                         bytes = nbytes)
+
+    def temp_path(self, kp):
+        # Objects are written here, then renamed over the key.  Keys have 
+        # their dots quoted, so this name can't be taken for one.
+        return "%s.%s.tmp" % (kp, uuid.uuid4().hex)
+
     def meta_path(self, bucket, key):
         kp = self.key_path(bucket,key)
         return kp + ".meta"
@@ -170,8 +217,10 @@ class FSRepository(Repository):
         if not exists(kp):
             raise NotFound()
         f = open(kp,'rb')
-        data = f.read()
-        f.close()
+        try:
+            data = read_cancellable(f)
+        finally:
+            f.close()
         content_type, headers, etag, owner = self.read_meta(bucket,key)
 
         record_operation("fsrepo:get_object",
@@ -180,6 +229,41 @@ class FSRepository(Repository):
 
         return data, content_type, headers
 
+    @record
+    def get_range(self, bucket, key, bytes, start=0):
+        elapsed = Stopwatch()
+
+        kp = self.key_path(bucket,key)
+        if not exists(kp):
+            raise NotFound()
+        f = open(kp,'rb')
+        try:
+            f.seek(start)
+            data = read_cancellable(f, bytes)
+        finally:
+            f.close()
+        content_type, headers, etag, owner = self.read_meta(bucket,key)
+
+        record_operation("fsrepo:get_range",
+                         elapsed = elapsed(),
+                         bytes = len(data))
+
+        return data, content_type, headers
+
+    @record
+    def get_object_stream(self, bucket, key):
+        elapsed = Stopwatch()
+
+        kp = self.key_path(bucket,key)
+        if not exists(kp):
+            raise NotFound()
+        content_type, headers, etag, owner = self.read_meta(bucket,key)
+        f = open(kp,'rb')
+
+        record_operation("fsrepo:get_object_stream", elapsed = elapsed())
+
+        return f, content_type, headers
+
     @record
     def head(self, bucket, key):
         elapsed = Stopwatch()
@@ -223,7 +307,8 @@ class FSRepository(Repository):
         elapsed = Stopwatch()
 
         bp = self.bucket_path(bucket,True)
-        keys = [_fs_unquote(k) for k in listdir(bp) if not k.endswith('.meta')]
+        # Names with dots are metadata and objects being written
+        keys = [_fs_unquote(k) for k in listdir(bp) if '.' not in k]
 
         keys, common_prefixes = select_keys(keys, prefix, marker, delimiter, max_keys)
         entries = []
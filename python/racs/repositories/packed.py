@@ -0,0 +1,480 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+from racs.s3_entities import *
+from racs.repository import *
+from racs.exceptions import *
+from racs.util.s3 import *
+from racs.util.misc import *
+from racs.util.stats import *
+
+import cPickle as pickle
+import struct, time
+from threading import Lock, Event
+from StringIO import StringIO
+
+# Packs are stored as ordinary objects of the bucket under this prefix,
+# named by sequence number so that they sort in the order written.
+pack_prefix = '.racs-packs/'
+
+record = record_event_decorator('packrepo')
+
+# A pack is the length of its pickled index, the index, then the data of
+# each object packed in it, one after another.
+_pack_header = '!I'
+_pack_header_length = struct.calcsize(_pack_header)
+
+class PackedObject(object):
+    def __init__(self, pack, offset, size, content_type, headers, etag):
+        self.pack = pack
+        self.offset = offset # from the end of the pack's index
+        self.size = size
+        self.content_type = content_type
+        self.headers = headers
+        self.etag = etag
+
+class Pack(object):
+    def __init__(self, name, written, data_offset=0):
+        self.name = name
+        self.written = written
+        self.data_offset = data_offset
+        self.live = set() # keys whose current version is in this pack
+        # Packs holding older versions of keys written or deleted in this
+        # one.  While any of them exists, this pack is what hides them.
+        self.hides = set()
+
+class PackBatch(object):
+    # Objects and deletions waiting to go into the next pack
+    def __init__(self):
+        self.objects = [] # (key, data, content_type, headers, etag)
+        self.deleted = [] # (key, name of the pack holding it)
+        self.bytes = 0
+        self.full = Event()
+        self.done = Event()
+        self.error = None
+
+class BucketIndex(object):
+    def __init__(self):
+        self.lock = Lock()
+        # Held while a pack is written, so that packs are written (and
+        # applied to the index) in sequence
+        self.write_lock = Lock()
+        self.loaded = False
+        self.objects = {} # key -> PackedObject
+        self.packs = {} # name -> Pack
+        self.unpacked = set() # keys stored in the wrapped repository itself
+        self.sequence = 0
+        self.batch = None
+
+class PackedRepository(Repository):
+    """
+    Packs objects smaller than pack_below bytes into pack objects of up to
+    pack_size bytes, so that small objects cost a share of one repository
+    request and one stored object rather than one each.  A PUT of a small
+    object waits up to pack_delay seconds for others to share its pack, and
+    returns once the pack is stored.
+
+    Each pack carries an index of the objects in it, and the bucket's index
+    (key -> pack, offset and size) is read from the packs on first use.  
+    Objects deleted or overwritten are dropped from the index; a pack is
+    deleted once none of its objects are current.  Larger objects, and any
+    stored before packing was configured, are passed straight on to the 
+    wrapped repository; the index keeps track of those too, so that one 
+    overwritten by a packed object can be deleted.
+
+    The index is kept in memory, so only one RACS proxy may write to a
+    repository that packs.
+    """
+
+    options = ['pack_below', 'pack_size', 'pack_delay']
+
+    def __init__(self, server, repository, pack_below, pack_size=4*1024*1024, pack_delay=0.01):
+        Repository.__init__(self, server, repository.name, repository.active)
+        self.repository = repository
+        self.pack_below = int(pack_below)
+        self.pack_size = int(pack_size)
+        self.pack_delay = float(pack_delay)
+        self.lock = Lock()
+        self.indexes = {} # bucket -> BucketIndex
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.repository)
+
+    # ------ the bucket index ------------------------------------------------
+
+    def index(self, bucket):
+        self.lock.acquire()
+        try:
+            index = self.indexes.setdefault(bucket, BucketIndex())
+        finally:
+            self.lock.release()
+        loaded = []
+        index.lock.acquire()
+        try:
+            if not index.loaded:
+                try:
+                    self.load_index(bucket, index)
+                except:
+                    # A read cut short (or cancelled) leaves the index half
+                    # built; start over on the next use rather than load the
+                    # same packs twice
+                    index.objects.clear()
+                    index.packs.clear()
+                    index.unpacked.clear()
+                    index.sequence = 0
+                    raise
+                index.loaded = True
+                loaded = index.packs.values()
+        finally:
+            index.lock.release()
+        # Clear away packs left over from deletions that were cut short
+        for pack in loaded:
+            self.collect(bucket, index, pack)
+        return index
+
+    def load_index(self, bucket, index):
+        elapsed = Stopwatch()
+        names = []
+        for omd in self.repository.get_bucket_contents(bucket):
+            if not isinstance(omd, ObjectMetaData):
+                continue
+            if omd.key.startswith(pack_prefix):
+                names.append(omd.key)
+            else:
+                index.unpacked.add(omd.key)
+        names.sort()
+        for name in names:
+            objects, deleted, written, data_offset = self.read_pack_index(bucket, name)
+            pack = Pack(name, written, data_offset)
+            index.packs[name] = pack
+            index.sequence = max(index.sequence, int(name[len(pack_prefix):]))
+            for key, hidden in deleted:
+                current = index.objects.get(key)
+                if current is not None and current.pack.name == hidden:
+                    del index.objects[key]
+                    current.pack.live.discard(key)
+                if hidden in index.packs and hidden != name:
+                    pack.hides.add(hidden)
+            for key, offset, size, content_type, headers, etag in objects:
+                self.add_object(index, key, PackedObject(pack, offset, size, content_type, headers, etag))
+        record_operation("packrepo:load_index",
+                         elapsed = elapsed(),
+                         n_objects = len(index.objects))
+
+    def read_pack_index(self, bucket, name):
+        # The index usually fits in the first read
+        data = self.repository.get_range(bucket, name, 64*1024)[0]
+        n, = struct.unpack(_pack_header, data[:_pack_header_length])
+        end = _pack_header_length + n
+        if end > len(data):
+            data += self.repository.get_range(bucket, name, end - len(data), len(data))[0]
+        pack_index = pickle.loads(data[_pack_header_length:end])
+        return pack_index['objects'], pack_index['deleted'], pack_index['written'], end
+
+    def add_object(self, index, key, entry):
+        current = index.objects.get(key)
+        if current is not None:
+            current.pack.live.discard(key)
+            # A pack may hold two versions of a key written together; it
+            # must not hide itself, or it would never be collected
+            if current.pack is not entry.pack:
+                entry.pack.hides.add(current.pack.name)
+        index.objects[key] = entry
+        entry.pack.live.add(key)
+
+    def lookup(self, bucket, key):
+        index = self.index(bucket)
+        index.lock.acquire()
+        try:
+            return index.objects.get(key)
+        finally:
+            index.lock.release()
+
+    def collect(self, bucket, index, pack):
+        # Deletes pack if it holds no current objects and hides no older
+        # pack, then any packs that were only kept to hide it
+        garbage = []
+        index.lock.acquire()
+        try:
+            pending = [pack]
+            while pending:
+                pack = pending.pop()
+                if pack.live or [name for name in pack.hides if name in index.packs]:
+                    continue
+                if index.packs.pop(pack.name, None) is None:
+                    continue
+                garbage.append(pack.name)
+                pending.extend([p for p in index.packs.values() if pack.name in p.hides])
+        finally:
+            index.lock.release()
+        for name in garbage:
+            self.repository.delete_object(bucket, name)
+        return garbage
+
+    def forget(self, bucket, key):
+        # Drops the packed version of key, if any: it has been deleted or 
+        # overwritten in the wrapped repository.  Unless that empties its
+        # pack, a deletion is written to the next pack so the packed version
+        # stays forgotten when the index is next read.
+        index = self.index(bucket)
+        index.lock.acquire()
+        try:
+            current = index.objects.pop(key, None)
+            if current is not None:
+                current.pack.live.discard(key)
+        finally:
+            index.lock.release()
+        if current is None:
+            return
+        if current.pack.name not in self.collect(bucket, index, current.pack):
+            self.commit(bucket, index, deleted = (key, current.pack.name))
+
+    # ------ writing packs ---------------------------------------------------
+
+    def commit(self, bucket, index, obj=None, deleted=None):
+        # Adds an object or a deletion to the bucket's next pack and waits
+        # until that pack is written.  The first to join a pack writes it,
+        # once it is full or pack_delay has passed.
+        index.lock.acquire()
+        try:
+            batch = index.batch
+            if batch is None:
+                batch = index.batch = PackBatch()
+            if obj is not None:
+                batch.objects.append(obj)
+                batch.bytes += len(obj[1])
+            else:
+                batch.deleted.append(deleted)
+            leader = len(batch.objects) + len(batch.deleted) == 1
+            if batch.bytes >= self.pack_size:
+                index.batch = None
+                batch.full.set()
+        finally:
+            index.lock.release()
+
+        if leader:
+            batch.full.wait(self.pack_delay)
+            index.write_lock.acquire()
+            try:
+                index.lock.acquire()
+                if index.batch is batch:
+                    index.batch = None
+                index.lock.release()
+                try:
+                    self.write_pack(bucket, index, batch)
+                except Exception, e:
+                    batch.error = e
+            finally:
+                index.write_lock.release()
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def write_pack(self, bucket, index, batch):
+        elapsed = Stopwatch()
+        index.sequence += 1
+        name = '%s%012d' % (pack_prefix, index.sequence)
+        written = time.time()
+
+        objects = []
+        offset = 0
+        for key, data, content_type, headers, etag in batch.objects:
+            objects.append((key, offset, len(data), content_type, headers, etag))
+            offset += len(data)
+        packed_index = pickle.dumps(dict(objects=objects, deleted=batch.deleted, written=written), 
+                                    pickle.HIGHEST_PROTOCOL)
+        data = ''.join([struct.pack(_pack_header, len(packed_index)), packed_index] + 
+                       [obj[1] for obj in batch.objects])
+        self.repository.put_object(bucket, name, data)
+
+        pack = Pack(name, written, _pack_header_length + len(packed_index))
+        superseded = []
+        unpacked = []
+        index.lock.acquire()
+        try:
+            index.packs[name] = pack
+            for key, hidden in batch.deleted:
+                if hidden in index.packs and hidden != name:
+                    pack.hides.add(hidden)
+            for key, offset, size, content_type, headers, etag in objects:
+                current = index.objects.get(key)
+                if current is not None and current.pack is not pack:
+                    superseded.append(current.pack)
+                if key in index.unpacked:
+                    unpacked.append(key)
+                self.add_object(index, key, PackedObject(pack, offset, size, content_type, headers, etag))
+        finally:
+            index.lock.release()
+        for p in superseded:
+            self.collect(bucket, index, p)
+        for key in unpacked:
+            self.drop_unpacked(bucket, index, key)
+
+        record_operation("packrepo:write_pack",
+                         elapsed = elapsed(),
+                         bytes = len(data),
+                         n_objects = len(objects))
+
+    def drop_unpacked(self, bucket, index, key):
+        # Deletes the wrapped repository's (larger, older) version of key, 
+        # now that a packed one has replaced it.  Should that fail, the 
+        # packed version still takes precedence, and the next write or 
+        # delete of key tries again.
+        try:
+            self.repository.delete_object(bucket, key)
+        except Exception, e:
+            self.server.log.warning("%s: could not delete %s/%s, overwritten by a packed object: %s", 
+                                    self, bucket, key, e)
+            return
+        index.lock.acquire()
+        try:
+            index.unpacked.discard(key)
+        finally:
+            index.lock.release()
+
+    def add_unpacked(self, bucket, key):
+        # key has been written to the wrapped repository; any packed version
+        # of it is out of date
+        index = self.index(bucket)
+        index.lock.acquire()
+        try:
+            index.unpacked.add(key)
+        finally:
+            index.lock.release()
+        self.forget(bucket, key)
+
+    # ------ Repository interface --------------------------------------------
+
+    def create_bucket(self, bucket):
+        self.repository.create_bucket(bucket)
+
+    def delete_bucket(self, bucket):
+        self.repository.delete_bucket(bucket)
+        self.lock.acquire()
+        try:
+            self.indexes.pop(bucket, None)
+        finally:
+            self.lock.release()
+
+    @record
+    def put_object(self, bucket, key, data, content_type=None, headers={}):
+        if len(data) >= self.pack_below:
+            self.repository.put_object(bucket, key, data, content_type, headers)
+            return self.add_unpacked(bucket, key)
+        index = self.index(bucket)
+        self.commit(bucket, index, obj = (key, str(data), content_type, dict(headers), compute_etag(data)))
+
+    def put_object_stream(self, bucket, key, stream, size, content_type=None, headers={}):
+        if size is not None and size < self.pack_below:
+            return Repository.put_object_stream(self, bucket, key, stream, size, content_type, headers)
+        self.repository.put_object_stream(bucket, key, stream, size, content_type, headers)
+        self.add_unpacked(bucket, key)
+
+    def read_packed(self, bucket, entry, bytes, start=0):
+        bytes = max(min(bytes, entry.size - start), 0)
+        data = self.repository.get_range(bucket, entry.pack.name, bytes, entry.pack.data_offset + entry.offset + start)[0]
+        if len(data) != bytes:
+            raise IOError("Pack %s/%s truncated" % (bucket, entry.pack.name))
+        return data
+
+    @record
+    def get_object(self, bucket, key):
+        entry = self.lookup(bucket, key)
+        if entry is None:
+            return self.repository.get_object(bucket, key)
+        return self.read_packed(bucket, entry, entry.size), entry.content_type, dict(entry.headers)
+
+    def get_object_stream(self, bucket, key):
+        entry = self.lookup(bucket, key)
+        if entry is None:
+            return self.repository.get_object_stream(bucket, key)
+        return StringIO(self.read_packed(bucket, entry, entry.size)), entry.content_type, dict(entry.headers)
+
+    def get_range(self, bucket, key, bytes, start=0):
+        entry = self.lookup(bucket, key)
+        if entry is None:
+            return self.repository.get_range(bucket, key, bytes, start)
+        return self.read_packed(bucket, entry, bytes, start), entry.content_type, dict(entry.headers)
+
+    def head(self, bucket, key):
+        entry = self.lookup(bucket, key)
+        if entry is None:
+            return self.repository.head(bucket, key)
+        headers = {
+            'Content-Type': entry.content_type,
+            'Last-Modified' : format_timestamp(entry.pack.written),
+            'Etag' : entry.etag,
+            'Content-Length': entry.size,
+            }
+        headers.update(entry.headers)
+        return headers
+
+    @record
+    def delete_object(self, bucket, key):
+        self.repository.delete_object(bucket, key)
+        index = self.index(bucket)
+        index.lock.acquire()
+        try:
+            index.unpacked.discard(key)
+        finally:
+            index.lock.release()
+        self.forget(bucket, key)
+
+    def get_bucket_contents(self, bucket, prefix=None, marker=None, delimiter=None, max_keys=None):
+        # Lists the wrapped repository's objects together with the packed 
+        # ones, which take precedence
+        objects = {}
+        for omd in self.repository.get_bucket_contents(bucket, prefix):
+            if isinstance(omd, ObjectMetaData) and not omd.key.startswith(pack_prefix):
+                objects[omd.key] = omd
+        index = self.index(bucket)
+        index.lock.acquire()
+        try:
+            for key, entry in index.objects.items():
+                if prefix is None or key.startswith(prefix):
+                    objects[key] = ObjectMetaData(key, entry.pack.written, entry.etag, entry.size, 
+                                                  metadata=dict(entry.headers))
+        finally:
+            index.lock.release()
+
+        keys, common_prefixes = select_keys(sorted(objects.keys()), prefix, marker, delimiter, max_keys)
+        entries = [Prefix(bucket,p) for p in common_prefixes]
+        entries.extend([objects[k] for k in keys])
+        return entries
+
+    def get_all_buckets(self):
+        return self.repository.get_all_buckets()
@@ -39,6 +39,7 @@ from racs.repository import *
 from racs.exceptions import *
 
 from racs.util.stats import *
+from racs.util.streams import IteratorStream, read_cancellable
 
 # Insert custom cloudfiles into the python path
 import sys, os, httplib
@@ -128,6 +129,34 @@ class RSRepository(Repository):
         #
         # Overwrites objects if they already exist.
         # Throws NoSuchBucket if bucket does not exist
+        obj = self.create_object(bucket, key, content_type)
+        obj.write(data, verify=True)
+        obj.metadata = headers
+        obj.sync_metadata()
+        record_operation("rsrepo:put_object",
+                         elapsed = elapsed(),
+                         bytes = len(data))
+
+    @record
+    def put_object_stream(self, bucket, key, stream, size, content_type=None, headers={}):
+        elapsed = Stopwatch()
+        obj = self.create_object(bucket, key, content_type)
+        # With size set, send() streams the iterable's blocks under a plain
+        # Content-Length; with size None it sends them chunked
+        obj.size = size
+        nbytes = [0]
+        def blocks():
+            for block in stream:
+                nbytes[0] += len(block)
+                yield block
+        obj.send(blocks())
+        obj.metadata = headers
+        obj.sync_metadata()
+        record_operation("rsrepo:put_object",
+                         elapsed = elapsed(),
+                         bytes = nbytes[0])
+
+    def create_object(self, bucket, key, content_type=None):
         conn = self.get_connection()
         cn = self.container_name(bucket)
         on = self.object_name(key)
@@ -140,12 +169,7 @@ class RSRepository(Repository):
                 raise e
         if content_type:
             obj.content_type = content_type
-        obj.write(data, verify=True)
-        obj.metadata = headers
-        obj.sync_metadata()
-        record_operation("rsrepo:put_object",
-                         elapsed = elapsed(),
-                         bytes = len(data))
+        return obj
     @record
     def get_object(self, bucket, key):
         elapsed = Stopwatch()
@@ -155,7 +179,11 @@ class RSRepository(Repository):
         cn = self.container_name(bucket)
         on = self.object_name(key)        
         obj = conn.get_container(cn).get_object(on)
-        data = obj.read()
+        stream = IteratorStream(obj.stream())
+        try:
+            data = read_cancellable(stream)
+        finally:
+            stream.close()
         content_type = obj.content_type
         headers = obj.metadata
         record_operation("rsrepo:get_object",
@@ -163,6 +191,29 @@ class RSRepository(Repository):
                          bytes = len(data))
         return data, content_type, headers
 
+    @record
+    def get_range(self, bucket, key, bytes, start=0):
+        elapsed = Stopwatch()
+        conn = self.get_connection()
+        cn = self.container_name(bucket)
+        on = self.object_name(key)        
+        obj = conn.get_container(cn).get_object(on)
+        data = obj.read(size=bytes, offset=start)
+        record_operation("rsrepo:get_range",
+                         elapsed = elapsed(),
+                         bytes = len(data))
+        return data, obj.content_type, obj.metadata
+
+    @record
+    def get_object_stream(self, bucket, key):
+        elapsed = Stopwatch()
+        conn = self.get_connection()
+        cn = self.container_name(bucket)
+        on = self.object_name(key)        
+        obj = conn.get_container(cn).get_object(on)
+        record_operation("rsrepo:get_object_stream", elapsed = elapsed())
+        return IteratorStream(obj.stream()), obj.content_type, obj.metadata
+
     @record
     def delete_object(self, bucket, key):
         elapsed = Stopwatch()
@@ -38,7 +38,7 @@ from racs.s3_entities import *
 from racs.repository import *
 from racs.exceptions import *
 
-import sys, os, httplib
+import sys, os, httplib, hashlib, base64, tempfile
 
 try:
     import boto
@@ -53,7 +53,6 @@ from boto.s3.connection import S3ResponseError
 
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
-import StringIO
 from racs.fec import ShareMeta, FECMeta
 import boto.s3.prefix
 from racs.util import *
@@ -87,12 +86,15 @@ class S3Repository(Repository):
         self.establish_connection()
         
     def establish_connection(self):
-        print >> self.server.log, "%s connecting" % repr(self)
-        self.conn = S3Connection(self.s3_access_key_id, 
-                                 self.s3_secret_access_key, 
-                                 is_secure = False,
-                                 proxy = self.server.proxy_host, 
-                                 proxy_port = self.server.proxy_port)
+        self.server.log.info("%s connecting", repr(self))
+        self.conn = self.new_connection()
+
+    def new_connection(self):
+        return S3Connection(self.s3_access_key_id, 
+                            self.s3_secret_access_key, 
+                            is_secure = False,
+                            proxy = self.server.proxy_host, 
+                            proxy_port = self.server.proxy_port)
 
     def s3(self):
         return self.conn
@@ -124,11 +126,7 @@ class S3Repository(Repository):
                 raise e
 
 
-    @record
-    @synchronized
-    def put_object(self, bucket, key, data, content_type=None, headers={}):
-        elapsed = Stopwatch()
-
+    def _put_headers(self, content_type, headers):
         h2 = {}
         for k,v in headers.items():
             if k.startswith('x-amz-meta-'):
@@ -143,7 +141,14 @@ class S3Repository(Repository):
 
         if content_type:
             h2['Content-Type'] = content_type
+        return h2
 
+    @record
+    @synchronized
+    def put_object(self, bucket, key, data, content_type=None, headers={}):
+        elapsed = Stopwatch()
+
+        h2 = self._put_headers(content_type, headers)
         s3key = Key(self.get_bucket(bucket))
         s3key.key = key
         try:
@@ -160,22 +165,66 @@ class S3Repository(Repository):
                          bytes = len(data))
         
         
+    @record
+    def put_object_stream(self, bucket, key, stream, size, content_type=None, headers={}):
+        # All S3 access is serialized (see synchronized above).  Holding the
+        # connection while a client trickles the object in would stall every
+        # other S3 request, and deadlock against a second S3 repository fed
+        # by the same client stream.  So the share is spooled to a temporary
+        # file and uploaded once it is complete.
+        elapsed = Stopwatch()
+
+        spool = tempfile.TemporaryFile()
+        md5 = hashlib.md5()
+        nbytes = 0
+        for block in stream:
+            spool.write(block)
+            md5.update(block)
+            nbytes += len(block)
+        if size is not None and nbytes != size:
+            spool.close()
+            raise Exception("put_object_stream: expected %s bytes, stream ended after %s" % (size, nbytes))
+        spool.seek(0)
+
+        try:
+            self._put_file(bucket, key, spool, (md5.hexdigest(), base64.b64encode(md5.digest())), 
+                           self._put_headers(content_type, headers))
+        finally:
+            spool.close()
+
+        record_operation("s3repo:put_object",
+                         elapsed = elapsed(),
+                         bytes = nbytes)
+
+    @synchronized
+    def _put_file(self, bucket, key, fp, md5, h2):
+        s3key = Key(self.get_bucket(bucket))
+        s3key.key = key
+        try:
+            s3key.set_contents_from_file(fp, headers=h2, md5=md5)
+        except S3ResponseError, e:
+            if e.status == httplib.NOT_FOUND:
+                raise NoSuchBucket()
+            else:
+                # Shouldn't happen
+                raise e
+
     @record
     @synchronized
     def get_object(self, bucket, key, headers={}):
         elapsed = Stopwatch()
 
-        print >> self.server.log, "%s: get_object %s %s" % (id(self),bucket,key)
+        self.server.log.debug("%s: get_object %s %s", id(self),bucket,key)
         s3key = Key(self.get_bucket(bucket))
         s3key.key = key
-        print >> self.server.log, "%s: s3key %s, headers %s" % (id(self),s3key,headers)
-        data = s3key.get_contents_as_string(headers=headers)
+        self.server.log.debug("%s: s3key %s, headers %s", id(self),s3key,headers)
+        data = self.get_contents(s3key, headers)
         metadata = s3key.metadata
         if data is None:
             ld = "(NONE!)"
         else:
             ld = len(data)
-        print >> self.server.log, "%s: get_object returning %s bytes" % (self,ld)
+        self.server.log.debug("%s: get_object returning %s bytes", self,ld)
 
         record_operation("s3repo:get_object",
                          elapsed = elapsed(),
@@ -183,6 +232,29 @@ class S3Repository(Repository):
 
         return data, s3key.content_type, metadata
     
+    def get_contents(self, s3key, headers):
+        # Checks for cancellation as each block arrives.  A cancelled read
+        # leaves the shared connection in the middle of a response, so it
+        # is replaced.
+        try:
+            return s3key.get_contents_as_string(headers=headers, 
+                                                cb=lambda done, size: check_cancelled(), num_cb=-1)
+        except Cancelled:
+            self.establish_connection()
+            raise
+
+    @record
+    def get_object_stream(self, bucket, key):
+        # The returned key is read long after this returns, so it can't use
+        # the shared (serialized) connection; it gets a connection of its own.
+        elapsed = Stopwatch()
+        conn = self.new_connection()
+        s3key = Key(conn.get_bucket(self.bucket_name(bucket),validate=False))
+        s3key.key = key
+        s3key.open_read()
+        record_operation("s3repo:get_object_stream", elapsed = elapsed())
+        return s3key, s3key.content_type, s3key.metadata
+    
     @record
     @synchronized
     def delete_object(self, bucket, key):
@@ -273,20 +345,22 @@ class S3Repository(Repository):
         record_operation("s3repo:head",elapsed=elapsed())
         return headers
 
+    @record
     @synchronized
     def get_range(self, bucket, key, bytes, start=0):
-        b = self.get_bucket(bucket)
-        k = b.get_key(key)
+        elapsed = Stopwatch()
+        s3key = Key(self.get_bucket(bucket))
+        s3key.key = key
         headers = {
             'Range':'bytes=%d-%d' % (start, start+bytes-1)
         }
-        k.open('r', headers)
-        fp = StringIO.StringIO()
-        for bytes in k:
-            fp.write(bytes)
-        k.close()
-        fp.seek(0)
-        return fp.read()
+        data = self.get_contents(s3key, headers)
+
+        record_operation("s3repo:get_range",
+                         elapsed = elapsed(),
+                         bytes = len(data))
+
+        return data, s3key.content_type, s3key.metadata
 
     def _botokey_to_ObjectMetaData(self, botokey):
         try:
@@ -302,8 +376,8 @@ class S3Repository(Repository):
             encoded_meta = botokey.metadata[FECMeta.short_header]
             fecmeta = None
         except Exception, e:
-            print >> self.server.log, "Error getting FECMeta in botokey_to_ObjectMetaData"
-            print >>self.server.log, "Metadata is: %s" %  botokey.metadata
+            self.server.log.error("Error getting FECMeta in botokey_to_ObjectMetaData")
+            self.server.log.error("Metadata is: %s", botokey.metadata)
             class Ug:
                 pass
             fecmeta = Ug()
@@ -35,6 +35,7 @@
 # 
 
 import sys
+from StringIO import StringIO
 from racs.exceptions import *
 from racs.s3_entities import *
 
@@ -72,11 +73,50 @@ class Repository(object):
         
         self.method_not_implemented("put_object")
 
+    def put_object_stream(self, bucket, key, stream, size, content_type=None, headers={}):
+        # Like put_object, but the data is read from stream, a file-like object 
+        # (also iterable by blocks) that yields exactly size bytes.  size is 
+        # None if the length isn't known until the stream ends.
+        #
+        # The caller may still be filling in headers while the stream is being
+        # read, so only look at headers once the stream is exhausted.
+        #
+        # Override this if the repository can store data without holding the
+        # whole object in memory; the default buffers it and calls put_object.
+        data = stream.read(size)
+        if size is not None and len(data) != size:
+            raise Exception("put_object_stream: expected %s bytes, stream ended after %s" % (size, len(data)))
+        if size is not None and stream.read(1):
+            raise Exception("put_object_stream: stream longer than %s bytes" % size)
+        # Only now that the stream has ended are the headers complete
+        self.put_object(bucket, key, data, content_type=content_type, headers=headers)
+
     def get_object(self, bucket, key):
         # Returns a triple (data, content-type, metadata dict)
         # Throws NotFound if bucket/path does not exist
         self.method_not_implemented("get_object")
 
+    def get_object_stream(self, bucket, key):
+        # Like get_object, but returns (stream, content-type, metadata dict) where
+        # stream is a file-like object supporting read(n) and close().  The
+        # stream may be read from any thread after this returns.
+        #
+        # Override this if the repository can hand out data before the whole
+        # object has been fetched; the default fetches it all with get_object.
+        data, content_type, metadata = self.get_object(bucket, key)
+        return StringIO(data), content_type, metadata
+
+    def get_range(self, bucket, key, bytes, start=0):
+        # Returns a triple (data, content-type, metadata dict) where data is
+        # the given number of bytes of the object from offset start onwards
+        # (fewer if the object ends first)
+        # Throws NotFound if bucket/path does not exist
+        #
+        # Override this if the repository can read part of an object; the
+        # default fetches the whole object with get_object.
+        data, content_type, metadata = self.get_object(bucket, key)
+        return data[start:start+bytes], content_type, metadata
+
     def head(self, bucket, key):
         # returns headers dict with Content-Type, Etag, Content-Length, and meta-info headers
         # raises NotFound if object doesn't exist
@@ -35,7 +35,8 @@
 # 
 
 #from boto.exception import *
-import sys
+import sys, base64, hashlib
+from threading import Lock
 
 from s3_request_handler import *
 from s3_entities import *
@@ -51,6 +52,42 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
     head_cache = HeadCache()
     release_lock = None
 
+    # Stripes buffered per repository between the client and a slow repository
+    # during a streaming put
+    stream_buffer_stripes = 4
+
+    def setup(self):
+        S3HTTPRequestHandler.setup(self)
+        self.keepalive_timeout = self.server.keepalive_timeout
+
+    def workers_saturated(self):
+        return self.server.frontend_saturated()
+
+    def abandon_response(self, request, exception):
+        if not S3HTTPRequestHandler.abandon_response(self, request, exception):
+            return False
+        self.release_zk_lock()
+        record_operation(self.op+"_fail",elapsed=self.elapsed(),**self.opargs)
+        return True
+
+    def reset_request(self):
+        S3HTTPRequestHandler.reset_request(self)
+        self.release_lock = None
+        self.op = RACSHTTPRequestHandler.op
+        self.opargs = {}
+        self.fecmeta = None
+        self.upload = None
+        self.part_number = None
+        self.replaced_parts = None
+
+    # Access and error lines from BaseHTTPRequestHandler go to the server
+    # log rather than stderr, and without a reverse DNS lookup per request
+    def log_message(self, format, *args):
+        self.server.log.info("%s - %s", self.client_address[0], format % args)
+
+    def log_error(self, format, *args):
+        self.server.log.warning("%s - %s", self.client_address[0], format % args)
+
     # debuggery
     def write(self, msg):
         if not self.server.verbose:
@@ -68,7 +105,8 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
             quorum_handler = self.typical_success,
             anti_quorum_handler = self.typical_failure,
             rollback_handler = lambda repo,result: repo.delete_bucket(self.bucket),
-            exception_handler = self.debugging_exception_handler
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
         )
 
 
@@ -82,14 +120,14 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
             quorum_handler = self.typical_success,
             anti_quorum_handler = self.typical_failure,
             #rollback_handler = lambda query,repo,result: repo.create_bucket(self.bucket),
-            exception_handler = self.debugging_exception_handler
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
         )
 
     op = "???"
     opargs = {}
 
     def get_head(self, repository, bucket, key):
-        self.op = 'racs:head'
         if not self.head_cache:
             return repository.head(bucket,key)
         else:
@@ -99,23 +137,30 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
                 return v
             except KeyError:
                 h = repository.head(bucket,key)
-                self.head_cache.put(bucket,key,h)
+                if h is not None:
+                    self.head_cache.put(bucket,key,h)
                 return h
 
-    def typical_success(self, query, headers={}):
+    def forget_head(self):
+        # Called on every write, so that conditional requests never see
+        # the headers of an object that has since been replaced
+        if self.head_cache:
+            self.head_cache.remove(self.bucket,self.key)
+
+    def typical_success(self, query, headers={}, status=200):
         if thread_manager.verbose:
-            print "[Success: 200]"
-        self.send_response(200)
+            print "[Success: %s]" % status
+        self.send_response(status)
         self.send_id_headers()
-        self.send_header('Connection','close')
-        self.send_header('Content-Length','0')
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length','0')
         for k,v in headers.items():
             self.send_header(k,v)
         self.end_headers()
 
-        if self.release_lock:
-            self.release_lock()
+        self.release_zk_lock()
         record_operation(self.op,elapsed=self.elapsed(),**self.opargs)
+        self.finish_response()
 
     def debugging_exception_handler(self, query, param, exception):
         import traceback
@@ -127,15 +172,17 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
             # FIXME: check for this better
             print >> sys.stderr, "ParallelQuery exception thrown for %s" % repr(param)
             print >> sys.stderr, tb
+            # The repository failed, rather than answering with an error
+            health = getattr(param, 'health', None)
+            if health is not None:
+                health.failed()
 
     def typical_failure(self, query=None, headers={}, status=None):
 
         try:
             exception = query.exceptions.values()[0]
             status = exception.status
-        except AttributeError:
-            status = 500
-        except IndexError:
+        except (AttributeError, IndexError):
             if status is None:
                 status = 500
         if thread_manager.verbose:
@@ -143,14 +190,14 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
 
         self.send_response(status)
         self.send_id_headers()
-        self.send_header('Connection','close')
+        self.send_header('Content-Length','0')
         for k,v in headers.items():
             self.send_header(k,v)
         self.end_headers()
 
-        if self.release_lock:
-            self.release_lock()
+        self.release_zk_lock()
         record_operation(self.op+"_fail",elapsed=self.elapsed(),**self.opargs)
+        self.finish_response()
 
 
     def handle_put_object(self, cache_control=None, content_type=None, content_length=None, 
@@ -162,7 +209,7 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
 
 
         if acl:
-            print >> self.server.log, "Warning: handle_put_object received acl=%s. ACL not implemented; ignored" % acl
+            self.server.log.warning("handle_put_object received acl=%s. ACL not implemented; ignored", acl)
 
         if x_amz_meta:
             for k,v in x_amz_meta.items():
@@ -173,32 +220,67 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
 
         if cache_control:
             return self.handle_not_implemented("handle_put_object - cache_control")
-        
-        data = self.read(content_length=content_length, content_encoding=content_encoding)
-        etag = etag_header(data)
+
+        chunked = self.chunked_body(content_encoding)
+        if content_encoding is not None and not chunked:
+            return self.handle_not_implemented("content encoding %s" % content_encoding)
+        if chunked:
+            # Only aws-chunked tells us the length of the decoded body
+            content_length = self.headers.get('x-amz-decoded-content-length')
+            if content_length is not None:
+                content_length = int(content_length)
+        elif content_length is None:
+            return self.typical_failure(status=411)
+
+        if self.upload is None:
+            self.replaced_parts = self.track_replaced_parts()
+
+        # The body is hashed as it is read, once for the ETag, Content-MD5
+        # and FECMeta alike
+        body = HashingReader(self.body_reader(content_encoding))
+        stripe_size = self.server.stripe_size
+        if content_length is None:
+            # A chunked body of unknown length: streamed if it turns out
+            # to be longer than a stripe
+            data = body.read(stripe_size)
+            if len(data) == stripe_size:
+                return self.put_object_streaming(body, None, content_type, content_md5, headers, data)
+            self._body_read = True
+        elif content_length > stripe_size:
+            return self.put_object_streaming(body, content_length, content_type, content_md5, headers)
+        elif chunked:
+            data = body.read()
+            self._body_read = True
+        else:
+            data = body.read(content_length)
+            self._body_read = True
+        md5 = body.md5.hexdigest()
+        etag = {'Etag' : '"%s"' % md5}
         if content_md5:
             # FIXME return proper error
-            m = compute_md5_64(data)
+            m = base64.b64encode(body.md5.digest())
             if content_md5 != m:
-                print >> sys.stderr, "put error: optional content_md5 does not match etag! (%s vs etag %s)" % (content_md5,m)
-                self.warn("content_md5 does not match!")
+                self.server.log.warning("put error: optional content_md5 does not match etag! (%s vs etag %s)", content_md5, m)
                 self.typical_failure(status=400)
                 return
                 
-        print >> self.server.log, "Handle put b:%s k:%s bytes:%s etag:%s" % (self.bucket,self.key, len(data), etag['Etag'])
+        self.server.log.debug("Handle put b:%s k:%s bytes:%s etag:%s", self.bucket,self.key, len(data), etag['Etag'])
 
         self.server.stats.record("racs:put_object")
 
 
-        shares, fecmeta = self.server.encode(data)
+        if self.server.replicates(self.bucket, len(data)):
+            shares, fecmeta = self.server.encoder().replicate(data, md5)
+        else:
+            shares, fecmeta = self.server.encode(data, md5)
         
         headers[FECMeta.short_header] = str(fecmeta)
         
         self.opargs = {
             "bytes" : len(data),
             }
-        cachekey = (str(self.bucket),str(self.key))
-        self.server.racs_metacache[cachekey] = ('"%s"'%fecmeta.md5,fecmeta.size)
+        self.fecmeta = fecmeta
+        self.cache_fecmeta(fecmeta)
 
 #        print >> self.server.log, "Handle put: %s %s type:%s headers:%s" % (self.bucket,self.key,content_type,headers)
 
@@ -214,17 +296,334 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
             self.release_lock = None
 
         ParallelQuery(
-            query_func = lambda r,share: r.put_object(self.bucket, self.key, share, content_type=content_type, headers=headers),
+            query_func = lambda r,share: r.put_object(self.bucket, self.key, share, content_type=content_type, 
+                                                      headers=share_headers(headers, ShareMeta.read(share).sharenum, share_checksum(share))),
             parameters = self.server.get_repositories(),
             #n_concurrent = 1, # should be temporary!
             supplementary_parameters = shares, #self.server.encode(data),
             abort_on_exception = True,
-            quorum_handler = lambda query: self.typical_success(query,etag),
+            quorum_handler = lambda query: self.finish_put_object(query,etag),
             anti_quorum_handler = self.typical_failure,
             rollback_handler = dorollback,#lambda repo,result: repo.delete_object(self.bucket, self.key),
-            exception_handler = self.debugging_exception_handler
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
+        )
+
+
+    def read_stripes(self, body, size, stripe_size, first_stripe=None):
+        # Yields (stripe, last) for each stripe of the request body.  A body
+        # of unknown size (None) runs to its end, so the reader stays one 
+        # stripe ahead to know which stripe is the last.
+        if size is not None:
+            remaining = size
+            while remaining > 0:
+                stripe = body.read(min(stripe_size, remaining))
+                if not stripe:
+                    raise IOError("Client closed connection with %s bytes left to send" % remaining)
+                remaining -= len(stripe)
+                yield stripe, remaining == 0
+        else:
+            stripe = first_stripe
+            if stripe is None:
+                stripe = body.read(stripe_size)
+            while stripe:
+                following = body.read(stripe_size)
+                yield stripe, not following
+                stripe = following
+
+    def put_object_streaming(self, body, content_length, content_type, content_md5, headers, first_stripe=None):
+        # Reads the body one stripe at a time, encodes each stripe as it arrives 
+        # and hands the blocks to one BlockPipe per repository.  The pipes are
+        # bounded, so a slow repository slows the client down rather than 
+        # letting the object pile up in memory.  content_length is None for
+        # a chunked body of unknown length; first_stripe is then the part of
+        # it already read.
+        self.op = 'racs:put_object'
+        self.server.stats.record("racs:put_object")
+
+        stripe_size = self.server.stripe_size
+        encoder = StripedEncoder(self.server.encoder(), content_length, stripe_size, body.md5)
+        repositories = self.server.get_repositories()
+        pipes = [BlockPipe(self.stream_buffer_stripes) for r in repositories]
+        pipe_headers = [share_headers(headers, i) for i in xrange(len(pipes))]
+        share_size = encoder.share_size()
+        etag = {}
+
+        self.server.log.debug("Handle streaming put b:%s k:%s bytes:%s stripe:%s", self.bucket,self.key, content_length, stripe_size)
+
+        self.opargs = {
+            "bytes" : content_length,
+            }
+
+        if self.server.use_zookeeper:
+            elapsed = Stopwatch()
+            self.release_lock = self.server.zk.request_write_lock(self.bucket,self.key)
+            record_operation("zk:request_write_lock",elapsed=elapsed())
+        else:
+            self.release_lock = None
+
+        def put_share(r, pipe, headers):
+            try:
+                return r.put_object_stream(self.bucket, self.key, pipe, share_size, content_type=content_type, headers=headers)
+            finally:
+                # Don't leave the reader below blocked on a repository that
+                # has stopped reading
+                pipe.abort()
+
+        def fail(query):
+            for pipe in pipes:
+                pipe.abort()
+            self.typical_failure(query)
+
+        ParallelQuery(
+            query_func = put_share,
+            parameters = repositories,
+            supplementary_parameters = zip(pipes, pipe_headers),
+            # every share must be consumed at the same pace, so none of them
+            # can be left waiting for a pool thread
+            dedicated_threads = True,
+            abort_on_exception = True,
+            quorum_handler = lambda query: self.finish_put_object(query,etag),
+            anti_quorum_handler = fail,
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
         )
 
+        try:
+            for pipe, share_header in zip(pipes, encoder.headers()):
+                pipe.put(share_header)
+            for stripe, last in self.read_stripes(body, content_length, stripe_size, first_stripe):
+                blocks = encoder.encode(stripe)
+                if last and content_md5 and \
+                        content_md5 != base64.b64encode(encoder.md5.digest()):
+                    raise BadDigest()
+                delivered = [pipe.put(block) for pipe, block in zip(pipes, blocks)]
+                if True not in delivered:
+                    # Every repository has given up; the failure has been reported
+                    return
+            if body.stream is not self.rfile and body.read(1):
+                # Reads to the end of a chunked body, which must be no
+                # longer than its stated length
+                raise IOError("Request body longer than its x-amz-decoded-content-length")
+            self._body_read = True
+            fecmeta = encoder.finish()
+        except Exception, e:
+            self.server.log.warning("%s streaming put failed after %s bytes: %s", self, encoder.nbytes, e)
+            for pipe in pipes:
+                pipe.fail(e)
+            return
+
+        # Repositories read the headers only after the last block, so the
+        # final FECMeta still makes it in
+        for h, checksum in zip(pipe_headers, encoder.checksums()):
+            h[FECMeta.short_header] = str(fecmeta)
+            h[ShareMeta.checksum_header] = checksum
+        etag['Etag'] = fecmeta.etag()
+        self.opargs['bytes'] = fecmeta.size
+        self.fecmeta = fecmeta
+        self.cache_fecmeta(fecmeta)
+        for pipe in pipes:
+            pipe.close()
+
+    def finish_put_object(self, query, etag):
+        self.forget_head()
+        if self.upload is not None:
+            self.upload.parts[self.part_number] = self.fecmeta
+        if self.replaced_parts is not None:
+            self.replaced_parts(self.fecmeta)
+        self.typical_success(query, etag)
+
+    def track_replaced_parts(self):
+        # Called as a write of the key begins.  Reads the FECMeta the key 
+        # had alongside the write, and returns a function to call with the
+        # new FECMeta once the write has reached a quorum, which deletes the
+        # parts of the multipart object the write replaced, if it did.
+        # Nothing waits on the read, so it goes to the repositories reads
+        # favour least.
+        bucket = self.bucket
+        lock = Lock()
+        versions = {}
+        def settle(version, fecmeta):
+            lock.acquire()
+            versions[version] = fecmeta
+            settled = len(versions) == 2
+            lock.release()
+            if not settled:
+                return
+            previous = versions['previous']
+            if previous is not None and previous.parts and previous.upload_id != versions['written'].upload_id:
+                self.delete_parts(bucket, previous.upload_id, range(1, previous.parts+1))
+        repositories = self.server.rank_repositories()
+        repositories.reverse()
+        self.read_previous_fecmeta(repositories, lambda fecmeta: settle('previous', fecmeta))
+        return lambda fecmeta: settle('written', fecmeta)
+
+    def read_previous_fecmeta(self, repositories, proceed, failure_handler=None):
+        # Calls proceed(fecmeta) with the FECMeta the key has before it is
+        # written or deleted, or None if it has none: from the cache, or 
+        # else from a HEAD of the first of repositories to answer
+        bucket, key = self.bucket, self.key
+        fecmeta = self.server.racs_metacache.get((str(bucket),str(key)))
+        if fecmeta is not None:
+            return proceed(fecmeta)
+
+        def head(r):
+            try:
+                return r.head(bucket, key)
+            except NotFound:
+                return None
+
+        def found(query):
+            headers = query.results.values()[0]
+            if headers is None or FECMeta.short_header not in headers:
+                return proceed(None)
+            proceed(FECMeta.read(headers[FECMeta.short_header]))
+
+        ParallelQuery(
+            query_func = head,
+            parameters = repositories,
+            n_concurrent = 1,
+            quorum = 1,
+            quorum_handler = found,
+            anti_quorum_handler = lambda q: proceed(None),
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = failure_handler
+        )
+
+    # Multipart uploads
+    #
+    # Each part is encoded and stored as an object of its own, under a key 
+    # in the hidden multipart_prefix namespace, so parts go up in parallel 
+    # and a failed part can be retried alone.  Completing the upload writes 
+    # the object's key with no data, only a FECMeta that lists the parts.  
+    # Uploads in progress are only known to the proxy that started them.
+
+    def handle_initiate_multipart_upload(self, content_type=None, x_amz_meta=None):
+        self.op = 'racs:initiate_multipart_upload'
+        self.server.stats.record("racs:initiate_multipart_upload")
+
+        headers = {}
+        if x_amz_meta:
+            for k,v in x_amz_meta.items():
+                headers[k[11:]] = v
+
+        upload = MultipartUpload(self.bucket, self.key, content_type, headers)
+        self.server.multipart_uploads[upload.upload_id] = upload
+        self.server.log.info("%s initiate multipart upload %s for %s/%s", self, upload.upload_id, self.bucket, self.key)
+
+        self.send_response(200)
+        self.send_id_headers()
+        record_operation(self.op,elapsed=self.elapsed())
+        self.send_xml_response(InitiateMultipartUploadResult(self.bucket, self.key, upload.upload_id))
+
+    def get_upload(self, upload_id):
+        upload = self.server.multipart_uploads.get(str(upload_id))
+        if upload is None or upload.bucket != self.bucket or upload.key != self.key:
+            return None
+        return upload
+
+    def handle_upload_part(self, uploadId, partNumber, content_type=None, content_length=None, 
+                           content_md5=None, content_encoding=None, x_amz_meta=None):
+        upload = self.get_upload(uploadId)
+        if upload is None:
+            return self.typical_failure(status=NoSuchUpload.error_code)
+        if not isinstance(partNumber, int) or not 1 <= partNumber <= 10000:
+            return self.typical_failure(status=InvalidPart.error_code)
+
+        self.upload = upload
+        self.part_number = partNumber
+        self.key = upload.part_key(partNumber)
+        self.handle_put_object(content_type=content_type, content_length=content_length, 
+                               content_md5=content_md5, content_encoding=content_encoding)
+
+    def handle_complete_multipart_upload(self, uploadId, content_length=None):
+        self.op = 'racs:complete_multipart_upload'
+        self.server.stats.record("racs:complete_multipart_upload")
+
+        upload = self.get_upload(uploadId)
+        if upload is None:
+            return self.typical_failure(status=NoSuchUpload.error_code)
+
+        body = self.read(content_length=content_length)
+        try:
+            fecmeta = upload.manifest(parse_complete_multipart_upload(body))
+        except HTTPException, e:
+            self.server.log.warning("%s complete multipart upload %s failed: %s", self, upload.upload_id, e.msg)
+            return self.typical_failure(status=e.status)
+
+        headers = dict(upload.headers)
+        headers[FECMeta.short_header] = str(fecmeta)
+        # The object's own shares carry no data
+        repositories = self.server.get_repositories()
+        shares = [str(ShareMeta(sharenum = i)) for i in xrange(len(repositories))]
+
+        if self.server.use_zookeeper:
+            elapsed = Stopwatch()
+            self.release_lock = self.server.zk.request_write_lock(self.bucket,self.key)
+            record_operation("zk:request_write_lock",elapsed=elapsed())
+
+        replaced_parts = self.track_replaced_parts()
+        ParallelQuery(
+            query_func = lambda r,share: r.put_object(self.bucket, self.key, share, content_type=upload.content_type, 
+                                                      headers=share_headers(headers, ShareMeta.read(share).sharenum, share_checksum(share))),
+            parameters = repositories,
+            supplementary_parameters = shares,
+            abort_on_exception = True,
+            quorum_handler = lambda query: self.finish_complete_multipart_upload(query, upload, fecmeta, replaced_parts),
+            anti_quorum_handler = self.typical_failure,
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
+        )
+
+    def finish_complete_multipart_upload(self, query, upload, fecmeta, replaced_parts):
+        self.server.multipart_uploads.pop(upload.upload_id, None)
+        self.cache_fecmeta(fecmeta)
+        self.forget_head()
+        self.release_zk_lock()
+        replaced_parts(fecmeta)
+
+        self.send_response(200)
+        self.send_id_headers()
+        record_operation(self.op,elapsed=self.elapsed(),bytes=fecmeta.size,parts=fecmeta.parts)
+        location = 'http://%s.%s/%s' % (self.bucket, S3_FQDN, self.key)
+        self.send_xml_response(CompleteMultipartUploadResult(location, self.bucket, self.key, fecmeta.etag()))
+
+        # Parts uploaded but left out of the object
+        unused = [n for n in upload.parts if n > fecmeta.parts]
+        if unused:
+            self.delete_parts(upload.bucket, upload.upload_id, unused)
+
+    def handle_abort_multipart_upload(self, uploadId):
+        self.op = 'racs:abort_multipart_upload'
+        self.server.stats.record("racs:abort_multipart_upload")
+
+        upload = self.get_upload(uploadId)
+        if upload is None:
+            return self.typical_failure(status=NoSuchUpload.error_code)
+        del self.server.multipart_uploads[upload.upload_id]
+
+        self.delete_parts(self.bucket, upload.upload_id, upload.parts.keys(),
+                          quorum_handler = lambda query: self.typical_success(query, status=204),
+                          anti_quorum_handler = self.typical_failure,
+                          failure_handler = self.failure_handler())
+
+    def delete_parts(self, bucket, upload_id, part_numbers, **handlers):
+        # Also called once a response has been sent, when self.bucket may
+        # already belong to the connection's next request
+        def delete(r):
+            for n in part_numbers:
+                try:
+                    r.delete_object(bucket, part_key(upload_id, n))
+                except NotFound:
+                    pass
+
+        ParallelQuery(
+            query_func = delete,
+            parameters = self.server.get_repositories(),
+            abort_on_exception = False,
+            exception_handler = self.debugging_exception_handler,
+            **handlers
+        )
 
     def handle_get_object(self, *args, **kw):
         if self.bucket == 'racs':
@@ -240,15 +639,18 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
 
         if if_modified_since or if_unmodified_since or if_match or \
                 if_none_match:
-            return self.handle_not_implemented("Optional arguments")
-        
-        self.range = range
+            return self.check_conditions(lambda: self.get_object(range),
+                                         if_match=if_match, if_none_match=if_none_match,
+                                         if_modified_since=if_modified_since, 
+                                         if_unmodified_since=if_unmodified_since)
+        self.get_object(range)
 
+    def get_object(self, range=None):
         repositories = self.server.choose_repositories(self.bucket, self.key, self.server.get_repositories(), self.server.k)
         n = len(repositories)
         extras = self.server.redundant_repositories(repositories)
         
-        print >> self.server.log, "rq%s Handle get %s/%s.  Request from %s repositories." % (id(self),self.bucket,self.key, n)
+        self.server.log.debug("rq%s Handle get %s/%s.  Request from %s repositories.", id(self),self.bucket,self.key, n)
 
         if self.server.use_zookeeper:
             elapsed = Stopwatch()
@@ -258,111 +660,591 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
             self.release_lock = None
 
         rs = repositories + extras
-        rs = rs[:self.server.k]
+        k = min(self.server.k, len(rs))
+
+        if range:
+            return self.get_object_range(range, rs[:k])
+
+        fecmeta = self.server.racs_metacache.get((str(self.bucket),str(self.key)))
+        if fecmeta is None and self.server.replicates(self.bucket, 0):
+            # Only the FECMeta tells whether the object is one of the 
+            # bucket's replicated ones; read it rather than k replicas
+            return self.read_fecmeta(rs, lambda fecmeta: self.fetch_object(rs, k, fecmeta))
+        self.fetch_object(rs, k, fecmeta)
+
+    def fetch_object(self, rs, k, fecmeta=None):
+        if self.server.streaming_get:
+            kind = 'stream'
+            query_func = self.timed(kind, self.open_share_stream)
+        else:
+            kind = 'get'
+            query_func = self.timed(kind, lambda r: r.get_object(self.bucket, self.key))
+        hedge_delay = lambda r: self.server.hedge_delay(r, kind)
+
+        if fecmeta is not None and fecmeta.replicated():
+            # Any one replica will do; try the repositories in turn
+            return ParallelQuery(
+                query_func = query_func,
+                parameters = rs,
+                n_concurrent = 1,
+                quorum = 1,
+                abort_on_exception = False,
+                hedge_delay = hedge_delay,
+                late_handler = self.close_late_share,
+                cancel_on_finish = True,
+                exception_handler = self.debugging_exception_handler,
+                quorum_handler = lambda query: self.finish_get_object(query, 1),
+                anti_quorum_handler = lambda query: self.finish_get_object(query, 1),
+                failure_handler = self.failure_handler()
+            )
 
+        # Shares are fetched from k repositories.  The rest are held back,
+        # to stand in for any that fail or, once hedge_delay has passed,
+        # that are slow to answer; the first k shares to arrive are used.
         ParallelQuery(
-            query_func = lambda r: r.get_object(self.bucket, self.key),
+            query_func = query_func,
             parameters = rs, 
-            n_concurrent = n,
+            n_concurrent = k,
+            quorum = k,
             abort_on_exception = False,
+            hedge_delay = hedge_delay,
+            late_handler = self.close_late_share,
+            cancel_on_finish = True,
             exception_handler = self.debugging_exception_handler,
             quorum_handler = self.finish_get_object,
             anti_quorum_handler = self.finish_get_object,
+            failure_handler = self.failure_handler()
         )
 
-    def finish_get_object(self, query):
-        if self.release_lock:
+    def timed(self, kind, query_func):
+        # Records how long each repository takes to answer query_func, a
+        # read of the given kind (see RACSHTTPServer.read_kinds)
+        def timed_query(r):
             elapsed = Stopwatch()
-            self.release_lock()
-            record_operation("zk:release_lock",elapsed=elapsed())
+            result = query_func(r)
+            r.latency[kind].add(elapsed())
+            return result
+        return timed_query
+
+    def open_share_stream(self, r):
+        # Opens r's share and waits for its header, so that the read is 
+        # timed (and hedged) until data flows rather than until the 
+        # repository answers
+        stream, content_type, metadata = r.get_object_stream(self.bucket, self.key)
+        try:
+            head = stream.read(ShareMeta.meta_length)
+        except:
+            stream.close()
+            raise
+        return PeekedStream(stream, head), content_type, metadata
+
+    def close_late_share(self, query, r, result):
+        # A share that arrived after the GET had all it needed
+        if self.server.streaming_get:
+            self.close_streams([result])
+
+    def check_conditions(self, proceed, **conditions):
+        # Conditional GETs are settled from the object's metadata without
+        # fetching any shares: from the FECMeta cache when only etags are 
+        # involved, otherwise from the head cache or a single HEAD.  
+        # proceed() carries on with the request if the conditions hold.
+        def settle(fecmeta, last_modified):
+            status = check_preconditions(fecmeta.etag(), last_modified, **conditions)
+            if status is None:
+                return proceed()
+            self.send_precondition_status(status, fecmeta, last_modified)
+
+        fecmeta = self.server.racs_metacache.get((str(self.bucket),str(self.key)))
+        if fecmeta is not None and not needs_last_modified(**conditions):
+            return settle(fecmeta, None)
+
+        def found(query):
+            headers = query.results.values()[0]
+            if headers is None or FECMeta.short_header not in headers:
+                return self.typical_failure(query, status=404)
+            fecmeta = FECMeta.read(headers[FECMeta.short_header])
+            self.cache_fecmeta(fecmeta)
+            settle(fecmeta, headers.get('Last-Modified'))
+
+        ParallelQuery(
+            query_func = self.cached_head_or_none,
+            parameters = self.server.rank_repositories(),
+            n_concurrent = 1,
+            quorum = 1,
+            quorum_handler = found,
+            anti_quorum_handler = lambda q: self.typical_failure(q,status=404),
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
+        )
+
+    def send_precondition_status(self, status, fecmeta, last_modified):
+        self.server.log.debug("%s: conditional request for %s/%s answered %s", self, self.bucket, self.key, status)
+        if status == 304:
+            headers = {
+                'Etag' : fecmeta.etag(),
+                'Content-Length' : str(fecmeta.size),
+                }
+            if last_modified:
+                headers['Last-Modified'] = last_modified
+            self.typical_success(None, headers, status=304)
+        else:
+            self.typical_failure(status=status)
+
+    def cache_fecmeta(self, fecmeta, key=None):
+        if key is None:
+            key = self.key
+        self.server.racs_metacache[(str(self.bucket),str(key))] = fecmeta
+
+    def head_or_none(self, r):
+        try:
+            return r.head(self.bucket,self.key)
+        except NotFound:
+            return None
+
+    def cached_head_or_none(self, r):
+        try:
+            return self.get_head(r,self.bucket,self.key)
+        except NotFound:
+            return None
+
+    def get_object_range(self, range, repositories):
+        # A ranged GET reads only the columns of each share that cover the
+        # range (see fec.plan_range).  Working those out takes the object's
+        # FECMeta.
+        self.read_fecmeta(repositories, lambda fecmeta: self.fetch_range(range, repositories, fecmeta))
+
+    def read_fecmeta(self, repositories, proceed):
+        # Calls proceed(fecmeta) with the object's FECMeta, from the cache
+        # or else from a HEAD of the first of repositories to answer
+        fecmeta = self.server.racs_metacache.get((str(self.bucket),str(self.key)))
+        if fecmeta is not None:
+            return proceed(fecmeta)
+
+        def found(query):
+            headers = query.results.values()[0]
+            if headers is None or FECMeta.short_header not in headers:
+                return self.typical_failure(query, status=404)
+            fecmeta = FECMeta.read(headers[FECMeta.short_header])
+            self.cache_fecmeta(fecmeta)
+            proceed(fecmeta)
 
-        k = self.server.k
+        ParallelQuery(
+            query_func = self.head_or_none,
+            parameters = repositories,
+            n_concurrent = 1,
+            quorum = 1,
+            quorum_handler = found,
+            anti_quorum_handler = lambda q: self.typical_failure(q,status=404),
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
+        )
+
+    def fetch_range(self, range, repositories, fecmeta, retry=True):
+        try:
+            byte_range = parse_byte_range(range, fecmeta.size)
+        except ValueError:
+            self.release_zk_lock()
+            return self.handle_not_implemented("Unknown range format \"%s\""%range)
+        if byte_range is None:
+            return self.typical_failure(headers={'Content-Range':'bytes */%s' % fecmeta.size}, status=416)
+        first, last = byte_range
+
+        if fecmeta.parts:
+            headers = self.head_or_none(repositories[0])
+            if headers is None:
+                return self.typical_failure(status=404)
+            metadata = dict([(k,v) for k,v in headers.items() if k not in ('Content-Type','Last-Modified','Etag','Content-Length')])
+            return self.send_multipart(fecmeta, headers.get('Content-Type'), metadata, first, last)
+
+        needed = fecmeta.needed_shares(self.server.k)
+        offset, length, windows = plan_range(fecmeta, needed, first, last)
+
+        self.server.log.debug("%s range %s-%s: %s bytes at offset %s of %s shares", self, first, last, length, offset, len(repositories))
+
+        if fecmeta.replicated():
+            # The range can be read from any one replica
+            quorum = 1
+        else:
+            quorum = len(repositories)
+        # Other repositories stand in for those that fail or are slow
+        parameters = repositories + self.server.redundant_repositories(repositories)
+
+        def get_share_range(r):
+            data, content_type, metadata = r.get_range(self.bucket, self.key, length, offset)
+            sharenum = (metadata or {}).get(ShareMeta.short_header)
+            if sharenum is None:
+                # Written before shares were labelled in their metadata
+                sharenum = ShareMeta.read(r.get_range(self.bucket, self.key, ShareMeta.meta_length)[0]).sharenum
+            sharenum = int(sharenum)
+            if (metadata or {}).get(FECMeta.short_header) == str(fecmeta) and \
+                    not share_range_intact(data, sharenum, metadata, fecmeta, needed, offset):
+                # Another repository stands in for this one
+                self.server.log.error("%s: share of %s/%s on %s is corrupt", self, self.bucket, self.key, r)
+                raise IOError("Share of %s/%s on %s does not match its checksum" % (self.bucket, self.key, r))
+            return data, content_type, metadata, sharenum
+
+        ParallelQuery(
+            query_func = self.timed('range', get_share_range),
+            parameters = parameters,
+            n_concurrent = quorum,
+            quorum = quorum,
+            abort_on_exception = False,
+            hedge_delay = lambda r: self.server.hedge_delay(r, 'range'),
+            late_handler = lambda query, r, result: None,
+            cancel_on_finish = True,
+            exception_handler = self.debugging_exception_handler,
+            quorum_handler = lambda query: self.finish_get_range(query, range, repositories, fecmeta, first, last, retry),
+            anti_quorum_handler = self.typical_failure,
+            failure_handler = self.failure_handler()
+        )
+
+    def finish_get_range(self, query, range, repositories, fecmeta, first, last, retry):
+        results = query.results.values()[:query.quorum]
+        for data, mime_type, metadata, sharenum in results:
+            current = (metadata or {}).get(FECMeta.short_header)
+            if current != str(fecmeta):
+                # Our FECMeta is stale; the object has been rewritten
+                if current is None or not retry:
+                    return self.typical_failure(status=503)
+                fecmeta = FECMeta.read(current)
+                self.cache_fecmeta(fecmeta)
+                return self.fetch_range(range, repositories, fecmeta, retry=False)
+
+        try:
+            data = self.server.decoder().decode_range([r[0] for r in results], [r[3] for r in results], 
+                                                    fecmeta, first, last)
+        except Exception:
+            import traceback
+            self.server.log.error("%s: error decoding range", self)
+            traceback.print_exc()
+            return self.typical_failure()
+        self.release_zk_lock()
+
+        data0, mime_type, metadata, sharenum = results[0]
+        self.server.log.debug("%s: responding %s bytes of range", self,len(data))
+        self.send_object_headers(fecmeta.etag(), mime_type, metadata, len(data),
+                                 content_range = 'bytes %d-%d/%d' % (first, last, fecmeta.size))
+        self.wfile.write(data)
+        record_operation(self.op,elapsed=self.elapsed(),bytes=len(data))
+        self.finish_response()
+
+    def finish_get_object(self, query, needed=None):
+        if not self.server.streaming_get:
+            # Shares are all in memory already
+            self.release_zk_lock()
+
+        k = needed or self.server.k
         if len(query.results) >= k:
             # success!
             try:
                 self.decode_object(query)
             except Exception, e:
                 import traceback
-                print >> self.server.log, "%s: error decoding object" % self
+                self.server.log.error("%s: error decoding object", self)
                 traceback.print_exc()
                 self.typical_failure()
         else:
-            print >> self.server.log, "rq%s finish get object.  Results size = %s.  Failure." % (id(self),len(query.results))
+            self.server.log.warning("rq%s finish get object.  Results size = %s.  Failure.", id(self),len(query.results))
+            if self.server.streaming_get:
+                self.close_streams(query.results.values())
             self.typical_failure(query)
 
+    def release_zk_lock(self):
+        if self.release_lock:
+            elapsed = Stopwatch()
+            self.release_lock()
+            self.release_lock = None
+            record_operation("zk:release_lock",elapsed=elapsed())
+
+    def close_streams(self, results):
+        for stream, ctype, meta in results:
+            try:
+                stream.close()
+            except Exception, e:
+                self.server.log.warning("%s: error closing share stream: %s", self, e)
+
     def __str__(self):
         return "rq%s" % id(self)
 
     def decode_object(self, query):
-        shares = [share for share,ctype,meta in query.results.values()[:self.server.k]]
-        share1, mime_type, metadata = query.results.values()[0]
+        repositories = query.results.keys()
+        results = query.results.values()
+        shares = [share for share,ctype,meta in results[:self.server.k]]
+        share1, mime_type, metadata = results[0]
 
-        print >> self.server.log, "%s decode %s shares.  mt=%s md=%s" % (self,len(shares),mime_type,metadata)
+        self.server.log.debug("%s decode %s shares.  mt=%s md=%s", self,len(shares),mime_type,metadata)
 
         if metadata is None:
-            print >> self.server.log, "Cannot decode; no metadata. Fail."
+            self.server.log.error("Cannot decode; no metadata. Fail.")
             raise Exception("Cannot decode: No metadata attached to object %s/%s" % (self.bucket,self.key))
         #if not metadata.contains(FECMeta.short_header
         fm = metadata.get(FECMeta.short_header,None)
         if fm is None:
-            print >> self.server.log, "%s decode: No FECMeta header in metadata!" % self
+            self.server.log.error("%s decode: No FECMeta header in metadata!", self)
             raise Exception()
         
         fecmeta = FECMeta.read(fm)
 
-        cachekey = (str(self.bucket),str(self.key))
-        self.server.racs_metacache[cachekey] = ('"%s"'%fecmeta.md5,fecmeta.size)
+        self.cache_fecmeta(fecmeta)
+
+        if fecmeta.parts:
+            # A multipart manifest; its own shares hold no data
+            if self.server.streaming_get:
+                self.close_streams(results)
+            return self.send_multipart(fecmeta, mime_type, metadata)
+
+        needed = fecmeta.needed_shares(self.server.k)
+        if self.server.streaming_get:
+            # The shares are open streams
+            self.close_streams(results[needed:])
+            if fecmeta.spans_stripes():
+                metas = [meta for share,ctype,meta in results[:needed]]
+                return self.send_decoded_stream(shares, fecmeta, mime_type, metadata, metas)
+            streams = shares[:needed]
+            try:
+                shares = [stream.read() for stream in streams]
+            finally:
+                self.close_streams(results[:needed])
+            self.release_zk_lock()
 
+        metas = [meta for share,ctype,meta in results[:needed]]
+        shares = self.intact_shares(self.key, repositories, zip(shares, metas), needed)
         data = self.server.decode(shares, fecmeta)
-        etag = '"%s"'% fecmeta.md5
+        etag = fecmeta.etag()
         
         # Verify
         actual_etag = compute_etag(data)
         if actual_etag != etag:
-            print >>self.server.log, "%s ERROR Computed etag %s does not match recorded etag %s" % (self,actual_etag, etag)
+            self.server.log.error("%s Computed etag %s does not match recorded etag %s", self,actual_etag, etag)
         else:
-            print >> self.server.log, "%s OK etag %s verified" % (self,etag)
+            self.server.log.debug("%s OK etag %s verified", self,etag)
             
         if fecmeta.size != len(data):
-            print >> self.server.log, "%s ERROR actual size %d does not match recorded size %d" % (self, len(data), fecmeta.size)
-
-        if self.range:
-            m = re.compile('bytes:\s*(\d+)\s*-\s*(\d+)').match(self.range.strip())
-            if not m:
-                return self.handle_not_implemented("Unknown range format \"%s\""%self.range)
-            a = int(m.group(1))
-            b = int(m.group(2))
-            data = data[a:b+1]
-            self.warn('GET range queries are not efficiently implemented!!!')
-
-        print >> self.server.log, "%s: responding %s bytes" % (self,len(data))
-        self.send_response(200)
+            self.server.log.error("%s actual size %d does not match recorded size %d", self, len(data), fecmeta.size)
+
+        self.server.log.debug("%s: responding %s bytes", self,len(data))
+        self.send_object_headers(etag, mime_type, metadata, len(data))
+        self.wfile.write(data)
+        record_operation(self.op,elapsed=self.elapsed(),bytes=len(data))        
+        self.server.log.debug("%s: responded %s bytes", self,len(data))
+        self.finish_response()
+
+    def send_object_headers(self, etag, mime_type, metadata, length, content_range=None):
+        if content_range:
+            self.send_response(206)
+        else:
+            self.send_response(200)
         self.send_id_headers()
         self.send_header('ETag',etag) 
         self.send_header('Content-Type',mime_type)  # FIXME
         for key, value in metadata.items():
-            if key != FECMeta.short_header:
+            if key not in racs_headers:
                 self.send_header('x-amz-meta-'+key,value)
-        if self.range:
-            self.send_header('Content-Range',self.range)
-        self.send_header('Content-Length',str(len(data)))
-        self.send_header('Connection','close')
+        if content_range:
+            self.send_header('Content-Range',content_range)
+        self.send_header('Content-Length',str(length))
         self.end_headers()
-        self.wfile.write(data)
-        self.wfile.close()
-        record_operation(self.op,elapsed=self.elapsed(),bytes=len(data))        
-        print >> self.server.log, "%s: responded %s bytes" % (self,len(data))   
+
+    def send_decoded_stream(self, streams, fecmeta, mime_type, metadata, metas):
+        # Decodes and sends a striped object one stripe at a time, as the
+        # share streams deliver it.  The headers go out before any share
+        # data has been checked, so a failure part way through (including
+        # a share found corrupt once it has all been read) can only be
+        # reported by dropping the connection short of Content-Length.
+        etag = fecmeta.etag()
+        self.server.log.debug("%s: streaming %s bytes", self,fecmeta.size)
+        self.send_object_headers(etag, mime_type, metadata, fecmeta.size)
+
+        md5 = hashlib.md5()
+        nbytes = 0
+        failed = False
+        readers = self.read_ahead(streams, fecmeta)
+        try:
+            checksums = map(expected_checksum, metas)
+            for data in self.server.decoder().decode_stream(readers, fecmeta, checksums):
+                self.wfile.write(data)
+                md5.update(data)
+                nbytes += len(data)
+        except Exception, e:
+            import traceback
+            self.server.log.warning("%s: streaming decode failed after %s bytes: %s", self, nbytes, e)
+            traceback.print_exc()
+            failed = True
+
+        for reader in readers:
+            reader.abort()
+        self.close_streams([(stream, None, None) for stream in streams])
+        self.release_zk_lock()
+
+        if failed:
+            self.close_connection = 1
+            record_operation(self.op+"_fail",elapsed=self.elapsed(),bytes=nbytes)
+            self.finish_response()
+            return
+
+        actual_etag = '"%s"' % md5.hexdigest()
+        if actual_etag != etag:
+            self.server.log.error("%s Computed etag %s does not match recorded etag %s", self,actual_etag, etag)
+        else:
+            self.server.log.debug("%s OK etag %s verified", self,etag)
+
+        record_operation(self.op,elapsed=self.elapsed(),bytes=nbytes)
+        self.server.log.debug("%s: responded %s bytes", self,nbytes)
+        self.finish_response()
+
+    def intact_shares(self, key, repositories, shares, needed=None):
+        # Checks each (share, metadata) read from repositories against the
+        # checksum in its metadata.  A corrupt share is replaced with one 
+        # read from a repository not used yet, so that the object decodes
+        # from k (or needed) good shares rather than failing its ETag check.
+        if needed is None:
+            needed = self.server.k
+        good = []
+        for r, (share, metadata) in zip(repositories, shares):
+            if share_intact(share, metadata):
+                good.append(share)
+            else:
+                self.server.log.error("%s: share of %s/%s on %s is corrupt", self, self.bucket, key, r)
+        if len(good) == len(shares):
+            return good
+        for r in self.server.redundant_repositories(repositories):
+            if len(good) == needed:
+                break
+            try:
+                share, ctype, metadata = r.get_object(self.bucket, key)
+            except Exception, e:
+                self.server.log.warning("%s: could not read a replacement share of %s/%s on %s: %s", self, self.bucket, key, r, e)
+                continue
+            if share_intact(share, metadata):
+                self.server.log.info("%s: replaced corrupt share of %s/%s with the one on %s", self, self.bucket, key, r)
+                good.append(share)
+            else:
+                self.server.log.error("%s: share of %s/%s on %s is corrupt", self, self.bucket, key, r)
+        if len(good) < needed:
+            raise Exception("Only %s intact shares of %s/%s" % (len(good), self.bucket, key))
+        return good
+
+    def read_ahead(self, streams, fecmeta):
+        # Fetches the next stripes of every share in parallel while the
+        # current one is decoded and sent
+        sizes = share_block_sizes(fecmeta, self.server.k)
+        return [ReadAhead(stream, sizes, self.stream_buffer_stripes) for stream in streams]
+
+    def open_shares(self, key):
+        # Opens share streams of key on k repositories, moving on to the
+        # redundant ones as others fail.  Returns the repositories used and
+        # their results.
+        repositories = self.server.choose_repositories(self.bucket, key, self.server.get_repositories(), self.server.k)
+        repositories = repositories + self.server.redundant_repositories(repositories)
+        used = []
+        results = []
+        for r in repositories:
+            if len(results) == self.server.k:
+                break
+            try:
+                results.append(r.get_object_stream(self.bucket, key))
+                used.append(r)
+            except Exception, e:
+                self.server.log.warning("%s: could not open %s/%s on %s: %s", self, self.bucket, key, r, e)
+        if len(results) < self.server.k:
+            self.close_streams(results)
+            raise Exception("Only %s shares of %s/%s available" % (len(results), self.bucket, key))
+        return used, results
+
+    def decode_part(self, key):
+        # Yields the data of one part of a multipart object, stripe by 
+        # stripe if the part is striped
+        used, results = self.open_shares(key)
+        readers = []
+        try:
+            streams = [stream for stream, ctype, meta in results]
+            fecmeta = FECMeta.read(results[0][2][FECMeta.short_header])
+            if fecmeta.spans_stripes():
+                readers = self.read_ahead(streams, fecmeta)
+                checksums = [expected_checksum(meta) for stream, ctype, meta in results]
+                chunks = self.server.decoder().decode_stream(readers, fecmeta, checksums)
+            else:
+                needed = fecmeta.needed_shares(self.server.k)
+                shares = [(stream.read(), meta) for stream, ctype, meta in results[:needed]]
+                chunks = [self.server.decode(self.intact_shares(key, used, shares, needed), fecmeta)]
+            md5 = hashlib.md5()
+            for data in chunks:
+                md5.update(data)
+                yield data
+            if md5.hexdigest() != fecmeta.md5:
+                self.server.log.error("%s Computed md5 %s of part %s does not match recorded %s", self, md5.hexdigest(), key, fecmeta.md5)
+        finally:
+            for reader in readers:
+                reader.abort()
+            self.close_streams(results)
+
+    def send_multipart(self, fecmeta, mime_type, metadata, first=0, last=None):
+        # Sends bytes first..last of a multipart object, decoding only the
+        # parts they fall in
+        content_range = None
+        if last is None:
+            last = fecmeta.size - 1
+        else:
+            content_range = 'bytes %d-%d/%d' % (first, last, fecmeta.size)
+        self.server.log.debug("%s: streaming bytes %s-%s of %s parts", self, first, last, fecmeta.parts)
+        self.send_object_headers(fecmeta.etag(), mime_type, metadata, last - first + 1, content_range)
+
+        nbytes = 0
+        failed = False
+        try:
+            for n, offset, size in fecmeta.part_layout():
+                if offset + size <= first or offset > last:
+                    continue
+                pos = offset
+                for data in self.decode_part(part_key(fecmeta.upload_id, n)):
+                    a = max(first - pos, 0)
+                    z = min(last + 1 - pos, len(data))
+                    pos += len(data)
+                    if a < z:
+                        self.wfile.write(data[a:z])
+                        nbytes += z - a
+        except Exception, e:
+            import traceback
+            self.server.log.warning("%s: multipart decode failed after %s bytes: %s", self, nbytes, e)
+            traceback.print_exc()
+            failed = True
+
+        self.release_zk_lock()
+
+        if failed:
+            self.close_connection = 1
+            record_operation(self.op+"_fail",elapsed=self.elapsed(),bytes=nbytes)
+        else:
+            record_operation(self.op,elapsed=self.elapsed(),bytes=nbytes)
+        self.finish_response()
 
     def handle_delete_object(self):
         # Can't roll back
         self.server.stats.record("racs:delete_object")
+        self.read_previous_fecmeta(self.server.rank_repositories(), self.delete_object, self.failure_handler())
+
+    def delete_object(self, fecmeta):
+        self.server.racs_metacache.pop((str(self.bucket),str(self.key)), None)
+        self.forget_head()
+
+        def delete(r):
+            # Multipart objects take their parts with them
+            if fecmeta is not None and fecmeta.parts:
+                for n in xrange(1, fecmeta.parts+1):
+                    try:
+                        r.delete_object(self.bucket, part_key(fecmeta.upload_id, n))
+                    except NotFound:
+                        pass
+            return r.delete_object(self.bucket,self.key)
+
         ParallelQuery(
-            query_func = lambda r: r.delete_object(self.bucket,self.key),
+            query_func = delete,
             parameters = self.server.get_repositories(),
             abort_on_exception=False,
             quorum_handler = self.typical_success,
             anti_quorum_handler = self.typical_failure,
-            exception_handler = self.debugging_exception_handler
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
         )
         
     def handle_get_buckets(self):
@@ -381,18 +1263,18 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
                 exception_handler = self.debugging_exception_handler,
                 quorum_handler = self.finish_get_buckets,
                 anti_quorum_handler = self.typical_failure,
+                failure_handler = self.failure_handler()
             )
         
         
     def finish_get_buckets(self, query):
         self.send_response(200)
         self.send_id_headers()
-        self.send_header('Connection','close')
         result = map(str,query.results.values()[0])
         buckets = [Bucket(bname) for bname in result]
         x = ListAllMyBucketsResult(self.get_owner(), buckets)
-        self.send_xml_response(x)
         record_operation(self.op,elapsed=self.elapsed(),n_buckets=len(buckets))        
+        self.send_xml_response(x)
 
     def get_owner(self):
         #self.warn("Not implemented: get_owner")
@@ -420,6 +1302,7 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
                 exception_handler = self.debugging_exception_handler,
                 quorum_handler = self.finish_get_bucket,
                 anti_quorum_handler = self.typical_failure,
+                failure_handler = self.failure_handler()
             )
         
     def finish_get_bucket(self, query):
@@ -436,28 +1319,33 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
             if omd.metadata and FECMeta.short_header in omd.metadata:#is None or FECMeta.short_header not in omd.metadata:
                 fecmeta_raw = omd.metadata[FECMeta.short_header]
                 fecmeta = FECMeta.read(fecmeta_raw)
-                omd.etag = '"%s"' % fecmeta.md5
+                omd.etag = fecmeta.etag()
                 omd.size = fecmeta.size
             else:
                 cachekey = (str(self.bucket),str(omd.key))
                 try:
                     raise KeyError()
-                    omd.etag, omd.size = self.server.racs_metacache[cachekey]
+                    fecmeta = self.server.racs_metacache[cachekey]
+                    omd.etag, omd.size = fecmeta.etag(), fecmeta.size
                 except KeyError:
                     r = self.server.get_repositories()[0]
                     # OUCH -- huge performance hit, needs to be parallelized
                     headers = self.get_head(r,self.bucket,omd.key)
                     fecmeta_raw = headers[FECMeta.short_header]
                     fecmeta = FECMeta.read(fecmeta_raw)
-                    omd.etag = '"%s"' % fecmeta.md5
+                    omd.etag = fecmeta.etag()
                     omd.size = fecmeta.size
-                    self.server.racs_metacache[cachekey] = (omd.etag,omd.size)
+                    self.cache_fecmeta(fecmeta, omd.key)
     
         for x in query.results.values()[0]: 
             if isinstance(x, ObjectMetaData):
+                if x.key.startswith(multipart_prefix):
+                    continue
                 racsify(x)
                 contents.append(x)
             elif isinstance(x, Prefix):
+                if x.name.startswith(multipart_prefix):
+                    continue
                 common_prefixes.append(x)
             else:
                 raise Exception
@@ -465,7 +1353,6 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
         self.send_response(200)    
         self.send_id_headers()
         self.send_header('Transfer-Encoding','identity')
-        self.send_header('Connection','close')
         record_operation(self.op,elapsed=self.elapsed(),n_objects=len(contents))        
         
         kw = {}
@@ -485,26 +1372,30 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
     def version_string(self):
         return "RACS"
 
-    def handle_head_object(self):
+    def handle_head_object(self, if_modified_since=None, if_unmodified_since=None, 
+                           if_match=None, if_none_match=None):
         self.op = "racs:head"
-        print "DEBUG: handle_head_object"
-        def run_head(r):
-            try:
-                return r.head(self.bucket,self.key)
-            except NotFound:
-                return None
+
+        conditions = dict(if_match=if_match, if_none_match=if_none_match,
+                          if_modified_since=if_modified_since, if_unmodified_since=if_unmodified_since)
+        fecmeta = self.server.racs_metacache.get((str(self.bucket),str(self.key)))
+        if fecmeta is not None and not needs_last_modified(**conditions):
+            status = check_preconditions(fecmeta.etag(), None, **conditions)
+            if status is not None:
+                return self.send_precondition_status(status, fecmeta, None)
 
         ParallelQuery(
-            query_func = run_head, # lambda r: r.head(self.bucket,self.key),
-            parameters = self.server.get_repositories(),
+            query_func = self.head_or_none,
+            parameters = self.server.rank_repositories(),
             n_concurrent = 1,
             quorum = 1,
-            quorum_handler = self.complete_head,
+            quorum_handler = lambda query: self.complete_head(query, conditions),
             anti_quorum_handler = lambda q: self.typical_failure(q,status=404),
-            exception_handler = self.debugging_exception_handler
+            exception_handler = self.debugging_exception_handler,
+            failure_handler = self.failure_handler()
         )
 
-    def complete_head(self, query):
+    def complete_head(self, query, conditions={}):
         self.server.stats.record("racs:head")
         
         headers = query.results.values()[0]
@@ -520,22 +1411,29 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
                 continue
             elif k == FECMeta.short_header:
                 fecmeta = FECMeta.read(v)
-                h2['Etag'] = '"%s"' % fecmeta.md5
+                h2['Etag'] = fecmeta.etag()
                 h2['Content-Length'] = str(fecmeta.size)
                 found_meta = True
+            elif k in racs_headers:
+                continue
             else:
                 # custom meta data
                 h2['x-amz-meta-'+k] = v
 
         if not found_meta:
             return self.typical_failure(query, status=500)
+
+        status = check_preconditions(fecmeta.etag(), headers.get('Last-Modified'), **conditions)
+        if status == 304:
+            self.typical_success(query, h2, status=304)
+        elif status is not None:
+            self.typical_failure(query, status=status)
         else:
             self.typical_success(query, h2)
         
     def handle_get_object_acl(self):
         self.send_response(200)
         self.send_id_headers()
-        self.send_header('Connection','close')
         x = AccessControlPolicy() # FIXME: placeholder, doesn't return real values
         self.send_xml_response(x)
         
@@ -559,17 +1457,27 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
                 return "%s <small><a href=\"%s\">toggle</a></small>" % (r.active,toggle_cmd)
 
 
-            repo_info_rows = ["<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>" % (r.name,r.__class__.__name__,disp_priority(r), disp_active(r)) for r in self.server.get_repositories(False)]
+            repo_info_rows = ["<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>" % (r.name,r.__class__.__name__,disp_priority(r), disp_active(r), r.health) for r in self.server.get_repositories(False)]
             repo_table = """
 <h3>Repositories</h3>
 <table border=1>
- <tr><td>Name</td><td>Class</td><td>Fetch Priority</td><td>Active</td></tr>
+ <tr><td>Name</td><td>Class</td><td>Fetch Priority</td><td>Active</td><td>Recent latency, throughput, failures</td></tr>
  %s
 </table>""" % "\n".join(repo_info_rows)
 
+            bulkhead_keys = ['max_concurrent','max_queued','running','waiting','admitted','delayed','rejected','max_running','max_waiting']
+            bulkhead_rows = ["<tr><td>%s</td>%s</tr>" % (r.name, "".join(["<td>%s</td>" % r.bulkhead.stats()[key] for key in bulkhead_keys])) for r in self.server.get_repositories(False)]
+            bulkhead_table = """
+<h3>Repository calls</h3>
+<table border=1>
+ <tr><td>Name</td>%s</tr>
+ %s
+</table>""" % ("".join(["<td>%s</td>" % key for key in bulkhead_keys]), "\n".join(bulkhead_rows))
+
             k = self.server.k
             m = self.server.m
             stats = self.server.stats.dump()
+            task_stats = thread_manager.dump()
             self.send_html_response("""
 <html>
 <head>
@@ -580,10 +1488,14 @@ class RACSHTTPRequestHandler(S3HTTPRequestHandler):
 <b>k = %(k)s<br>
 m = %(m)s</b><br>
 %(repo_table)s
+%(bulkhead_table)s
 <h2>Stats</h2>
 <pre>%(stats)s</pre>
+<h2>Task threads</h2>
+<pre>%(task_stats)s</pre>
 <br><br>
 <small><a href='?cmd=self.server.stats.reset()'>Reset stats</a></small>
+<small><a href='?cmd=thread_manager.reset_stats()'>Reset task thread stats</a></small>
 </body>
 </html>
 """ % locals())
@@ -40,6 +40,7 @@
 
 from xmlutil import *
 from util import *
+from racs.exceptions import *
 from lxml import objectify
 import time
 
@@ -208,3 +209,60 @@ class ListBucketResult(XMLEntity):
                        xmlns = S3XMLNS,
                        children = children)
 
+
+class InitiateMultipartUploadResult(XMLEntity):
+    def __init__(self, bucket, key, upload_id):
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = upload_id
+
+    def xml(self):
+        return Element('InitiateMultipartUploadResult',
+                       xmlns = S3XMLNS,
+                       children = [
+                Element('Bucket',self.bucket),
+                Element('Key',self.key),
+                Element('UploadId',self.upload_id),
+                ])
+
+class CompleteMultipartUploadResult(XMLEntity):
+    def __init__(self, location, bucket, key, etag):
+        self.location = location
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+
+    def xml(self):
+        return Element('CompleteMultipartUploadResult',
+                       xmlns = S3XMLNS,
+                       children = [
+                Element('Location',self.location),
+                Element('Bucket',self.bucket),
+                Element('Key',self.key),
+                Element('ETag',self.etag),
+                ])
+
+def parse_complete_multipart_upload(body):
+    """
+    Reads the part list out of a CompleteMultipartUpload request body.
+
+    @return: a list of (part number, etag)
+    """
+    def local_name(element):
+        # Clients may or may not put the S3 namespace on the elements
+        return element.tag.split('}')[-1]
+
+    try:
+        root = etree.fromstring(body)
+    except etree.XMLSyntaxError:
+        raise MalformedXML()
+    parts = []
+    for part in root:
+        if not isinstance(part.tag, basestring) or local_name(part) != 'Part':
+            continue
+        fields = dict([(local_name(e), (e.text or '').strip()) for e in part if isinstance(e.tag, basestring)])
+        try:
+            parts.append((int(fields['PartNumber']), fields['ETag']))
+        except (KeyError, ValueError):
+            raise MalformedXML()
+    return parts
@@ -35,8 +35,8 @@
 # 
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-import re, sys
-from urlparse import urlparse
+import re, sys, socket, select, time
+from threading import Event
 
 from racs.util import *
 from racs.util.stats import *
@@ -48,59 +48,185 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
     verbose = True
     protocol_version = 'HTTP/1.1'
 
+    # Idle keep-alive connections are closed after this many seconds, or
+    # as soon as another connection is waiting for a worker; idle 
+    # connections check for that this often
+    keepalive_timeout = 15
+    idle_poll = 0.1
+    # Longest we wait for an asynchronous handler to finish its response
+    # before giving up on the connection
+    response_timeout = 600
+
     def __init__(self, *args, **keywords):
         BaseHTTPRequestHandler.__init__(self, *args, **keywords)
-        
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.response_complete = Event()
+        self.n_requests = 0
+        self.response_started = False
+
+    # ------ Persistent connections -----------------------------------
+    #
+    # Most handlers answer asynchronously, from a ParallelQuery callback
+    # running on another thread.  Before reading the next (possibly
+    # pipelined) request off the connection, we wait for the current
+    # response to be completed with finish_response().
+    #
+    # Each connection holds a front-end worker for as long as it is open,
+    # idle or not, so keep-alive gives way when the workers run out: 
+    # responses then close the connection, and connections idle between
+    # requests are closed.
+
+    def handle_one_request(self):
+        if not self.wait_for_request():
+            self.close_connection = 1
+            return
+        # Idle reaper: give up on a connection that sends nothing new
+        # within keepalive_timeout seconds
+        self.connection.settimeout(self.keepalive_timeout)
+        try:
+            self.raw_requestline = self.rfile.readline()
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        self.connection.settimeout(None)
+
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+
+        self.reset_request()
+        if not self.parse_request():
+            return
+        mname = 'do_' + self.command
+        if not hasattr(self, mname):
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+            return
+        getattr(self, mname)()
+        self.wait_for_response()
+
+    def wait_for_request(self):
+        # Whether the next request on a persistent connection has begun to
+        # arrive: False if keepalive_timeout passes first, or if the worker
+        # is wanted for another connection before then
+        if self.n_requests == 0 or self.buffered_request():
+            return True
+        deadline = time.time() + self.keepalive_timeout
+        while not self.workers_saturated():
+            timeout = min(self.idle_poll, deadline - time.time())
+            if timeout <= 0:
+                return False
+            if select.select([self.connection], [], [], timeout)[0]:
+                return True
+        return False
+
+    def buffered_request(self):
+        # Whether a pipelined request has already been read into rfile's
+        # buffer, where select can't see it
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def workers_saturated(self):
+        # Whether other connections are waiting for a worker to serve them
+        return False
+
+    def reset_request(self):
+        # Clear per-request state left over from the previous request
+        # on this connection
+        self._prepped = False
+        self._body_read = False
+        self.response_complete.clear()
+        self.response_started = False
+        self.n_requests += 1
+
+    def wait_for_response(self):
+        self.response_complete.wait(self.response_timeout)
+        if not self.response_complete.isSet():
+            print >> sys.stderr, "Warning: no response to %s %s after %ss; closing connection" % (self.command, self.path, self.response_timeout)
+            self.close_connection = 1
+        if self.has_body() and not self._body_read:
+            # The request body is still sitting on the connection, so the
+            # next request can't be framed
+            self.close_connection = 1
+
+    def finish_response(self):
+        # Must be the last thing a handler does with the request: once this
+        # is called the connection moves on to the next request.
+        self.wfile.flush()
+        self.response_complete.set()
+
+    def failure_handler(self):
+        # A ParallelQuery failure_handler for the current request
+        request = self.n_requests
+        return lambda query, exception: self.abandon_response(request, exception)
+
+    def abandon_response(self, request, exception):
+        # An asynchronous handler of request raised instead of finishing its
+        # response.  Answers 500 if nothing was sent yet, and closes the 
+        # connection, as what was sent may be cut short.  Returns False if
+        # the response had been finished after all.
+        if request != self.n_requests or self.response_complete.isSet():
+            return False
+        print >> sys.stderr, "Warning: handler for %s %s failed: %s" % (self.command, self.path, exception)
+        self.close_connection = 1
+        try:
+            if not self.response_started:
+                self.send_response(500)
+                self.send_header('Content-Length','0')
+                self.end_headers()
+            self.wfile.flush()
+        except Exception:
+            pass
+        self.response_complete.set()
+        return True
+
+    def send_response(self, code, message=None):
+        self.response_started = True
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def end_headers(self):
+        if not self.close_connection and self.workers_saturated():
+            self.close_connection = 1
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'keep-alive')
+        BaseHTTPRequestHandler.end_headers(self)
+
     _prepped = False
     _bucket_re = re.compile('^(.*)\.%s$' % S3_FQDN.replace('.','\.'))
+    # One pass over the request target: an optional http://netloc, the
+    # path, and the query string.  A bare path is a request to the racs
+    # bucket.
+    _url_re = re.compile('^(?:http://([^/?]*))?(/[^?]*)?(?:\?(.*))?$')
     def prep(self):
         if self._prepped:
-            return
+            return True
         self._prepped = True
 
-        if self.path.startswith('/'):
-            self.path = 'http://racs.%s%s' % (S3_FQDN,self.path)
-
-        parsed = urlparse(url_unquote(self.path))
-
-        if parsed.scheme != 'http':
+        m = self._url_re.match(self.path)
+        if not m:
             self.handle_not_implemented('Expected http schemed URL, got: %s' % self.path)
-            return
+            return False
+        netloc, path, query = m.groups()
+        if netloc is None:
+            netloc = 'racs.' + S3_FQDN
 
         # was this sent to a bucket subdomain?
-        bucket_match = self._bucket_re.match(parsed.netloc)
+        bucket_match = self._bucket_re.match(netloc)
         if bucket_match:
             # ... yes
             self.bucket = bucket_match.group(1)
-            if parsed.path == "/":
+            self.key = url_unquote(path[1:]) if path else None
+            if not self.key:
                 self.key = None
-            else:
-                self.key = parsed.path[1:]
         else:
             # ... no
             self.bucket = None
             self.key = None
-        self.parameters = {}
-
-        spl = parsed.query.split(';')
-        spl2 = parsed.query.split('&')
-        if len(spl) < len(spl2):
-            spl = spl2
-        for temp in spl:
-            if len(temp) == 0:
-                continue
-            try:
-                key, value = temp.split('=')
-            except:
-                self.parameters[temp] = True
-                continue
-                #print "key/value can't split param?", temp
-                #return self.handle_not_implemented()
-            try:
-                value = int(value)
-            except:
-                pass
-            self.parameters[key] = value
+        self.parameters = parse_query(query)
+        return True
         
     # HACK assumes host is always Amazon
     # not necessary, when run as proxy we can get it from the url
@@ -110,85 +236,144 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
 #            return None
 #        return m.group(1)
 
-    @record_event('proxy-in:GET')
-    def do_GET(self):
+    # ------ Request routing ------------------------------------------
+    #
+    # (method, target) -> [(condition, handler, headers), ...]
+    #
+    # target is 'service' (no bucket), 'bucket' (no key) or 'object'.
+    # The first entry whose condition is present wins: None always
+    # matches, an x-amz-* condition is a request header and anything else
+    # a query parameter.  A flag condition without a value (?acl) is
+    # consumed; one with a value (uploadId=ID) is passed on.  headers is
+    # None for handlers that take no arguments, otherwise the request
+    # headers handed to the handler along with the query parameters.
+
+    _get_conditions = ('If-Modified-Since','If-Unmodified-Since','If-Match','If-None-Match')
+
+    routes = {
+        ('GET', 'service'): [
+            (None, 'handle_get_buckets', None),
+            ],
+        ('GET', 'bucket'): [
+            ('location', 'handle_get_bucket_location', None),
+            (None, 'handle_get_bucket', ()),
+            ],
+        ('GET', 'object'): [
+            ('acl', 'handle_get_object_acl', ('Range',) + _get_conditions),
+            (None, 'handle_get_object', ('Range',) + _get_conditions),
+            ],
+        ('PUT', 'service'): [
+            (None, 'handle_create_bucket', None),
+            ],
+        ('PUT', 'bucket'): [
+            (None, 'handle_create_bucket', None),
+            ],
+        ('PUT', 'object'): [
+            ('x-amz-copy-source', 'handle_copy_object', (
+                    'x-amz-copy-source',
+                    'x-amz-metadata-directive',
+                    'x-amz-copy-source-if-match',
+                    'x-amz-copy-source-if-none-match', 
+                    'x-amz-copy-source-if-unmodified-since', 
+                    'x-amz-copy-source-if-modified-since',
+                    )),
+            ('requestPayment', 'handle_request_payment', None),
+            ('uploadId', 'handle_upload_part', (
+                    'Content-Length', 
+                    'Content-MD5', 
+                    'Content-Encoding', 
+                    )),
+            (None, 'handle_put_object', (
+                    'Cache-Control', 
+                    'Content-Type', 
+                    'Content-Length', 
+                    'Content-MD5', 
+                    'Content-Disposition', 
+                    'Content-Encoding', 
+                    'expires', 
+                    'x-amz-acl', 
+                    )),
+            ],
+        # initiate multipart upload:  path = /key?uploads
+        # complete multipart upload:  path = /key?uploadId=ID
+        ('POST', 'object'): [
+            ('uploads', 'handle_initiate_multipart_upload', ('Content-Type',)),
+            ('uploadId', 'handle_complete_multipart_upload', ('Content-Length',)),
+            ],
+        ('DELETE', 'service'): [
+            (None, 'handle_delete_bucket', None),
+            ],
+        ('DELETE', 'bucket'): [
+            (None, 'handle_delete_bucket', None),
+            ],
+        ('DELETE', 'object'): [
+            ('uploadId', 'handle_abort_multipart_upload', ()),
+            (None, 'handle_delete_object', None),
+            ],
+        ('HEAD', 'service'): [
+            (None, 'handle_head_object', _get_conditions),
+            ],
+        ('HEAD', 'bucket'): [
+            (None, 'handle_head_object', _get_conditions),
+            ],
+        ('HEAD', 'object'): [
+            (None, 'handle_head_object', _get_conditions),
+            ],
+        }
+
+    def route(self):
+        # Returns (handler name, header names) for the current request,
+        # or None if nothing matches
+        if self.key:
+            target = 'object'
+        elif self.bucket:
+            target = 'bucket'
+        else:
+            target = 'service'
+        for condition, handler, headers in self.routes.get((self.command, target), ()):
+            if condition is None:
+                return handler, headers
+            if condition.startswith('x-amz-'):
+                if condition in self.headers:
+                    return handler, headers
+            elif condition in self.parameters:
+                if self.parameters[condition] is True:
+                    del self.parameters[condition]
+                return handler, headers
+        return None
+
+    def dispatch(self):
         self.elapsed = Stopwatch()
-        self.prep()
-        if not self.key:
-            if self.bucket:
-                if 'location' in self.parameters:
-                    self.handle_get_bucket_location()
-                else:
-                    self.handle_get_bucket(**self.parameters)
-            else:
-                self.handle_get_buckets() # no parameters
+        if not self.prep():
+            return
+        r = self.route()
+        if r is None:
+            return self.handle_not_implemented()
+        handler, headers = r
+        if headers is None:
+            getattr(self, handler)()
         else:
-            self.headers_to_parameters([
-                    'Range','If-Modified-Since','If-Unmodified-Since','If-Match', 'If-None-Match'
-                    ])
-            if 'acl' in self.parameters:
-                del self.parameters['acl']
-                self.handle_get_object_acl(**self.parameters)
-            else:
-                self.handle_get_object(**self.parameters)
+            self.headers_to_parameters(headers)
+            getattr(self, handler)(**self.parameters)
+
+    @record_event('proxy-in:GET')
+    def do_GET(self):
+        self.dispatch()
                     
     @record_event('proxy-in:PUT')        
     def do_PUT(self):
-        self.elapsed = Stopwatch()
-        # make bucket:  bucket != None, path = /
-        # put object:  bucket != None, path = /key
-        self.prep()
-        
-        if not self.key:
-            self.handle_create_bucket()
-        else:
-            if 'x-amz-copy-source' in self.headers:
-                # copy operation
-                self.headers_to_parameters([
-                        'x-amz-copy-source',
-                        'x-amz-metadata-directive',
-                        'x-amz-copy-source-if-match',
-                        'x-amz-copy-source-if-none-match', 
-                        'x-amz-copy-source-if-unmodified-since', 
-                        'x-amz-copy-source-if-modified-since'
-                       ])
-                self.handle_copy_object(**self.parameters)
-            elif 'requestPayment' in self.parameters:
-                self.handle_request_payment()
-            else:
-                self.headers_to_parameters([
-                        'Cache-Control', 
-                        'Content-Type', 
-                        'Content-Length', 
-                        'Content-MD5', 
-                        'Content-Disposition', 
-                        'Content-Encoding', 
-                        'expires', 
-                        'x-amz-acl', 
-                    ])
-                self.handle_put_object(**self.parameters)
+        self.dispatch()
             
     def do_POST(self):
-        self.elapsed = Stopwatch()
-        self.prep()
-        self.handle_not_implemented()
+        self.dispatch()
 
     @record_event('proxy-in:DELETE')
     def do_DELETE(self):
-        self.elapsed = Stopwatch()
-        self.prep()
-        if not self.key:
-            self.handle_delete_bucket()
-        else:
-            self.handle_delete_object()
+        self.dispatch()
 
     @record_event('proxy-in:HEAD')            
     def do_HEAD(self):
-        self.elapsed = Stopwatch()
-        print >> sys.stderr, "DEBUG: do_HEAD"
-        self.prep()
-        print >> sys.stderr, "DEBUG:    do_HEAD prep OK, bucket=%s key=%s" % (self.bucket,self.key)
-        self.handle_head_object()
+        self.dispatch()
 
     def warn(self, msg):
         print >> sys.stderr, 'Warning:',msg
@@ -229,6 +414,7 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         if msg != None:
             print >> sys.stderr, "Not implemented: %s" % msg
+        self.finish_response()
 
     def headers_to_parameters(self, header_names):
         for n in header_names:
@@ -236,10 +422,8 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
                 continue
             m = n.lower().replace('-','_')
             v = self.headers[n]
-            try:
+            if v.isdigit():
                 v = int(v)
-            except:
-                pass
             self.parameters[m] = v 
         meta = {}
         for k,v in self.headers.items():
@@ -259,7 +443,8 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
 
     def send_xml_response(self, x):
         # x is an racs.xmlutil.XMLEntity object
-        # This sends the following headers, calls end_headers, and writes the given object to wfile
+        # This sends the following headers, calls end_headers, writes the given object to wfile
+        # and finishes the response
         #   Content-Length
         #   Content-Type
         #   Transfer-Encoding: identity 
@@ -271,21 +456,42 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
         self.send_header('Content-Length', len(x))
         self.end_headers()
         self.wfile.write(x)
+        self.finish_response()
 
     def send_html_response(self, x):
         self.send_response(200)
         self.send_header('Content-Type', 'text/html')
         self.send_header('Transfer-Encoding','identity')
-        self.send_header('Connection','close')
         self.send_header('Content-Length', len(x))
         self.end_headers()
         self.wfile.write(x)
+        self.finish_response()
+
+    def has_body(self):
+        return self.headers.get('Content-Length','0') != '0' or self.chunked_body()
+
+    def chunked_body(self, content_encoding=None):
+        # Whether the request body comes in chunks of its own, either as
+        # Transfer-Encoding: chunked or with the aws-chunked content encoding
+        return 'chunked' in self.headers.get('Transfer-Encoding','').lower() or \
+            content_encoding == 'aws-chunked'
+
+    def body_reader(self, content_encoding=None):
+        # A file-like reader of the (decoded) request body
+        if self.chunked_body(content_encoding):
+            return ChunkedReader(self.rfile)
+        return self.rfile
 
     def read(self, content_length, content_encoding=None):
+        if self.chunked_body(content_encoding):
+            val = ChunkedReader(self.rfile).read()
+            self._body_read = True
+            return val
         # FIXME
         assert(content_length!=None)
         if content_encoding is None:
             val = self.rfile.read(content_length)
+            self._body_read = True
         else:
             self.handle_not_implemented("content encoding %s" % content_encoding)
             return
@@ -316,7 +522,8 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
                           expires=None, x_amz_acl=None, x_amz_meta=None):
         self.handle_not_implemented()
 
-    def handle_head_object(self):
+    def handle_head_object(self, if_modified_since=None, if_unmodified_since=None, 
+                           if_match=None, if_none_match=None):
         self.handle_not_implemented()
 
     def handle_delete_object(self):
@@ -331,6 +538,19 @@ class S3HTTPRequestHandler(BaseHTTPRequestHandler):
     def handle_get_bucket_location(self):
         self.handle_not_implemented()
 
+    def handle_initiate_multipart_upload(self, content_type=None, x_amz_meta=None):
+        self.handle_not_implemented()
+
+    def handle_upload_part(self, uploadId, partNumber, content_type=None, content_length=None, 
+                           content_md5=None, content_encoding=None, x_amz_meta=None):
+        self.handle_not_implemented()
+
+    def handle_complete_multipart_upload(self, uploadId, content_length=None):
+        self.handle_not_implemented()
+
+    def handle_abort_multipart_upload(self, uploadId):
+        self.handle_not_implemented()
+
     def get_request_id(self):
         # returns a two-element tuple (x-amz-id-2, x-amz-request-id)
         # These are ID numbers specific to the request, created for reference by the server
@@ -41,8 +41,10 @@ from math import sqrt
 
 from BaseHTTPServer import HTTPServer
 from request_handler import RACSHTTPRequestHandler
+from thread_manager import Bulkhead
 import fec
-from threading import Condition
+from threading import Condition, Thread
+from Queue import Queue
 from repositories import *
 from racs.util.stats import *
 from StringIO import StringIO
@@ -61,10 +63,28 @@ class ConfigNotFound(Exception): pass
 class RACSHTTPServer(HTTPServer):
     verbose = True
 
+    # Reading shares other than the primaries means decoding them, so the
+    # primaries are read unless others look this many times, and this many
+    # seconds, faster
+    primary_preference = 1.5
+    primary_margin = 0.01
+
+    # Each step of manual priority (lower reads first) a repository is 
+    # behind the best scales its expected cost by this much
+    priority_bias = 1.5
+
+    # Reads whose latencies are kept apart for hedging: whole shares, 
+    # share streams (until their first bytes arrive) and share ranges
+    read_kinds = ['get', 'stream', 'range']
+
+    # Connections waiting to be accept()ed while every front-end thread is busy
+    request_queue_size = 64
+
     def __init__(self, configfile):
         if not os.path.exists(configfile):
             raise ConfigNotFound(configfile,"Config file \"%s\" not found" % configfile)
         self.racs_metacache = {}
+        self.multipart_uploads = {} # upload id -> fec.MultipartUpload
         self.stats = Stats()
         self.zk_host = 'localhost'
         self.zk_port = 2181
@@ -100,12 +120,13 @@ class RACSHTTPServer(HTTPServer):
 Config file: %s
 Repositories: %s
 Tolerate up to %s failures
-""" % (server_address, configfile, self.m, self.get_max_failures())
+Front-end threads: %s
+""" % (server_address, configfile, self.m, self.get_max_failures(), self.frontend_threads)
 
             if self.verbose:
                 print msg
         
-            print >> self.log, msg
+            self.log.info(msg)
 
 
         if self.unit_test_repositories:
@@ -114,21 +135,86 @@ Tolerate up to %s failures
 
         #self.k = self.m - self.max_failures
  
-        self.encode = fec.Encoder(self.k,self.m).encode
-        self.decode = fec.Decoder(self.k,self.m).decode
+        try:
+            fec.get_codec(self.codec)
+        except Exception, e:
+            print >> sys.stderr, e
+            sys.exit(1)
+
+        # Stripes are split evenly into k segments
+        self.stripe_size = fec.div_ceil(self.stripe_size, self.k) * self.k
+
+        # Worker processes for erasure coding; forked here, before any
+        # request or task threads exist.  They code for as many shares as
+        # there are repositories, however many are active.
+        self.coding_pool = None
+        if self.coding_processes > 0:
+            self.coding_pool = fec.CodingPool(self.k, len(self.repositories), self.stripe_size, self.coding_processes, self.codec)
+
+        self.codecs = fec.CodecCache(self.stripe_size, self.coding_pool, self.codec)
 
         if self.use_zookeeper:
             self.zk = ZK(**self.zk_args)
 
         HTTPServer.__init__(self, server_address, RACSHTTPRequestHandler)
         import thread_manager
+        if self.task_threads > 0:
+            thread_manager.thread_manager.max_threads = self.task_threads
         thread_manager.thread_manager.start()
+        self.start_frontend_pool()
+
+    # Front-end worker pool
+    #
+    # BaseHTTPServer handles one client connection at a time; a slow upload
+    # would stall every other client.  When frontend_threads > 0, accepted
+    # connections are instead handed to a fixed pool of worker threads.  The
+    # hand-off queue is bounded, so once every worker is busy the accept loop
+    # blocks and new clients wait in the listen backlog.  A connection holds
+    # its worker until it closes, so persistent connections close as soon as
+    # others are waiting (see S3HTTPRequestHandler.wait_for_request).
+
+    def start_frontend_pool(self):
+        self.frontend_queue = Queue(max(self.frontend_threads,1))
+        for i in xrange(self.frontend_threads):
+            t = Thread(target=self.frontend_worker, name="racs-frontend-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        if self.frontend_threads <= 0:
+            return HTTPServer.process_request(self, request, client_address)
+        self.frontend_queue.put((request, client_address))
+
+    def frontend_saturated(self):
+        # Whether accepted connections are waiting for a worker
+        return self.frontend_threads > 0 and not self.frontend_queue.empty()
+
+    def frontend_worker(self):
+        while True:
+            request, client_address = self.frontend_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.close_request(request)
 
     def init_log(self):
-        if self.logfile:
-            self.log = LogStreamWrapper(FileAppendOutStream(self.logfile))
-        else:
-            self.log = NullOutStream()
+        self.log = Logger(self.logfile, self.log_level)
+
+    def encoder(self):
+        # Writes one share to each active repository
+        return self.codecs.encoder(self.k, self.m)
+
+    def decoder(self):
+        # Shares may have been written while other repositories were
+        # active, so any share number up to one per repository may turn up
+        return self.codecs.decoder(self.k, len(self.repositories))
+
+    def encode(self, data, md5=None):
+        return self.encoder().encode(data, md5)
+
+    def decode(self, shares, fecmeta):
+        return self.decoder().decode(shares, fecmeta)
 
     def get_max_failures(self):
         return self.m - self.k
@@ -161,6 +247,7 @@ Tolerate up to %s failures
             sys.exit(1)
         
         self.repositories = []
+        self.bucket_policies = {}
         RACS_read = False
         for section in config.sections():
             if section.startswith('Repository'):
@@ -181,6 +268,16 @@ Tolerate up to %s failures
                         pass
                     #setattr(self, key, value)
                     self.zk_args[key] = value
+            elif section.startswith('Bucket'):
+                # Storage policy of one bucket, overriding the RACS section
+                name = ' '.join(section.split()[1:])
+                policy = {}
+                for key, value in config.items(section):
+                    if key not in ('replicate_below',):
+                        print >> sys.stderr, "Unrecognized %s config key: %s" % (section,key)
+                        sys.exit(1)
+                    policy[key] = int(value)
+                self.bucket_policies[name] = policy
             elif section == 'RACS':
                 RACS_read = True
                 params = dict(config.items(section))                
@@ -196,10 +293,20 @@ Tolerate up to %s failures
                     proxy_host = None,
                     proxy_port = None,
                     m = None,
-                    logfile = os.path.abspath,
+                    logfile = None,
+                    log_level = INFO,
                     unit_test_repositories = False,
                     use_zookeeper = False,
                     record_stats = False,
+                    frontend_threads = 16,
+                    task_threads = 0,
+                    keepalive_timeout = 15,
+                    stripe_size = 1024*1024,
+                    streaming_get = True,
+                    coding_processes = 0,
+                    replicate_below = 0,
+                    codec = None,
+                    hedge_percentile = 95,
                 )
 
                 optional_set = set(optional_parameters.keys())
@@ -212,6 +319,16 @@ Tolerate up to %s failures
                     k =  int, 
                     port = int, 
                     verify_listings_consistent = eval,
+                    frontend_threads = int,
+                    task_threads = int,
+                    keepalive_timeout = float,
+                    stripe_size = int,
+                    streaming_get = eval,
+                    coding_processes = int,
+                    replicate_below = int,
+                    hedge_percentile = float,
+                    logfile = os.path.abspath,
+                    log_level = log_level,
                     )
 
                 identity = lambda x: x
@@ -240,7 +357,7 @@ Tolerate up to %s failures
 
 
     def init_repositories(self):
-        self.repositories = [cls(self, name,**params) for cls, name, params in self.repositories]
+        self.repositories = [self.make_repository(cls, name, params) for cls, name, params in self.repositories]
         n = len(self.get_repositories())
 
         if n == 0:
@@ -257,25 +374,80 @@ Tolerate up to %s failures
             sys.exit(1)
 
 
+    def make_repository(self, cls, name, params):
+        # Repositories configured with pack_below are wrapped in a 
+        # PackedRepository, which takes the packing options
+        pack_options = dict([(k, params.pop(k)) for k in PackedRepository.options if k in params])
+        bulkhead_options = dict([(k, params.pop(k)) for k in Bulkhead.options if k in params])
+        r = cls(self, name, **params)
+        r.health = RepositoryHealth()
+        if pack_options:
+            r = PackedRepository(self, r, **pack_options)
+            r.health = r.repository.health
+        r.bulkhead = Bulkhead(name, **bulkhead_options)
+        # Each kind of read is hedged by the latencies of its own kind
+        r.latency = dict([(kind, LatencyWindow()) for kind in self.read_kinds])
+        return r
+
     def choose_repositories(self, bucket, key, available_repositories = None, k=None):
         # return a list of repositories that should be tried to get k shares
         # may return more than k repositories
         if k is None:
             k = self.k
-        if available_repositories is None:
-            available_repositories = self.get_repositories()
 
-        available_repositories = sorted(available_repositories, key = lambda r: r.priority)
+        # The size of the shares, if the object is known
+        size = None
+        fecmeta = self.racs_metacache.get((str(bucket),str(key)))
+        if fecmeta is not None:
+            size = fecmeta.size / fecmeta.needed_shares(self.k)
+
+        available_repositories = self.rank_repositories(available_repositories, size)
         if self.minimize_latency_or_bandwidth == 'latency':
             return available_repositories  # try them all!
         else:
             # FIXME not very sophisticated right now...
             return available_repositories[:k]
         
-    def redundant_repositories(self, spent_repositories, available_repositories=None):
+    def replicates(self, bucket, size):
+        # Storage policy: objects smaller than the bucket's replicate_below
+        # (or else the server's) are stored as whole replicas, saving the
+        # coding and letting reads fetch a single share.  Larger ones are 
+        # erasure coded.
+        policy = self.bucket_policies.get(bucket, {})
+        return size < policy.get('replicate_below', self.replicate_below)
+
+    def hedge_delay(self, r, kind='get'):
+        # Reads from r that take longer than most of the same kind (by 
+        # hedge_percentile) are hedged with a read from another repository
+        if self.hedge_percentile <= 0:
+            return None
+        return r.latency[kind].percentile(self.hedge_percentile)
+
+    def rank_repositories(self, available_repositories=None, size=None):
+        # Orders repositories to read from by the expected cost of reading
+        # size bytes, going by their recent operations (see RepositoryHealth).
+        # Manual priority biases that cost, and decides between equals.
         if available_repositories is None:
             available_repositories = self.get_repositories()
-        return list(set(available_repositories).difference(set(spent_repositories)))
+        if not available_repositories:
+            return []
+        best = min([r.priority for r in available_repositories])
+
+        # Share i of an object goes to active repository i, so while the
+        # active set is unchanged the first k hold the primary shares, which
+        # need no decoding.  Among equals, those come first.
+        primaries = set(self.get_repositories()[:self.k])
+        def key(r):
+            cost = r.health.cost(size)
+            if r not in primaries:
+                cost = cost * self.primary_preference + self.primary_margin
+            cost = cost * self.priority_bias ** (r.priority - best)
+            return (cost, r.priority, r not in primaries)
+        return sorted(available_repositories, key = key)
+
+    def redundant_repositories(self, spent_repositories, available_repositories=None):
+        spent_repositories = set(spent_repositories)
+        return [r for r in self.rank_repositories(available_repositories) if r not in spent_repositories]
 
 
     # FIXME  --- implement
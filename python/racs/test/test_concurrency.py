@@ -0,0 +1,87 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest
+from StringIO import StringIO
+from racs.util.concurrency import *
+from racs.util.streams import read_cancellable
+
+class CancellationTokenTest(unittest.TestCase):
+
+    def test_run_sets_current_token(self):
+        token = CancellationToken()
+        self.assertTrue(token.run(cancellation_token) is token)
+        self.assertTrue(cancellation_token() is None)
+
+    def test_cancelled_before_run(self):
+        token = CancellationToken()
+        token.cancel()
+        self.assertRaises(Cancelled, token.run, lambda: None)
+
+    def test_check_between_steps(self):
+        token = CancellationToken()
+        steps = []
+        def work():
+            for i in range(3):
+                check_cancelled()
+                steps.append(i)
+                if i == 1:
+                    token.cancel()
+        self.assertRaises(Cancelled, token.run, work)
+        self.assertEqual(steps, [0, 1])
+
+    def test_read_cancellable(self):
+        token = CancellationToken()
+        stream = StringIO('x' * 100)
+        self.assertEqual(token.run(read_cancellable, stream, 30, 8), 'x' * 30)
+
+        class CancellingStream(object):
+            # Cancels the token once the first block has been read
+            def __init__(self):
+                self.stream = StringIO('x' * 100)
+            def read(self, n):
+                token.cancel()
+                return self.stream.read(n)
+        stream = CancellingStream()
+        self.assertRaises(Cancelled, token.run, read_cancellable, stream, -1, 8)
+        self.assertEqual(stream.stream.tell(), 8)
+
+    def test_no_token(self):
+        check_cancelled()
+        self.assertEqual(read_cancellable(StringIO('abc')), 'abc')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, os
+from StringIO import StringIO
+from racs.fec import *
+
+def striped_shares(data, stripe_size, k=2, m=3):
+    # The shares of data coded stripe by stripe, their checksums and FECMeta
+    encoder = StripedEncoder(Encoder(k, m), len(data), stripe_size)
+    shares = encoder.headers()
+    for i in xrange(0, len(data), stripe_size):
+        blocks = encoder.encode(data[i:i+stripe_size])
+        shares = [share + block for share, block in zip(shares, blocks)]
+    fecmeta = encoder.finish()
+    return shares, encoder.checksums(), fecmeta
+
+def corrupt(share, pos):
+    return share[:pos] + chr(ord(share[pos]) ^ 0xff) + share[pos+1:]
+
+class ChecksumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(100)
+        self.shares, self.checksums, self.fecmeta = striped_shares(self.data, 16)
+        self.decoder = Decoder(2, 3)
+
+    def decode_stream(self, shares, checksums):
+        chunks = []
+        try:
+            for data in self.decoder.decode_stream(map(StringIO, shares), self.fecmeta, checksums):
+                chunks.append(data)
+        except IOError:
+            return ''.join(chunks), True
+        return ''.join(chunks), False
+
+    def test_streamed_shares_verify(self):
+        data, failed = self.decode_stream(self.shares[1:], self.checksums[1:])
+        self.assertFalse(failed)
+        self.assertEqual(data, self.data)
+
+    def test_corrupt_streamed_share_fails_before_last_stripe(self):
+        shares = [corrupt(self.shares[0], 3), self.shares[1]]
+        data, failed = self.decode_stream(shares, self.checksums[:2])
+        self.assertTrue(failed)
+        self.assertTrue(len(data) < len(self.data))
+
+    def test_unchecked_streams(self):
+        # Shares written before checksums decode as they are
+        data, failed = self.decode_stream(self.shares[:2], [None, None])
+        self.assertFalse(failed)
+        self.assertEqual(data, self.data)
+
+    def test_whole_share_range(self):
+        metadata = {ShareMeta.checksum_header: self.checksums[0]}
+        offset, length, windows = plan_range(self.fecmeta, 2, 0, len(self.data) - 1)
+        body = self.shares[0][offset:offset+length]
+        self.assertTrue(share_range_intact(body, 0, metadata, self.fecmeta, 2, offset))
+        self.assertFalse(share_range_intact(corrupt(body, 7), 0, metadata, self.fecmeta, 2, offset))
+
+    def test_partial_range_unchecked(self):
+        metadata = {ShareMeta.checksum_header: self.checksums[0]}
+        offset, length, windows = plan_range(self.fecmeta, 2, 0, 9)
+        body = corrupt(self.shares[0][offset:offset+length], 0)
+        self.assertTrue(share_range_intact(body, 0, metadata, self.fecmeta, 2, offset))
+
+    def test_share_intact(self):
+        self.assertTrue(share_intact(self.shares[2], {ShareMeta.checksum_header: self.checksums[2]}))
+        self.assertFalse(share_intact(corrupt(self.shares[2], 1), {ShareMeta.checksum_header: self.checksums[2]}))
+        self.assertTrue(share_intact(corrupt(self.shares[2], 1), {}))
+
+class RangeTest(unittest.TestCase):
+
+    def check_ranges(self, data, shares, fecmeta, k=2):
+        decoder = Decoder(2, 3)
+        ranges = [(0, len(data) - 1), (0, 0), (len(data) - 1, len(data) - 1)]
+        ranges += [(first, last) for first in range(0, len(data), 7) for last in range(first, len(data), 11)]
+        for sharenums in ([0, 1], [1, 2], [2, 0]):
+            for first, last in ranges:
+                offset, length, windows = plan_range(fecmeta, k, first, last)
+                blocks = [shares[n][offset:offset+length] for n in sharenums]
+                self.assertEqual(decoder.decode_range(blocks, sharenums, fecmeta, first, last),
+                                 data[first:last+1], (sharenums, first, last))
+
+    def test_striped(self):
+        data = os.urandom(100)
+        shares, checksums, fecmeta = striped_shares(data, 16)
+        self.check_ranges(data, shares, fecmeta)
+
+    def test_unstriped(self):
+        data = os.urandom(37)
+        shares, fecmeta = Encoder(2, 3).encode(data)
+        self.check_ranges(data, map(str, shares), fecmeta)
+
+    def test_replicated(self):
+        data = os.urandom(20)
+        shares, fecmeta = Encoder(2, 3).replicate(data)
+        decoder = Decoder(2, 3)
+        offset, length, windows = plan_range(fecmeta, 1, 3, 9)
+        self.assertEqual((offset, length), (ShareMeta.meta_length + 3, 7))
+        block = str(shares[2])[offset:offset+length]
+        self.assertEqual(decoder.decode_range([block], [2], fecmeta, 3, 9), data[3:10])
+
+    def test_plan_reads_only_columns_needed(self):
+        # Within one segment of one stripe, only those bytes of one share
+        fecmeta = FECMeta(size = 100, md5 = '0' * 32, stripe_size = 16)
+        self.assertEqual(plan_range(fecmeta, 2, 34, 36), (ShareMeta.meta_length + 16 + 2, 3, [(2, 2, 5)]))
+        # Across stripes, whole columns of the stripes in between
+        offset, length, windows = plan_range(fecmeta, 2, 10, 40)
+        self.assertEqual(windows, [(0, 2, 8), (1, 0, 8), (2, 0, 8)])
+
+    def test_truncated_share_range(self):
+        data = os.urandom(100)
+        shares, checksums, fecmeta = striped_shares(data, 16)
+        offset, length, windows = plan_range(fecmeta, 2, 10, 40)
+        blocks = [shares[0][offset:offset+length], shares[1][offset:offset+length-1]]
+        self.assertRaises(IOError, Decoder(2, 3).decode_range, blocks, [0, 1], fecmeta, 10, 40)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, tempfile, shutil
+from racs.repositories.fs import FSRepository
+
+def failing_stream(blocks):
+    for block in blocks:
+        yield block
+    raise IOError("client went away")
+
+class FSRepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.repository = FSRepository(None, 'fs', self.base)
+        self.repository.create_bucket('bkt')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_put_stream(self):
+        self.repository.put_object_stream('bkt', 'k', iter(['ab', 'cd']), 4, 'text/plain', {'a': '1'})
+        self.assertEqual(self.repository.get_object('bkt', 'k'), ('abcd', 'text/plain', {'a': '1'}))
+
+    def test_failed_put_keeps_old_object(self):
+        self.repository.put_object('bkt', 'k', 'old', 'text/plain', {'a': '1'})
+        self.assertRaises(IOError, self.repository.put_object_stream, 
+                          'bkt', 'k', failing_stream(['ne', 'w']), None, 'text/html', {'a': '2'})
+        self.assertRaises(Exception, self.repository.put_object_stream, 
+                          'bkt', 'k', iter(['ne', 'w']), 4, 'text/html', {'a': '2'})
+        self.assertEqual(self.repository.get_object('bkt', 'k'), ('old', 'text/plain', {'a': '1'}))
+        self.assertEqual([omd.key for omd in self.repository.get_bucket_contents('bkt')], ['k'])
+
+if __name__ == '__main__':
+    unittest.main()
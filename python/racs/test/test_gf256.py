@@ -0,0 +1,102 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, os
+from itertools import combinations
+from racs import gf256
+
+try:
+    import zfec
+except ImportError:
+    zfec = None
+
+# Parity blocks zfec wrote for these segments
+segments = ['racsracs', 'gf256 ok', 'zfec!!!!']
+zfec_parity = {
+    (2, 3): ['586fc1fffae37b43'],
+    (2, 4): ['586fc1fffae37b43', '267d3a767f785313'],
+    (3, 5): ['ea4bc5199fce9242', '45a5a092849e557f'],
+    }
+
+class GF256Test(unittest.TestCase):
+
+    def test_matches_zfec_vectors(self):
+        for (k, m), parity in zfec_parity.items():
+            blocks = gf256.Encoder(k, m).encode(segments[:k])
+            self.assertEqual(blocks[:k], segments[:k])
+            self.assertEqual([b.encode('hex') for b in blocks[k:]], parity)
+
+    @unittest.skipIf(zfec is None, "zfec is not installed")
+    def test_matches_zfec(self):
+        for k, m in ((1, 1), (1, 3), (2, 3), (3, 5), (4, 10), (10, 16)):
+            data = [os.urandom(64) for i in xrange(k)]
+            self.assertEqual(gf256.Encoder(k, m).encode(data), zfec.Encoder(k, m).encode(data))
+            blocks = zfec.Encoder(k, m).encode(data)
+            sharenums = range(m - k, m)
+            self.assertEqual(gf256.Decoder(k, m).decode([blocks[n] for n in sharenums], sharenums), 
+                             data)
+
+    def test_decode_from_any_k_shares(self):
+        for k, m in ((1, 3), (2, 3), (3, 5), (4, 7)):
+            data = [os.urandom(32) for i in xrange(k)]
+            blocks = gf256.Encoder(k, m).encode(data)
+            decoder = gf256.Decoder(k, m)
+            for sharenums in combinations(range(m), k):
+                sharenums = list(sharenums)
+                self.assertEqual(decoder.decode([blocks[n] for n in sharenums], sharenums), 
+                                 data, sharenums)
+                # in any order
+                sharenums.reverse()
+                self.assertEqual(decoder.decode([blocks[n] for n in sharenums], sharenums), 
+                                 data, sharenums)
+
+    def test_decode_parity_only(self):
+        data = [os.urandom(100) for i in xrange(3)]
+        blocks = gf256.Encoder(3, 6).encode(data)
+        self.assertEqual(gf256.Decoder(3, 6).decode(blocks[3:], [3, 4, 5]), data)
+
+    def test_selected_blocks(self):
+        blocks = gf256.Encoder(3, 5).encode(segments, [4, 0])
+        self.assertEqual([blocks[0].encode('hex'), blocks[1]], [zfec_parity[3, 5][1], segments[0]])
+
+    def test_bad_parameters(self):
+        for k, m in ((0, 3), (3, 2), (2, 257)):
+            self.assertRaises(ValueError, gf256.Encoder, k, m)
+            self.assertRaises(ValueError, gf256.Decoder, k, m)
+        self.assertRaises(ValueError, gf256.Decoder(2, 3).decode, ['ab'], [0])
+
+if __name__ == '__main__':
+    unittest.main()
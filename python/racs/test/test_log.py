@@ -0,0 +1,112 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, tempfile, shutil, sys, threading, time
+from StringIO import StringIO
+from racs.util.log import *
+
+class SlowFile(object):
+    # Takes a while over each write, the longer the more it writes, as a
+    # busy disk might
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        time.sleep(len(data) * 1e-5)
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+class LoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_levels(self):
+        log = Logger(self.base + '/log', WARNING)
+        log.info("not this")
+        log.warning("%s %s", 'this', 1)
+        log.error("and this\nover two lines")
+        log.flush()
+        lines = open(self.base + '/log').read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].endswith('] warning: this 1'))
+        self.assertTrue(lines[1].endswith('] error: and this'))
+        self.assertEqual(lines[2].strip(), 'over two lines')
+
+    def test_concurrent_flushes(self):
+        # However many threads flush at once, each line is written once
+        # and in the order it was logged
+        log = Logger(self.base + '/log')
+        log.file = SlowFile(log.file)
+        logged = threading.Event()
+        def flush():
+            while not logged.isSet():
+                log.flush()
+        threads = [threading.Thread(target=flush) for i in range(4)]
+        for t in threads:
+            t.start()
+        for i in range(2000):
+            log.info("%d", i)
+            if i % 100 == 0:
+                time.sleep(0.001)
+        logged.set()
+        for t in threads:
+            t.join()
+        log.flush()
+        logged = [int(line.split(': ')[1]) for line in open(self.base + '/log')]
+        self.assertEqual(logged, range(2000))
+
+    def test_errors_to_stderr_without_file(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            log = Logger()
+            log.warning("not this")
+            log.error("this")
+            log.flush()
+            written = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(written.endswith('] error: this\n'))
+        self.assertFalse('not this' in written)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest
+from racs.util.misc import *
+
+class ByteRangeTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(parse_byte_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_byte_range('bytes=10-', 100), (10, 99))
+        self.assertEqual(parse_byte_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_byte_range(' bytes = 5 - 7 ', 100), (5, 7))
+
+    def test_clipped_to_size(self):
+        self.assertEqual(parse_byte_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_byte_range('bytes=-200', 100), (0, 99))
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_byte_range('bytes=100-', 100), None)
+        self.assertEqual(parse_byte_range('bytes=9-5', 100), None)
+        self.assertEqual(parse_byte_range('bytes=0-0', 0), None)
+
+    def test_unsupported(self):
+        for spec in ('bytes=-', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b'):
+            self.assertRaises(ValueError, parse_byte_range, spec, 100)
+
+class PreconditionTest(unittest.TestCase):
+
+    etag = '"0123456789abcdef0123456789abcdef"'
+    modified = 'Tue, 15 Nov 1994 12:45:26 GMT'
+    earlier = 'Mon, 14 Nov 1994 12:45:26 GMT'
+    later = 'Wed, 16 Nov 1994 12:45:26 GMT'
+
+    def check(self, **headers):
+        return check_preconditions(self.etag, self.modified, **headers)
+
+    def test_none(self):
+        self.assertEqual(self.check(), None)
+
+    def test_if_match(self):
+        self.assertEqual(self.check(if_match=self.etag), None)
+        self.assertEqual(self.check(if_match='"other", ' + self.etag), None)
+        self.assertEqual(self.check(if_match='W/' + self.etag), None)
+        self.assertEqual(self.check(if_match='*'), None)
+        self.assertEqual(self.check(if_match='"other"'), 412)
+
+    def test_if_none_match(self):
+        self.assertEqual(self.check(if_none_match=self.etag), 304)
+        self.assertEqual(self.check(if_none_match='*'), 304)
+        self.assertEqual(self.check(if_none_match='"other"'), None)
+
+    def test_if_modified_since(self):
+        self.assertEqual(self.check(if_modified_since=self.modified), 304)
+        self.assertEqual(self.check(if_modified_since=self.later), 304)
+        self.assertEqual(self.check(if_modified_since=self.earlier), None)
+        self.assertEqual(self.check(if_modified_since='garbage'), None)
+
+    def test_if_unmodified_since(self):
+        self.assertEqual(self.check(if_unmodified_since=self.modified), None)
+        self.assertEqual(self.check(if_unmodified_since=self.earlier), 412)
+        self.assertEqual(self.check(if_unmodified_since='garbage'), None)
+
+    def test_etag_conditions_override_dates(self):
+        self.assertEqual(self.check(if_match=self.etag, if_unmodified_since=self.earlier), None)
+        self.assertEqual(self.check(if_none_match='"other"', if_modified_since=self.later), None)
+
+    def test_if_match_before_if_none_match(self):
+        self.assertEqual(self.check(if_match='"other"', if_none_match=self.etag), 412)
+
+    def test_iso_last_modified(self):
+        self.assertEqual(check_preconditions(self.etag, '1994-11-15T12:45:26.000Z', 
+                                             if_modified_since=self.modified), 304)
+        self.assertEqual(check_preconditions(self.etag, '1994-11-15T12:45:27Z', 
+                                             if_modified_since=self.modified), None)
+
+    def test_unknown_last_modified(self):
+        self.assertEqual(check_preconditions(self.etag, None, if_modified_since=self.modified), None)
+        self.assertEqual(check_preconditions(self.etag, None, if_unmodified_since=self.earlier), None)
+
+    def test_needs_last_modified(self):
+        self.assertFalse(needs_last_modified())
+        self.assertFalse(needs_last_modified(if_match=self.etag, if_none_match=self.etag))
+        self.assertTrue(needs_last_modified(if_modified_since=self.modified))
+        self.assertTrue(needs_last_modified(if_unmodified_since=self.modified))
+        self.assertFalse(needs_last_modified(if_none_match=self.etag, if_modified_since=self.modified))
+        self.assertFalse(needs_last_modified(if_match=self.etag, if_unmodified_since=self.modified))
+
+class QueryTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(parse_query(''), {})
+        self.assertEqual(parse_query(None), {})
+        self.assertEqual(parse_query('&;&'), {})
+
+    def test_parameters(self):
+        self.assertEqual(parse_query('prefix=photos/&max-keys=50&acl'), 
+                         {'prefix': 'photos/', 'max_keys': 50, 'acl': True})
+        self.assertEqual(parse_query('a=1;b=two'), {'a': 1, 'b': 'two'})
+
+    def test_values(self):
+        self.assertEqual(parse_query('marker=&delimiter=%2F&partNumber=007&x=-1'), 
+                         {'marker': '', 'delimiter': '/', 'partNumber': 7, 'x': '-1'})
+        self.assertEqual(parse_query('prefix=a%20b+c'), {'prefix': 'a b+c'})
+
+    def test_last_value_wins(self):
+        self.assertEqual(parse_query('a=1&a=2'), {'a': 2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, tempfile, shutil, threading
+from racs.repositories.fs import FSRepository
+from racs.repositories.packed import PackedRepository, pack_prefix
+from racs.exceptions import NotFound
+
+class PackedRepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.fs = FSRepository(None, 'fs', self.base)
+        self.fs.create_bucket('bkt')
+        self.repository = self.packed()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def packed(self):
+        # A fresh PackedRepository over the same files, reading its index anew
+        return PackedRepository(None, self.fs, pack_below=100, pack_delay=0)
+
+    def stored(self):
+        # Keys of the objects and packs in the wrapped repository
+        return sorted([omd.key for omd in self.fs.get_bucket_contents('bkt')])
+
+    def packs(self):
+        return [key for key in self.stored() if key.startswith(pack_prefix)]
+
+    def listed(self, repository=None):
+        repository = repository or self.repository
+        return sorted([omd.key for omd in repository.get_bucket_contents('bkt')])
+
+    def test_round_trip(self):
+        self.repository.put_object('bkt', 'a', 'small a', 'text/plain', {'x': '1'})
+        self.repository.put_object('bkt', 'b', 'small b')
+        self.assertEqual(self.packs(), [pack_prefix + '000000000001', pack_prefix + '000000000002'])
+        self.assertEqual(self.repository.get_object('bkt', 'a'), ('small a', 'text/plain', {'x': '1'}))
+        self.assertEqual(self.repository.get_range('bkt', 'a', 3, 2)[0], 'all')
+        self.assertEqual(self.repository.get_object_stream('bkt', 'b')[0].read(), 'small b')
+        self.assertEqual(self.repository.head('bkt', 'a')['Content-Length'], 7)
+        self.assertEqual(self.listed(), ['a', 'b'])
+        reloaded = self.packed()
+        self.assertEqual(reloaded.get_object('bkt', 'a')[0], 'small a')
+        self.assertEqual(self.listed(reloaded), ['a', 'b'])
+
+    def test_delete(self):
+        self.repository.put_object('bkt', 'a', 'small a')
+        self.repository.put_object('bkt', 'b', 'small b')
+        self.repository.delete_object('bkt', 'a')
+        self.assertRaises(NotFound, self.repository.get_object, 'bkt', 'a')
+        self.assertEqual(self.listed(), ['b'])
+        self.assertEqual(self.listed(self.packed()), ['b'])
+        self.repository.delete_object('bkt', 'b')
+        self.assertEqual(self.listed(), [])
+        self.assertEqual(self.stored(), [])
+
+    def test_small_overwrites_large(self):
+        self.repository.put_object('bkt', 'a', 'x' * 200)
+        self.repository.put_object('bkt', 'a', 'small a')
+        self.assertEqual(self.repository.get_object('bkt', 'a')[0], 'small a')
+        self.assertRaises(NotFound, self.fs.get_object, 'bkt', 'a')
+        self.assertEqual(self.listed(), ['a'])
+
+    def test_small_overwrites_large_stored_before(self):
+        # Stored before the index was read
+        self.fs.put_object('bkt', 'a', 'x' * 200)
+        self.repository.put_object('bkt', 'a', 'small a')
+        self.assertRaises(NotFound, self.fs.get_object, 'bkt', 'a')
+        self.assertEqual(self.packed().get_object('bkt', 'a')[0], 'small a')
+
+    def test_large_overwrites_small(self):
+        self.repository.put_object('bkt', 'a', 'small a')
+        self.repository.put_object_stream('bkt', 'a', iter(['x' * 100, 'y' * 100]), 200)
+        self.assertEqual(self.repository.get_object('bkt', 'a')[0], 'x' * 100 + 'y' * 100)
+        self.assertEqual(self.stored(), ['a'])
+        self.assertEqual(self.packed().get_object('bkt', 'a')[0], 'x' * 100 + 'y' * 100)
+
+    def put_together(self, key, versions):
+        # Puts the versions of key at once, so that they share one pack
+        repository = PackedRepository(None, self.fs, pack_below=100, pack_size=len(''.join(versions)),
+                                      pack_delay=5)
+        threads = [threading.Thread(target=repository.put_object, args=('bkt', key, data))
+                   for data in versions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return repository
+
+    def test_same_key_twice_in_one_pack(self):
+        # Two puts of one key that share a pack: the pack must not hide 
+        # itself, so that deleting the key deletes it
+        repository = self.put_together('a', ['first a', 'second a'])
+        self.assertEqual(self.packs(), [pack_prefix + '000000000001'])
+        self.assertTrue(repository.get_object('bkt', 'a')[0] in ('first a', 'second a'))
+        self.assertEqual(self.listed(self.packed()), ['a'])
+        repository.delete_object('bkt', 'a')
+        self.assertEqual(self.stored(), [])
+
+    def test_same_key_twice_in_one_pack_reloaded(self):
+        self.put_together('a', ['first a', 'second a'])
+        reloaded = self.packed()
+        reloaded.delete_object('bkt', 'a')
+        self.assertEqual(self.stored(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest
+from racs.s3_request_handler import S3HTTPRequestHandler
+
+class Request(S3HTTPRequestHandler):
+    # A handler that has parsed a request line but has no connection
+    def __init__(self, command, bucket, key, parameters, headers):
+        self.command = command
+        self.bucket = bucket
+        self.key = key
+        self.parameters = parameters
+        self.headers = headers
+
+class RouteTest(unittest.TestCase):
+
+    def route(self, command, bucket=None, key=None, parameters={}, headers={}):
+        handler = Request(command, bucket, key, dict(parameters), headers)
+        r = handler.route()
+        return r and r[0], handler.parameters
+
+    def test_targets(self):
+        self.assertEqual(self.route('GET')[0], 'handle_get_buckets')
+        self.assertEqual(self.route('GET', 'b')[0], 'handle_get_bucket')
+        self.assertEqual(self.route('GET', 'b', 'k')[0], 'handle_get_object')
+        self.assertEqual(self.route('PUT', 'b')[0], 'handle_create_bucket')
+        self.assertEqual(self.route('PUT', 'b', 'k')[0], 'handle_put_object')
+        self.assertEqual(self.route('DELETE', 'b', 'k')[0], 'handle_delete_object')
+        self.assertEqual(self.route('HEAD', 'b', 'k')[0], 'handle_head_object')
+
+    def test_parameter_conditions(self):
+        self.assertEqual(self.route('GET', 'b', parameters={'location': True}), 
+                         ('handle_get_bucket_location', {}))
+        self.assertEqual(self.route('GET', 'b', 'k', {'acl': True}), 
+                         ('handle_get_object_acl', {}))
+        self.assertEqual(self.route('POST', 'b', 'k', {'uploads': True}), 
+                         ('handle_initiate_multipart_upload', {}))
+        # Parameters with values are kept for the handler
+        self.assertEqual(self.route('POST', 'b', 'k', {'uploadId': 'u1'}), 
+                         ('handle_complete_multipart_upload', {'uploadId': 'u1'}))
+        self.assertEqual(self.route('PUT', 'b', 'k', {'uploadId': 'u1', 'partNumber': 2}), 
+                         ('handle_upload_part', {'uploadId': 'u1', 'partNumber': 2}))
+        self.assertEqual(self.route('DELETE', 'b', 'k', {'uploadId': 'u1'})[0], 
+                         'handle_abort_multipart_upload')
+
+    def test_header_conditions(self):
+        self.assertEqual(self.route('PUT', 'b', 'k', headers={'x-amz-copy-source': '/b/j'})[0], 
+                         'handle_copy_object')
+        # The copy header wins over a query parameter further down the list
+        self.assertEqual(self.route('PUT', 'b', 'k', {'uploadId': 'u1'}, 
+                                    {'x-amz-copy-source': '/b/j'})[0], 'handle_copy_object')
+
+    def test_no_route(self):
+        self.assertEqual(self.route('POST', 'b', 'k')[0], None)
+        self.assertEqual(self.route('POST', 'b')[0], None)
+        self.assertEqual(self.route('PATCH', 'b', 'k')[0], None)
+
+if __name__ == '__main__':
+    unittest.main()
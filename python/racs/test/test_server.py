@@ -0,0 +1,279 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, tempfile, shutil, os, threading, httplib, time, re, hashlib
+from racs.server import RACSHTTPServer
+from racs.request_handler import RACSHTTPRequestHandler
+from racs.fec import multipart_prefix
+
+def make_server(base, n=3, k=2, extra=''):
+    # A server on an unused port, over n FSRepositories under base
+    config = "[RACS]\nk: %d\nhost: 127.0.0.1\nport: 0\nlogfile: %s/racs.log\n%s\n" % (k, base, extra)
+    for i in range(n):
+        os.mkdir('%s/r%d' % (base, i))
+        config += "[Repository fs%d]\nclass: FSRepository\nbase_directory: %s/r%d\n" % (i, base, i)
+    open('%s/config' % base, 'w').write(config)
+    RACSHTTPServer.verbose = False
+    return RACSHTTPServer('%s/config' % base)
+
+class RankTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.server = make_server(self.base)
+        self.r = dict([(r.name, r) for r in self.server.get_repositories()])
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.base)
+
+    def ranked(self, size=None):
+        return [r.name for r in self.server.rank_repositories(size=size)]
+
+    def test_primaries_first(self):
+        self.assertEqual(self.ranked(), ['fs0', 'fs1', 'fs2'])
+
+    def test_priority_breaks_ties(self):
+        self.r['fs1'].decrease_priority()
+        self.assertEqual(self.ranked(), ['fs1', 'fs0', 'fs2'])
+
+    def test_cost_outweighs_priority(self):
+        for name, latency in (('fs0', 1.0), ('fs1', 0.01), ('fs2', 0.01)):
+            self.r[name].health.succeeded(latency)
+        self.r['fs2'].increase_priority()
+        self.assertEqual(self.ranked(), ['fs1', 'fs2', 'fs0'])
+
+    def test_priority_biases_cost(self):
+        for name, latency in (('fs0', 0.1), ('fs1', 0.1), ('fs2', 0.1)):
+            self.r[name].health.succeeded(latency)
+        self.r['fs0'].increase_priority()
+        self.assertEqual(self.ranked(), ['fs1', 'fs0', 'fs2'])
+        # fs2 is no primary, and has that much more to make up
+        self.r['fs0'].increase_priority()
+        self.assertEqual(self.ranked(), ['fs1', 'fs2', 'fs0'])
+
+class HedgeDelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.server = make_server(self.base)
+        self.r = self.server.get_repositories()[0]
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.base)
+
+    def test_kinds_apart(self):
+        # Quick range reads don't make whole share reads look slow
+        for i in range(100):
+            self.r.latency['range'].add(0.001)
+            self.r.latency['stream'].add(0.1)
+        self.assertEqual(self.server.hedge_delay(self.r, 'range'), 0.001)
+        self.assertEqual(self.server.hedge_delay(self.r, 'stream'), 0.1)
+        self.assertEqual(self.server.hedge_delay(self.r, 'get'), None)
+
+class ServingTest(unittest.TestCase):
+    # A server answering requests on a thread of its own
+    extra = ''
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.server = make_server(self.base, extra=self.extra)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.base)
+
+    def connect(self):
+        return httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=30)
+
+    def request(self, method, path, body=None):
+        connection = self.connect()
+        connection.request(method, 'http://bkt.s3.amazonaws.com' + path, body)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+class KeepAliveTest(ServingTest):
+    extra = 'frontend_threads: 2\n'
+
+    def list_buckets(self, connection):
+        connection.request('GET', 'http://s3.amazonaws.com/')
+        response = connection.getresponse()
+        response.read()
+        return response
+
+    def test_persistent(self):
+        connection = self.connect()
+        for i in range(3):
+            response = self.list_buckets(connection)
+            self.assertEqual(response.status, 200)
+            self.assertNotEqual(response.getheader('Connection'), 'close')
+
+    def test_idle_connections_give_way(self):
+        # Both workers are held by idle connections; a third client is 
+        # served once one of them gives its worker up, well before 
+        # keepalive_timeout
+        idle = [self.connect(), self.connect()]
+        for connection in idle:
+            self.list_buckets(connection)
+        start = time.time()
+        self.assertEqual(self.list_buckets(self.connect()).status, 200)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_failed_handler_answers(self):
+        def fail(handler, query):
+            raise ValueError("handler failed")
+        finish_get_buckets = RACSHTTPRequestHandler.finish_get_buckets
+        RACSHTTPRequestHandler.finish_get_buckets = fail
+        try:
+            start = time.time()
+            response = self.list_buckets(self.connect())
+        finally:
+            RACSHTTPRequestHandler.finish_get_buckets = finish_get_buckets
+        self.assertEqual(response.status, 500)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertTrue(time.time() - start < 5)
+
+class SlowStream(object):
+    # A share that starts to flow only after delay seconds
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def read(self, n=-1):
+        time.sleep(self.delay)
+        self.delay = 0
+        return self.stream.read(n)
+
+    def close(self):
+        self.stream.close()
+
+class StragglerTest(ServingTest):
+
+    def test_slow_share_hedged(self):
+        self.assertEqual(self.request('PUT', '/')[0], 200)
+        data = os.urandom(100000)
+        self.assertEqual(self.request('PUT', '/obj', data)[0], 200)
+        for r in self.server.get_repositories():
+            for i in range(100):
+                r.latency['stream'].add(0.01)
+        r = self.server.rank_repositories()[0]
+        get_object_stream = r.get_object_stream
+        r.get_object_stream = lambda bucket, key: \
+            (SlowStream(get_object_stream(bucket, key)[0], 2.0),) + get_object_stream(bucket, key)[1:]
+        start = time.time()
+        self.assertEqual(self.request('GET', '/obj'), (200, data))
+        self.assertTrue(time.time() - start < 1.5)
+
+class MultipartTest(ServingTest):
+
+    def setUp(self):
+        ServingTest.setUp(self)
+        self.assertEqual(self.request('PUT', '/')[0], 200)
+
+    def upload(self, key, parts):
+        status, body = self.request('POST', '/%s?uploads' % key)
+        upload_id = re.search('<UploadId>(.*)</UploadId>', body).group(1)
+        xml = '<CompleteMultipartUpload>'
+        for n, data in enumerate(parts):
+            self.assertEqual(self.request('PUT', '/%s?partNumber=%d&uploadId=%s' % (key, n+1, upload_id), data)[0], 200)
+            xml += '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag></Part>' % (n+1, hashlib.md5(data).hexdigest())
+        xml += '</CompleteMultipartUpload>'
+        self.assertEqual(self.request('POST', '/%s?uploadId=%s' % (key, upload_id), xml)[0], 200)
+        return upload_id
+
+    def parts(self):
+        # Upload ids of the parts stored in each repository
+        return [sorted(set([omd.key.split('/')[1] for omd in r.get_bucket_contents('bkt') 
+                            if omd.key.startswith(multipart_prefix)]))
+                for r in self.server.get_repositories()]
+
+    def wait_for_parts(self, expected):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                if self.parts() == expected:
+                    break
+            except IOError:
+                # Listed a part as it was being deleted
+                pass
+            time.sleep(0.01)
+        self.assertEqual(self.parts(), expected)
+
+    def forget(self):
+        # As if another proxy had written the object
+        self.server.racs_metacache.clear()
+
+    def test_put_over_multipart(self):
+        self.upload('obj', ['a' * 10, 'b' * 10])
+        self.assertEqual(len(self.parts()[0]), 1)
+        self.assertEqual(self.request('PUT', '/obj', 'small')[0], 200)
+        self.wait_for_parts([[], [], []])
+        self.assertEqual(self.request('GET', '/obj'), (200, 'small'))
+
+    def test_put_over_uncached_multipart(self):
+        self.upload('obj', ['a' * 10, 'b' * 10])
+        self.forget()
+        self.assertEqual(self.request('PUT', '/obj', 'small')[0], 200)
+        self.wait_for_parts([[], [], []])
+
+    def test_multipart_over_multipart(self):
+        self.upload('obj', ['a' * 10, 'b' * 10])
+        self.forget()
+        second = self.upload('obj', ['c' * 10, 'd' * 10])
+        self.wait_for_parts([[second]] * 3)
+        self.assertEqual(self.request('GET', '/obj'), (200, 'c' * 10 + 'd' * 10))
+
+    def test_delete_uncached(self):
+        self.upload('obj', ['a' * 10, 'b' * 10])
+        self.forget()
+        heads = []
+        for r in self.server.get_repositories():
+            def head(bucket, key, r=r, head=r.head):
+                heads.append(r)
+                return head(bucket, key)
+            r.head = head
+        self.assertEqual(self.request('DELETE', '/obj')[0], 200)
+        self.assertEqual(self.parts(), [[], [], []])
+        # One repository tells what the object is
+        self.assertEqual(len(heads), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest
+from StringIO import StringIO
+from racs.util.streams import *
+
+def chunked(*chunks, **kw):
+    body = ''.join(['%x%s\r\n%s\r\n' % (len(c), kw.get('ext', ''), c) for c in chunks])
+    return body + '0%s\r\n%s\r\n' % (kw.get('ext', ''), kw.get('trailers', ''))
+
+class ChunkedReaderTest(unittest.TestCase):
+
+    def test_read_all(self):
+        reader = ChunkedReader(StringIO(chunked('hello ', 'chunked ', 'world')))
+        self.assertEqual(reader.read(), 'hello chunked world')
+        self.assertEqual(reader.read(), '')
+
+    def test_read_across_chunks(self):
+        reader = ChunkedReader(StringIO(chunked('abc', 'defgh', 'ij')))
+        self.assertEqual([reader.read(4) for i in range(4)], ['abcd', 'efgh', 'ij', ''])
+
+    def test_empty_body(self):
+        self.assertEqual(ChunkedReader(StringIO(chunked())).read(10), '')
+
+    def test_leaves_following_data(self):
+        stream = StringIO(chunked('body') + 'next request')
+        self.assertEqual(ChunkedReader(stream).read(), 'body')
+        self.assertEqual(stream.read(), 'next request')
+
+    def test_extensions_and_trailers(self):
+        body = chunked('abc', 'def', ext=';chunk-signature=0123abcd', 
+                       trailers='x-amz-checksum-crc32: AAAAAA==\r\n')
+        stream = StringIO(body + 'next')
+        self.assertEqual(ChunkedReader(stream).read(), 'abcdef')
+        self.assertEqual(stream.read(), 'next')
+
+    def test_bad_size_line(self):
+        self.assertRaises(IOError, ChunkedReader(StringIO('xyz\r\nabc\r\n0\r\n\r\n')).read)
+
+    def test_missing_crlf(self):
+        self.assertRaises(IOError, ChunkedReader(StringIO('3\r\nabcd\r\n0\r\n\r\n')).read)
+
+    def test_truncated(self):
+        for body in ('', '5\r\nabc', '3\r\nabc\r\n', '3\r\nabc\r\n0\r\n'):
+            self.assertRaises(IOError, ChunkedReader(StringIO(body)).read)
+
+class PeekedStreamTest(unittest.TestCase):
+
+    def test_read(self):
+        stream = StringIO('0123456789')
+        peeked = PeekedStream(stream, stream.read(4))
+        self.assertEqual([peeked.read(3), peeked.read(3), peeked.read(3), peeked.read(3)], 
+                         ['012', '345', '678', '9'])
+        stream = StringIO('0123456789')
+        peeked = PeekedStream(stream, stream.read(4))
+        self.assertEqual(peeked.read(2), '01')
+        self.assertEqual(peeked.read(), '23456789')
+
+    def test_close(self):
+        stream = StringIO('0123456789')
+        PeekedStream(stream, stream.read(4)).close()
+        self.assertTrue(stream.closed)
+
+if __name__ == '__main__':
+    unittest.main()
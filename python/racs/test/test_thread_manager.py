@@ -0,0 +1,223 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import unittest, threading, time
+from racs.thread_manager import ParallelQuery, Bulkhead, RepositoryBusy, make_task, run_task
+from racs.util.concurrency import check_cancelled
+
+class Gate(object):
+    # Counts the queries that have started, and holds them until opened
+    def __init__(self):
+        self.started = []
+        self.condition = threading.Condition()
+        self.opened = threading.Event()
+
+    def arrive(self, param):
+        self.condition.acquire()
+        self.started.append(param)
+        self.condition.notify_all()
+        self.condition.release()
+
+    def enter(self, param):
+        self.arrive(param)
+        self.opened.wait(5)
+
+    def wait_started(self, n, timeout=5):
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        while len(self.started) < n and time.time() < deadline:
+            self.condition.wait(deadline - time.time())
+        self.condition.release()
+        return len(self.started)
+
+class HedgeTest(unittest.TestCase):
+
+    def test_results_stop_at_quorum(self):
+        # Two queries and a hedge all succeed at once; the quorum handler
+        # must see only two results, and the third goes to late_handler
+        gate = Gate()
+        seen = {}
+        done = threading.Event()
+        def quorum_handler(query):
+            seen['results'] = len(query.results)
+        def late_handler(query, param, result):
+            seen['late'] = param
+            done.set()
+        def query_func(param):
+            gate.enter(param)
+            return param
+        ParallelQuery(query_func, ['a', 'b', 'c'], quorum=2, n_concurrent=2,
+                      hedge_delay=lambda param: 0.0,
+                      quorum_handler=quorum_handler, late_handler=late_handler)
+        self.assertEqual(gate.wait_started(3), 3)
+        gate.opened.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(seen['results'], 2)
+
+    def test_hedge_ends_with_hedged_query(self):
+        # 'a' runs late, so 'b' is started to stand in for it.  Once 'a'
+        # has failed, 'b' is still running in its place: 'c' must not go out.
+        gate = Gate()
+        done = threading.Event()
+        def query_func(param):
+            if param == 'a':
+                # Fails only once its hedge is running
+                gate.arrive(param)
+                gate.wait_started(2)
+                raise IOError("a failed")
+            gate.enter(param)
+            return param
+        def hedge_delay(param):
+            return 0.0 if param == 'a' else None
+        query = ParallelQuery(query_func, ['a', 'b', 'c'], quorum=1, n_concurrent=1,
+                              hedge_delay=hedge_delay, late_handler=lambda *args: None,
+                              quorum_handler=lambda query: done.set())
+        self.assertEqual(gate.wait_started(2), 2)
+        time.sleep(0.1)
+        self.assertEqual(sorted(gate.started), ['a', 'b'])
+        self.assertEqual(query.exceptions.keys(), ['a'])
+        gate.opened.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(query.results.keys(), ['b'])
+
+class CancelTest(unittest.TestCase):
+
+    def test_cancel_on_finish(self):
+        # 'a' is hedged with 'b', and 'b' is still running when 'a' reaches
+        # the quorum.  It is cancelled at its next check, giving neither a
+        # late result nor an exception.
+        finished = threading.Event()
+        started = threading.Event()
+        checked = threading.Event()
+        seen = []
+        def query_func(param):
+            if param == 'a':
+                started.wait(5)
+            else:
+                started.set()
+                finished.wait(5)
+                try:
+                    check_cancelled()
+                finally:
+                    checked.set()
+            return param
+        ParallelQuery(query_func, ['a', 'b'], quorum=1, cancel_on_finish=True,
+                      hedge_delay=lambda param: 0.0,
+                      quorum_handler=lambda query: finished.set(),
+                      late_handler=lambda query, param, result: seen.append(param),
+                      exception_handler=lambda query, param, e: seen.append(e))
+        self.assertTrue(checked.wait(5))
+        time.sleep(0.1)
+        self.assertEqual(seen, [])
+
+class FailureTest(unittest.TestCase):
+
+    def test_failure_handler(self):
+        failed = []
+        done = threading.Event()
+        def quorum_handler(query):
+            raise ValueError("quorum handler failed")
+        def failure_handler(query, exception):
+            failed.append(exception)
+            done.set()
+        ParallelQuery(lambda param: param, ['a'], quorum_handler=quorum_handler,
+                      failure_handler=failure_handler)
+        self.assertTrue(done.wait(5))
+        self.assertTrue(isinstance(failed[0], ValueError))
+
+class Repository(object):
+    def __init__(self, bulkhead):
+        self.bulkhead = bulkhead
+
+class BulkheadTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        bulkhead = Bulkhead('r')
+        for i in range(10):
+            self.assertNotEqual(bulkhead.admit(make_task(list)), None)
+        self.assertEqual(bulkhead.stats()['running'], 10)
+
+    def test_queue_and_reject(self):
+        bulkhead = Bulkhead('r', max_concurrent=1, max_queued=1)
+        results = []
+        second_done = threading.Event()
+        def task(name):
+            return make_task(results.append, (name,), exception_handler=results.append,
+                             callback=lambda result: name == 'second' and second_done.set())
+        first = bulkhead.admit(task('first'))
+        self.assertNotEqual(first, None)
+        self.assertEqual(bulkhead.admit(task('second')), None)
+        # No room left to wait: the call fails at once
+        run_task(bulkhead.admit(task('third')))
+        self.assertEqual(len(results), 1)
+        self.assertTrue(isinstance(results[0], RepositoryBusy))
+        # When the first call finishes, its slot passes to the second,
+        # which goes into the pool
+        run_task(first)
+        self.assertTrue(second_done.wait(5))
+        self.assertEqual(results[1:], ['first', 'second'])
+        # and then gives up the slot, once its callback has run
+        deadline = time.time() + 5
+        while bulkhead.stats()['running'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(bulkhead.stats(), dict(
+                max_concurrent = 1, max_queued = 1, running = 0, waiting = 0, 
+                admitted = 2, delayed = 1, rejected = 1, max_running = 1, max_waiting = 1))
+
+    def test_limits_queries(self):
+        # Two queries to a repository that takes one call at a time: the
+        # second waits in the bulkhead until the first has finished
+        gate = Gate()
+        done = []
+        finished = threading.Event()
+        def quorum_handler(query):
+            done.append(query)
+            if len(done) == 2:
+                finished.set()
+        repository = Repository(Bulkhead('r', max_concurrent=1))
+        for i in range(2):
+            ParallelQuery(gate.enter, [repository], quorum=1, quorum_handler=quorum_handler)
+        self.assertEqual(gate.wait_started(1), 1)
+        time.sleep(0.1)
+        self.assertEqual(len(gate.started), 1)
+        self.assertEqual(repository.bulkhead.stats()['waiting'], 1)
+        gate.opened.set()
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(len(gate.started), 2)
+        self.assertEqual(repository.bulkhead.stats()['max_running'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
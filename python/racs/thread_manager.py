@@ -35,13 +35,31 @@
 # 
 
 import traceback
-from threading import Thread, Lock
-import sys, time
+from threading import Thread, Lock, Condition, current_thread
+from collections import deque
+import sys, time, heapq
 from util import *
 
 Aborted = object()
 
-MAX_THREADS=15
+# Pool size when none is configured: tasks mostly wait on repositories,
+# so allow many threads per core, but never fewer than MIN_AUTO_THREADS.
+THREADS_PER_CPU = 16
+MIN_AUTO_THREADS = 64
+
+# Threads kept waiting for work however long the pool is idle
+WARM_THREADS = 4
+
+# Seconds an idle thread beyond WARM_THREADS waits before exiting
+IDLE_TIMEOUT = 60.0
+
+def default_max_threads():
+    try:
+        import multiprocessing
+        ncpu = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        ncpu = 1
+    return max(MIN_AUTO_THREADS, ncpu * THREADS_PER_CPU)
 
 class ParallelQuery(object):
 
@@ -52,7 +70,9 @@ class ParallelQuery(object):
                  quorum_handler=None, exception_handler=None, completion_handler=None, 
                  anti_quorum_handler=None, rollback_handler=None,
                  supplementary_parameters = None, termination_handler = None,
-                 n_concurrent = None
+                 n_concurrent = None, dedicated_threads = False,
+                 hedge_delay = None, late_handler = None, cancel_on_finish = False,
+                 failure_handler = None
                  ):
         # query_func takes a single argument.  parameters is a list of such arguments.
         # quorum_handler takes a single argument, which is this parallelquery instance
@@ -64,6 +84,24 @@ class ParallelQuery(object):
         # termination_handler is called when all queries have returned or failed
         #    it takes one argument, the parallelquery instance
         # n_concurrent is the maximum concurrent queries we want to run
+        # dedicated_threads runs each query on its own thread instead of the shared pool.
+        #    Use it for queries that must all be running at the same time, e.g. 
+        #    consumers of a stream that a single producer feeds in lockstep.
+        # hedge_delay takes a parameter and returns the seconds its query may run, 
+        #    or None for no limit.  A query still running then is hedged: one more
+        #    query is started, beyond n_concurrent and the quorum, for as long as 
+        #    the slow one still runs.
+        # late_handler takes three arguments: (parallelquery, param, result).  If it is
+        #    given, results that arrive once a quorum or antiquorum has been reached,
+        #    or once results already holds a quorum, are passed to it instead of 
+        #    being added to results, so handlers see a fixed set of at most quorum
+        #    results.
+        # cancel_on_finish cancels the queries still queued or running once a quorum
+        #    or antiquorum has been reached.  Queries run under the cancellation token
+        #    self.token (see util.concurrency); those cancelled return Aborted.
+        # failure_handler takes two arguments: (parallelquery, exception).  It is called
+        #    if the quorum or anti-quorum handler raises, so that whatever that handler
+        #    was to finish (a response, say) is finished anyway.
 
         if n_concurrent is None:
             n_concurrent = len(parameters)
@@ -71,6 +109,14 @@ class ParallelQuery(object):
         assert(n_concurrent > 0)
 
         self.n_concurrent = n_concurrent 
+        self.dedicated_threads = dedicated_threads
+        self.hedge_delay = hedge_delay
+        self.late_handler = late_handler
+        self.cancel_on_finish = cancel_on_finish
+        self.token = CancellationToken()
+        # Guards this query's counts, results and finished flag; never held
+        # while a handler runs
+        self.lock = Lock()
 
         if abort_on_exception:
             original_query_func = query_func
@@ -81,6 +127,17 @@ class ParallelQuery(object):
                     return original_query_func(*args)
             query_func = qf
 
+        if cancel_on_finish:
+            uncancellable_query_func = query_func
+            def cancellable(*args):
+                try:
+                    return self.token.run(uncancellable_query_func, *args)
+                except Exception:
+                    if self.token.cancelled:
+                        return Aborted
+                    raise
+            query_func = cancellable
+
         self.rollback_handler = rollback_handler
         self.query_func = query_func
         self.abort_on_exception = abort_on_exception
@@ -98,6 +155,7 @@ class ParallelQuery(object):
         self.quorum = quorum
         self.quorum_handler = quorum_handler
         self.anti_quorum_handler = anti_quorum_handler
+        self.failure_handler = failure_handler
         self.results = {} # maps parameter => result, only for completed parameters
         self.exceptions = {}  # maps paramter => exception, only for those that have thrown exceptions
         self.run()
@@ -105,6 +163,8 @@ class ParallelQuery(object):
     def run(self):
         self.tasks = []
         self.n_running_tasks = 0
+        self.ended = set() # parameters whose queries have finished
+        self.hedged = set() # parameters whose queries are running late
 
         for param in self.parameters:
             supp = self.supplementary_parameters[param]
@@ -112,20 +172,48 @@ class ParallelQuery(object):
                 f = self.query_func, 
                 args = (param,)+supp, 
                 callback = lambda result,p=param: self.pq_callback(p,result), 
-                exception_handler = lambda x,p=param: self.pq_exception_handler(p,x)))
+                exception_handler = lambda x,p=param: self.pq_exception_handler(p,x),
+                bulkhead = getattr(param, 'bulkhead', None)))
 
         self.launch_tasks()
 
-    @serialize
-    def launch_tasks(self):
+    @lock('lock')
+    def launch_tasks(self, ended=None, hedged=None):
+        # ended is the parameter whose query has just finished.  The count
+        # of running tasks only changes here, under the lock, and before
+        # new tasks go out: one that ends at once must not find it stale.
+        # Queries beyond those that could still be needed for the quorum 
+        # wait until some fail, unless they are hedges: each query running
+        # late (hedged names one more) allows one extra until it ends.
+        if ended is not None:
+            self.n_running_tasks -= 1
+            self.ended.add(ended)
+            self.hedged.discard(ended)
+        if hedged is not None and hedged not in self.ended:
+            self.hedged.add(hedged)
         if self.abort or self.finished:
             return
-        j = self.n_concurrent - self.n_running_tasks
+        j = min(self.n_concurrent, self.quorum - len(self.results)) + len(self.hedged) - self.n_running_tasks
         if j > 0 and not self.abort:
             temp = self.tasks[:j]
             self.tasks = self.tasks[j:]
-            thread_manager.queue_tasks(temp)
             self.n_running_tasks += len(temp)
+            if self.hedge_delay:
+                for t in temp:
+                    param = t['args'][0]
+                    delay = self.hedge_delay(param)
+                    if delay is not None:
+                        thread_manager.call_later(delay, self.hedge, (param,))
+            if self.dedicated_threads:
+                thread_manager.run_dedicated(temp)
+            else:
+                thread_manager.queue_tasks(temp)
+
+    def hedge(self, param):
+        # param's query has run for longer than hedge_delay allows
+        if self.finished:
+            return
+        self.launch_tasks(hedged=param)
 
     def pq_rollback(self, param):
         if self.rollback_handler:
@@ -135,13 +223,24 @@ class ParallelQuery(object):
                 print >> sys.stderr, "Suppressing exception raised by rollback handler %s for param %s: %s" % (self.rollback_handler, param, f)
                 
     def pq_callback(self, param, return_value):
-        self.n_running_tasks -= 1
-        self.launch_tasks()
-
         if return_value is Aborted:
+            self.launch_tasks(ended=param)
             return
 
-        self.results[param] = return_value
+        # A hedge and the query it stands in for may both succeed before
+        # the quorum is checked; only the first quorum results are kept
+        self.lock.acquire()
+        late = self.late_handler is not None and (self.finished or len(self.results) >= self.quorum)
+        if not late:
+            self.results[param] = return_value
+        self.lock.release()
+        if late:
+            self.launch_tasks(ended=param)
+            try:
+                self.late_handler(self, param, return_value)
+            except Exception, f:
+                print >> sys.stderr, "Suppressing exception raised by late handler %s for param %s: %s" % (self.late_handler, param, f)
+            return
 
         if self.completion_handler:
             try:
@@ -150,6 +249,8 @@ class ParallelQuery(object):
                 print >> sys.stderr, "Suppressing exception raised by completion handler %s for param %s: %s" % (self.completion_handler, param, f)
         
         self.check_quorum()
+        # Only now, so that no further queries go out once a quorum is reached
+        self.launch_tasks(ended=param)
 
         if self.abort:
             self.pq_rollback(param)
@@ -164,24 +265,37 @@ class ParallelQuery(object):
             except Exception, f:
                 print >> sys.stderr, "Suppressing exception raised by termination handler %s: %s" % (self.termination_handler,f)
 
-    @serialize
     def check_quorum(self):
+        # The handlers run outside the lock: they may decode and send a
+        # whole object, and other queries must not wait for that
+        outcome = self.reach_outcome()
+        if outcome is not None:
+            if self.cancel_on_finish:
+                self.token.cancel()
+            outcome()
+
+    @lock('lock')
+    def reach_outcome(self):
+        # Returns pq_quorum or pq_anti_quorum to the one caller that finds
+        # the query decided, else None
         if self.finished: 
-            return
+            return None
             
-        if self.abort:
-            self.pq_anti_quorum()
-
         n_succeed = len(self.results)
         n_fail = len(self.exceptions)
         n_total = len(self.parameters)
-        if n_succeed >= self.quorum:
-            self.pq_quorum()
+        if self.abort:
+            outcome = self.pq_anti_quorum
+        elif n_succeed >= self.quorum:
+            outcome = self.pq_quorum
         elif n_total - n_fail < self.quorum:
-            self.pq_anti_quorum()
+            outcome = self.pq_anti_quorum
+        else:
+            return None
+        self.finished = True
+        return outcome
 
     def pq_quorum(self):
-        self.finished = True
         if self.quorum_handler:
             try:
                 self.quorum_handler(self)
@@ -189,13 +303,20 @@ class ParallelQuery(object):
                 import traceback
                 traceback.print_exc()
                 print >> sys.stderr, "(printed) Suppressing exception raised by quorum handler %s: %s" % (self.quorum_handler, f)
+                self.pq_failure(f)
 
 
+    def pq_failure(self, exception):
+        if self.failure_handler:
+            try:
+                self.failure_handler(self, exception)
+            except Exception, f:
+                print >> sys.stderr, "Suppressing exception raised by failure handler %s: %s" % (self.failure_handler, f)
+
     def pq_exception_handler(self, param, exception):
 
 
-        self.n_running_tasks -= 1
-        self.launch_tasks()
+        self.launch_tasks(ended=param)
 
         self.exceptions[param] = exception
         
@@ -216,19 +337,36 @@ class ParallelQuery(object):
             self.pq_terminate() # finished!
 
     def pq_anti_quorum(self):
-        self.finished = True
         if self.anti_quorum_handler:
             try:
                 self.anti_quorum_handler(self)
             except Exception, f:
                 traceback.print_exc()
                 print >> sys.stderr, "Suppressing exception raised by anti_quorum_handler %s: %s" % (self.anti_quorum_handler, f)
+                self.pq_failure(f)
 
         # rollback whatever was completed
         for param in self.results.keys():
             self.pq_rollback(param)
 
 
+def run_task(task):
+    f, args, keywords, callback, exception_handler = task
+    try:
+        result = f(*args, **keywords)
+    except Exception, e:
+        if exception_handler:
+            try:
+                exception_handler(e)
+            except Exception, f:
+                print >> sys.stderr, "Suppressing exception handler error [%s] in %s" % (f,exception_handler)
+        return
+    if callback:
+        try:
+            callback(result)
+        except Exception, f:
+            print >> sys.stderr, "Suppressing callback error [%s] with %s" % (f,exception_handler)
+
 class PoolThread(Thread):
     def __init__(self, manager):
         Thread.__init__(self)
@@ -240,96 +378,265 @@ class PoolThread(Thread):
             task = self.manager.get_task()
             if task is None:
                 break
-            f, args, keywords, callback, exception_handler = task
-            try:
-                result = f(*args, **keywords)
-            except Exception, e:
-                if exception_handler:
-                    try:
-                        exception_handler(e)
-                    except Exception, f:
-                        print >> sys.stderr, "Suppressing exception handler error [%s] in %s" % (f,exception_handler)
-                continue
-            if callback:
-                try:
-                    callback(result)
-                except Exception, f:
-                    print >> sys.stderr, "Suppressing callback error [%s] with %s" % (f,exception_handler)
-                
-class ThreadManager(Thread):
-    verbose = False
+            run_task(task)
 
-    def __init__(self, max_threads = MAX_THREADS):
+class DedicatedThread(Thread):
+    # Runs a single task outside of the pool, then exits
+    def __init__(self, task):
         Thread.__init__(self)
+        self.task = task
         self.daemon = True
+
+    def run(self):
+        run_task(self.task)
+                
+def make_task(f, args=(), keywords={}, callback=None, exception_handler=None):
+    return  (f, args, keywords, callback, exception_handler)
+
+class ThreadManager(object):
+    # A pool of persistent threads fed from a FIFO queue.
+    #
+    # Queueing a task wakes an idle thread, or starts a new one if none is
+    # idle and the pool is below max_threads; otherwise the task waits in the
+    # queue for the next thread to finish.  Threads wait on the condition
+    # for work rather than polling, and those beyond warm_threads exit once
+    # they have been idle for idle_timeout seconds.
+
+    verbose = False
+
+    def __init__(self, max_threads = None, warm_threads = WARM_THREADS, idle_timeout = IDLE_TIMEOUT):
+        if not max_threads:
+            max_threads = default_max_threads()
         self.max_threads = max_threads
+        self.warm_threads = min(warm_threads, max_threads)
+        self.idle_timeout = idle_timeout
         self.threads = set()
-        self.tasks = []
-        self.interval = 1.0
-        self.running = False
+        self.n_idle = 0
+        self.tasks = deque()  # (time queued, task)
         self.lock = Lock()
-    
-    def queue_task(self, f, args=(), keywords={}, callback=None, exception_handler=None):
+        self.condition = Condition(self.lock)
+        self.timers = [] # heap of (time due, sequence, task)
+        self.timer_sequence = 0
+        self.timer_thread = None
+        self.timer_condition = Condition(Lock())
+
+        # metrics
+        self.n_queued = 0
+        self.n_started = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
         self.lock.acquire()
-        self.tasks.append( (f, args, keywords, callback, exception_handler) )
+        while len(self.threads) < self.warm_threads:
+            self.spawn()
         self.lock.release()
-        self.maintain()
 
-    def queue_tasks(self, tasks): 
-        def task(f, args=(), keywords={}, callback=None, exception_handler=None):
-            return  (f, args, keywords, callback, exception_handler)
+    def queue_task(self, f, args=(), keywords={}, callback=None, exception_handler=None):
+        self.put([make_task(f, args, keywords, callback, exception_handler)])
 
-        self.lock.acquire()
+    def queue_tasks(self, tasks): 
+        # A task may name the bulkhead of the repository it calls, which
+        # decides when it goes into the pool
+        ready = []
         for t in tasks:
-            self.tasks.append(task(**t))
-        self.lock.release()
-        self.maintain()
-    
-    def run(self):
-        self.running = True
-        while self.running:
-            time.sleep(self.interval)
-            self.maintain()
-
-    _lst = None
+            bulkhead = t.pop('bulkhead', None)
+            task = make_task(**t)
+            if bulkhead is not None:
+                task = bulkhead.admit(task)
+            if task is not None:
+                ready.append(task)
+        if ready:
+            self.put(ready)
+
+    def run_dedicated(self, tasks):
+        # Dedicated queries must all run at once, so bypass any bulkhead
+        for t in tasks:
+            t.pop('bulkhead', None)
+            DedicatedThread(make_task(**t)).start()
+
+    def call_later(self, delay, f, args=()):
+        # Queues f(*args) in the pool once delay seconds have passed
+        self.timer_condition.acquire()
+        self.timer_sequence += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_sequence, make_task(f, args)))
+        if self.timer_thread is None:
+            self.timer_thread = Thread(target=self.run_timers, name="racs-timers")
+            self.timer_thread.daemon = True
+            self.timer_thread.start()
+        self.timer_condition.notify()
+        self.timer_condition.release()
+
+    def run_timers(self):
+        self.timer_condition.acquire()
+        while True:
+            if not self.timers:
+                self.timer_condition.wait()
+                continue
+            due = self.timers[0][0] - time.time()
+            if due > 0:
+                self.timer_condition.wait(due)
+                continue
+            due, sequence, task = heapq.heappop(self.timers)
+            self.put([task])
 
     @lock('lock')
-    def maintain(self):
-            
-        self.reap()
-        nthreads = len(self.threads)
-        ntasks = len(self.tasks)
-        if ntasks > nthreads and nthreads < self.max_threads:
-            for i in xrange(ntasks-nthreads):
-                self.spawn()
-
-        if self.verbose:
-            nxt = int(time.time() /3)
-            if self._lst != nxt:
-                self._lst = nxt
-                print "[%d task threads running]" % (len(self.threads))
+    def put(self, tasks):
+        now = time.time()
+        for task in tasks:
+            self.tasks.append((now, task))
+        self.n_queued += len(tasks)
+        self.max_depth = max(self.max_depth, len(self.tasks))
+
+        # Idle threads take what they can; start threads for the rest
+        for i in xrange(len(self.tasks) - self.n_idle):
+            if len(self.threads) >= self.max_threads:
+                break
+            self.spawn()
+        self.condition.notify(min(len(tasks), self.n_idle))
 
-        
     def spawn(self):
-        # create a new pool thread
+        # create a new pool thread; called with the lock held
         t = PoolThread(self)
         self.threads.add(t)
         t.start()
-    
+        if self.verbose:
+            print "[%d task threads running]" % len(self.threads)
+
     @lock('lock')
     def get_task(self):
-        if len(self.tasks) == 0:
-            return None
-        else:
-            return  self.tasks.pop(0)
-
-    def reap(self):
-        junk = []
-        for t in list(self.threads):
-            if not t.isAlive():
-                junk.append(t)
-                self.threads.remove(t)
-        for t in junk:
-            t.join()
+        # Returns the next task, or None once the calling thread should exit
+        idle_since = time.time()
+        while not self.tasks:
+            if len(self.threads) > self.warm_threads:
+                timeout = idle_since + self.idle_timeout - time.time()
+                if timeout <= 0:
+                    self.threads.discard(current_thread())
+                    return None
+            else:
+                timeout = None
+            self.n_idle += 1
+            self.condition.wait(timeout)
+            self.n_idle -= 1
+
+        queued, task = self.tasks.popleft()
+        wait = time.time() - queued
+        self.n_started += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return task
+
+    @lock('lock')
+    def stats(self):
+        return dict(
+            threads = len(self.threads),
+            idle_threads = self.n_idle,
+            max_threads = self.max_threads,
+            queue_depth = len(self.tasks),
+            max_queue_depth = self.max_depth,
+            tasks_queued = self.n_queued,
+            tasks_started = self.n_started,
+            mean_wait = self.total_wait / max(self.n_started, 1),
+            max_wait = self.max_wait,
+            )
+
+    def dump(self):
+        return "\n".join(["   %-35s %s" % kv for kv in sorted(self.stats().items())])
+
+    @lock('lock')
+    def reset_stats(self):
+        self.max_depth = len(self.tasks)
+        self.n_queued = self.n_started = 0
+        self.total_wait = self.max_wait = 0.0
+
+class RepositoryBusy(Exception): pass
+
+class Bulkhead(object):
+    # Limits how many pool threads the calls to one repository may hold.
+    #
+    # Without this, a repository that stops answering ties up a thread per
+    # call until the pool is full, and requests to healthy repositories
+    # queue behind it.  Calls beyond max_concurrent wait in the bulkhead's
+    # own queue, outside the pool; calls beyond max_queued more fail at
+    # once with RepositoryBusy, as if the repository had, so that queries
+    # can go on to other repositories.  0 means no limit.
+
+    options = ['max_concurrent', 'max_queued']
+
+    def __init__(self, name, max_concurrent=0, max_queued=0):
+        self.name = name
+        self.max_concurrent = int(max_concurrent)
+        self.max_queued = int(max_queued)
+        self.running = 0
+        self.waiting = deque()
+        self.lock = Lock()
+
+        # saturation counters
+        self.n_admitted = 0
+        self.n_delayed = 0   # admitted, but had to wait for a free slot
+        self.n_rejected = 0
+        self.max_running = 0
+        self.max_waiting = 0
+
+    @lock('lock')
+    def admit(self, task):
+        # Returns the task to queue in the pool now, or None if it must wait
+        if self.max_concurrent <= 0 or self.running < self.max_concurrent:
+            self.n_admitted += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            return self.wrap(task)
+        if self.max_queued > 0 and len(self.waiting) >= self.max_queued:
+            self.n_rejected += 1
+            f, args, keywords, callback, exception_handler = task
+            return make_task(raise_busy, (self.name,), {}, callback, exception_handler)
+        self.n_delayed += 1
+        self.waiting.append(task)
+        self.max_waiting = max(self.max_waiting, len(self.waiting))
+        return None
+
+    def wrap(self, task):
+        return make_task(self.run_task, (task,))
+
+    def run_task(self, task):
+        try:
+            run_task(task)
+        finally:
+            task = self.release()
+            if task is not None:
+                thread_manager.put([task])
+
+    @lock('lock')
+    def release(self):
+        # The slot of a finished call passes to the next waiting call
+        if self.waiting:
+            self.n_admitted += 1
+            return self.wrap(self.waiting.popleft())
+        self.running -= 1
+        return None
+
+    @lock('lock')
+    def stats(self):
+        return dict(
+            max_concurrent = self.max_concurrent,
+            max_queued = self.max_queued,
+            running = self.running,
+            waiting = len(self.waiting),
+            admitted = self.n_admitted,
+            delayed = self.n_delayed,
+            rejected = self.n_rejected,
+            max_running = self.max_running,
+            max_waiting = self.max_waiting,
+            )
+
+    @lock('lock')
+    def reset_stats(self):
+        self.n_admitted = self.n_delayed = self.n_rejected = 0
+        self.max_running = self.running
+        self.max_waiting = len(self.waiting)
+
+def raise_busy(name):
+    raise RepositoryBusy("Too many calls queued for repository %s" % name)
 
 thread_manager = ThreadManager()
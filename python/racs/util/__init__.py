@@ -39,3 +39,4 @@ from streams import *
 from s3 import *
 from head_cache import *
 from concurrency import *
+from log import *
@@ -34,7 +34,7 @@
 # official policies, either expressed or implied, of Cornell University.
 # 
 
-from threading import RLock
+from threading import RLock, local
 
 class ReentrantSynchronizationDecorator(object):
     def __init__(self):
@@ -49,3 +49,43 @@ class ReentrantSynchronizationDecorator(object):
             finally:
                 self.lock.release()
         return wrapper
+
+
+class Cancelled(Exception): pass
+
+_current = local()
+
+class CancellationToken(object):
+    # Tells work that has been handed out that it is no longer wanted.
+    #
+    # Work runs under the token with run(); while it does, it can call 
+    # check_cancelled() between steps (blocks read, say).  A step already
+    # under way, such as a blocking read, runs to its end.
+
+    def __init__(self):
+        self.cancelled = False
+
+    def run(self, f, *args):
+        self.check()
+        previous = getattr(_current, 'token', None)
+        _current.token = self
+        try:
+            return f(*args)
+        finally:
+            _current.token = previous
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+def cancellation_token():
+    # The token the calling thread's work runs under, or None
+    return getattr(_current, 'token', None)
+
+def check_cancelled():
+    token = cancellation_token()
+    if token is not None:
+        token.check()
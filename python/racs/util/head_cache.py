@@ -54,6 +54,10 @@ class HeadCache(object):
     def put(self, bucket, key, value):
         self.queue.append( ((bucket,key),value, time.time()))
 
+    def remove(self, bucket, key):
+        k = (bucket,key)
+        self.queue = [entry for entry in self.queue if entry[0] != k]
+
     def clean(self):
         now = time.time()
         while len(self.queue) > 0 and (now-self.queue[0][2]) > self.lifespan:
@@ -0,0 +1,157 @@
+# Copyright 2010 Cornell University. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above 
+# copyright notice, this list of conditions and the following 
+# disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+#   3. Neither the name of the University nor the names of its 
+# contributors may be used to endorse or promote products derived 
+# from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY CORNELL UNIVERSITY  ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CORNELL UNIVERSITY OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR 
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY 
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT 
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE 
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing 
+# official policies, either expressed or implied, of Cornell University.
+# 
+
+import os, sys, time, atexit
+from threading import Lock, Thread
+
+# Log levels, lowest first
+DEBUG, INFO, WARNING, ERROR = range(4)
+level_names = ['debug', 'info', 'warning', 'error']
+
+def log_level(name):
+    # e.g. "warning" -> WARNING, for the log_level config key
+    try:
+        return level_names.index(name.strip().lower())
+    except ValueError:
+        raise ValueError("Unknown log level %r; expected one of %s" % (name, ', '.join(level_names)))
+
+class Logger(object):
+    # Leveled log file written by a background thread.
+    #
+    # Callers only format the message and queue it; the writer thread
+    # appends whatever has accumulated in one write, at most every
+    # flush_interval seconds, keeping file I/O off the request path.
+    # Messages below the configured level are dropped before they are
+    # formatted, so
+    #
+    #     log.debug("%s: responding %s bytes", self, n)
+    #
+    # costs a comparison unless debug logging is on.  A Logger with no
+    # filename writes only errors, to stderr.
+
+    flush_interval = 0.5 # seconds
+    # Messages queued beyond this are dropped (and counted) rather than
+    # letting a stalled disk hold up requests
+    max_pending = 10000
+
+    def __init__(self, filename=None, level=INFO, overwrite=True):
+        self.filename = filename
+        self.pending = []
+        self.dropped = 0
+        self.lock = Lock()
+        # Held by whoever is writing, the writer thread or flush at exit,
+        # so that batches go out whole and in order
+        self.write_lock = Lock()
+        if filename is None:
+            self.level = ERROR
+            self.file = sys.stderr
+        else:
+            self.level = level
+            if overwrite and os.path.exists(filename):
+                os.remove(filename)
+            self.file = open(filename, 'a')
+        t = Thread(target=self.writer, name="racs-log")
+        t.daemon = True
+        t.start()
+        atexit.register(self.flush)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args):
+        if level < self.level:
+            return
+        if args:
+            msg = msg % args
+        self.lock.acquire()
+        if len(self.pending) < self.max_pending:
+            self.pending.append((time.time(), level, msg))
+        else:
+            self.dropped += 1
+        self.lock.release()
+
+    def debug(self, msg, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        if INFO >= self.level:
+            self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        if WARNING >= self.level:
+            self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        if ERROR >= self.level:
+            self.log(ERROR, msg, *args)
+
+    def write(self, msg):
+        # So that "print >> log, msg" still works; logged at info
+        if msg.strip():
+            self.log(INFO, msg)
+
+    def format(self, stamp, level, msg):
+        # Continuation lines are indented under the first
+        pfx = "[%d] %s: " % (stamp, level_names[level])
+        lines = msg.rstrip("\n").split("\n")
+        indent = "\n" + " " * len(pfx)
+        return pfx + indent.join(lines) + "\n"
+
+    def take_pending(self):
+        self.lock.acquire()
+        pending, self.pending = self.pending, []
+        dropped, self.dropped = self.dropped, 0
+        self.lock.release()
+        out = [self.format(*p) for p in pending]
+        if dropped:
+            out.append(self.format(time.time(), WARNING, "%d log messages dropped" % dropped))
+        return out
+
+    def writer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        self.write_lock.acquire()
+        try:
+            out = self.take_pending()
+            if out:
+                self.file.write(''.join(out))
+                self.file.flush()
+        finally:
+            self.write_lock.release()
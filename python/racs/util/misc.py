@@ -34,17 +34,39 @@
 # official policies, either expressed or implied, of Cornell University.
 # 
 
-import sys, os, time, re, hashlib, binascii
+import sys, os, time, re, hashlib, binascii, calendar
+from email.utils import parsedate_tz, mktime_tz
+from urllib import unquote
 from threading import Lock
 
-_url_unquote_re = re.compile('%([0123456789abcdef][0123456789abcdef])')
-
 def url_unquote(s):
     # e.g., replace %24 -> $
-    return _url_unquote_re.sub(_sfunc,s)
+    if '%' not in s:
+        return s
+    return unquote(s)
+
+_query_split_re = re.compile('[&;]')
 
-def _sfunc(match):
-    return chr(eval("0x"+match.group(1)))
+def parse_query(query):
+    # Parse a URL query string in one pass.  Flags without a value (?acl)
+    # map to True, all-digit values become ints, and '-' in names becomes
+    # '_' so every parameter can be passed on as a keyword argument.
+    parameters = {}
+    if not query:
+        return parameters
+    for item in _query_split_re.split(query):
+        if not item:
+            continue
+        name, eq, value = item.partition('=')
+        name = url_unquote(name).replace('-','_')
+        if not eq:
+            parameters[name] = True
+            continue
+        value = url_unquote(value)
+        if value.isdigit():
+            value = int(value)
+        parameters[name] = value
+    return parameters
 
 def tuplify(x):
     if not isinstance(x, tuple) or isinstance(x, list):
@@ -104,6 +126,84 @@ def format_amz_date(d):
 #                parameters[x.replace('-','_')] = True
 #    return parts[0], parameters
 
+_byte_range_re = re.compile(r'^bytes\s*[=:]\s*(\d*)\s*-\s*(\d*)$')
+
+def parse_byte_range(spec, size):
+    # Parses a single HTTP byte range ("bytes=a-b", "bytes=a-" or "bytes=-n")
+    # against an object of the given size.  Returns (first, last), inclusive, 
+    # or None if the range can't be satisfied.  Raises ValueError for 
+    # anything else, including multiple ranges.
+    m = _byte_range_re.match(spec.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        raise ValueError("Unsupported range %s" % spec)
+    if not m.group(1):
+        # suffix range: the last n bytes
+        first = max(size - int(m.group(2)), 0)
+        last = size - 1
+    else:
+        first = int(m.group(1))
+        last = size - 1
+        if m.group(2):
+            last = min(int(m.group(2)), size - 1)
+    if first > last:
+        return None
+    return first, last
+
+_iso_date_re = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?Z?$')
+
+def parse_http_date(s):
+    # Seconds since the epoch for an RFC 1123 date, as clients and S3 send
+    # them, or an ISO 8601 timestamp as the other repositories report 
+    # Last-Modified.  None if the date can't be read.
+    s = str(s).strip()
+    t = parsedate_tz(s)
+    if t is not None:
+        return mktime_tz(t)
+    m = _iso_date_re.match(s)
+    if m:
+        return calendar.timegm(tuple(map(int, m.groups()[:6])))
+    return None
+
+def etag_matches(header, etag):
+    # If-Match and If-None-Match take "*" or a list of etags, which may be
+    # weak (W/"...").  RACS etags are always strong.
+    tags = [t.strip() for t in str(header).split(',')]
+    if '*' in tags:
+        return True
+    tags = [t[2:] if t.startswith('W/') else t for t in tags]
+    return etag in tags
+
+def check_preconditions(etag, last_modified, if_match=None, if_none_match=None, 
+                        if_modified_since=None, if_unmodified_since=None):
+    # Evaluates the conditional headers of a GET or HEAD in the order 
+    # RFC 7232 gives them.  Returns 412 or 304 if the request stops there, 
+    # None if it goes ahead.  The date conditions are skipped when the 
+    # matching etag condition is present, or when a date can't be read.
+    if if_match is not None:
+        if not etag_matches(if_match, etag):
+            return 412
+    elif if_unmodified_since is not None and last_modified is not None:
+        since = parse_http_date(if_unmodified_since)
+        modified = parse_http_date(last_modified)
+        if since is not None and modified is not None and modified > since:
+            return 412
+
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return 304
+    elif if_modified_since is not None and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        modified = parse_http_date(last_modified)
+        if since is not None and modified is not None and modified <= since:
+            return 304
+    return None
+
+def needs_last_modified(if_match=None, if_none_match=None, 
+                        if_modified_since=None, if_unmodified_since=None):
+    # Whether check_preconditions would look at the object's Last-Modified
+    return bool((if_unmodified_since and if_match is None) or 
+                (if_modified_since and if_none_match is None))
+
 def compute_etag(value):
     value = str(value)
     m = hashlib.md5()
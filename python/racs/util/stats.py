@@ -35,6 +35,9 @@
 # 
 
 from racs.util.tracer import *
+from racs.util.misc import lock
+from threading import Lock
+from collections import deque
 from StringIO import StringIO
 import re, sys, os
 import time
@@ -53,6 +56,7 @@ class record_event(Tracer):
         for o in objs:
             try:
                 self.stats = o.server.stats
+                self.source = o
                 return True
             except:
                 pass
@@ -78,16 +82,101 @@ class record_operation(record_event):
         record_event.__init__(self, opname, keywords, "list")
         self()
 
+    def apply(self):
+        record_event.apply(self)
+        # Operations of a repository also go into its RepositoryHealth
+        health = getattr(self.source, 'health', None)
+        if health is not None and 'elapsed' in self.value:
+            health.succeeded(self.value['elapsed'], self.value.get('bytes', 0))
+
 class Stopwatch:
     def __init__(self):
         self.start = time.time()
     def __call__(self):
         return time.time() - self.start
 
+class LatencyWindow:
+    # The most recent latencies of some operation, in seconds
+    def __init__(self, size=128, min_samples=16):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = Lock()
+
+    @lock('lock')
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    @lock('lock')
+    def percentile(self, p):
+        # None until there are enough samples to go by
+        samples = sorted(self.samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(len(samples) * p / 100.0), len(samples)-1)]
+
+class RepositoryHealth:
+    # Exponentially weighted moving averages of a repository's recent
+    # operations: the latency of small ones, the throughput of large ones,
+    # and the rate of failures.  The failure rate decays while nothing is
+    # heard from the repository, so that one that has recovered is tried
+    # again.
+
+    large = 256*1024   # operations moving this many bytes measure throughput
+    failure_cost = 1.0 # seconds a failed operation costs, in retries and timeouts
+
+    def __init__(self, alpha=0.2, halflife=30.0):
+        self.alpha = alpha
+        self.halflife = halflife
+        self.latency = None
+        self.throughput = None
+        self.errors = 0.0
+        self.updated = time.time()
+        self.lock = Lock()
+
+    def average(self, mean, value):
+        if mean is None:
+            return value
+        return mean + self.alpha * (value - mean)
+
+    def error_rate(self):
+        return self.errors * 0.5 ** ((time.time() - self.updated) / self.halflife)
+
+    @lock('lock')
+    def succeeded(self, elapsed, bytes=0):
+        if bytes >= self.large and elapsed > 0:
+            self.throughput = self.average(self.throughput, bytes / elapsed)
+        else:
+            self.latency = self.average(self.latency, elapsed)
+        self.errors = self.average(self.error_rate(), 0.0)
+        self.updated = time.time()
+
+    @lock('lock')
+    def failed(self):
+        self.errors = self.average(self.error_rate(), 1.0)
+        self.updated = time.time()
+
+    @lock('lock')
+    def cost(self, size=None):
+        # Expected seconds for an operation moving size bytes
+        seconds = self.latency or 0.0
+        if size and self.throughput:
+            seconds += size / self.throughput
+        return seconds + self.error_rate() * self.failure_cost
+
+    def __str__(self):
+        def fmt(value, scale, unit):
+            if value is None:
+                return '?'
+            return '%.1f %s' % (value * scale, unit)
+        return "%s, %s, %.0f%% failing" % (fmt(self.latency, 1000, 'ms'), fmt(self.throughput, 1/1024.0, 'KB/s'), 
+                                          100 * self.error_rate())
+
 class Stats:
     def __init__(self):
+        self.lock = Lock()
         self.reset()
 
+    @lock('lock')
     def record(self, event, value=1, etype="counter"):
         if etype == "counter":
             if event not in self.operations:
@@ -34,45 +34,265 @@
 # official policies, either expressed or implied, of Cornell University.
 # 
 
-import time, os
+from collections import deque
+from threading import Condition, Thread
+from racs.util.concurrency import check_cancelled
+import hashlib
+
+class IteratorStream(object):
+    # File-like wrapper around an iterable of string chunks
+    def __init__(self, iterable):
+        self.chunks = iter(iterable)
+        self.buffer = ''
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            data = self.buffer + ''.join(self.chunks)
+            self.buffer = ''
+            return data
+        parts = [self.buffer]
+        have = len(self.buffer)
+        while have < n:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        data = ''.join(parts)
+        self.buffer = data[n:]
+        return data[:n]
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+
+
+def read_cancellable(stream, n=-1, block_size=64*1024):
+    # stream.read(n), but a block at a time, raising Cancelled in between
+    # if the work reading it has been cancelled
+    parts = []
+    while n != 0:
+        check_cancelled()
+        if n < 0:
+            want = block_size
+        else:
+            want = min(n, block_size)
+        data = stream.read(want)
+        if not data:
+            break
+        parts.append(data)
+        if n > 0:
+            n -= len(data)
+    return ''.join(parts)
+
+
+class HashingReader(object):
+    # File-like reader that computes the MD5 of all that is read through it,
+    # so that a request body is hashed as it arrives rather than in another
+    # pass over it afterwards
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5 = hashlib.md5()
+
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        self.md5.update(data)
+        return data
+
+
+class PeekedStream(object):
+    # File-like wrapper around a stream whose first bytes, head, have
+    # already been read from it
+    def __init__(self, stream, head):
+        self.stream = stream
+        self.head = head
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            data = self.head + self.stream.read()
+            self.head = ''
+            return data
+        data = self.head[:n]
+        self.head = self.head[n:]
+        if len(data) < n:
+            data += self.stream.read(n - len(data))
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class ChunkedReader(object):
+    # File-like reader that decodes a chunked request body: either 
+    # Transfer-Encoding: chunked, or the aws-chunked content encoding, whose
+    # chunk extensions carry signatures (ignored here).  read() returns ''
+    # once the last chunk and any trailers have gone by.
+    max_line = 4096
 
-class LogStreamWrapper(object):
     def __init__(self, stream):
         self.stream = stream
+        self.left = 0 # bytes left in the current chunk
+        self.done = False
 
-    def write(self, msg):
-        if not msg.strip():
-            return
-        msg = msg + "\n"
-        msg = msg.split("\n")
-        stamp = "[%s] " % int(time.time())
-#        self.stream.write(stamp + msg[0])
-        pfx = " " * len(stamp)
-        def f(m):
-            if m:
-                return pfx + m
+    def readline(self):
+        line = self.stream.readline(self.max_line)
+        if not line:
+            raise IOError("Client closed connection in the middle of a chunked body")
+        return line
+
+    def next_chunk(self):
+        line = self.readline()
+        try:
+            self.left = int(line.split(';',1)[0].strip(), 16)
+        except ValueError:
+            raise IOError("Bad chunk size line %r" % line[:40])
+        if self.left == 0:
+            # skip any trailers, up to the blank line
+            while self.readline().strip():
+                pass
+            self.done = True
+
+    def read(self, n=-1):
+        if n is None:
+            n = -1
+        parts = []
+        while n != 0 and not self.done:
+            if self.left == 0:
+                self.next_chunk()
+                continue
+            if n < 0:
+                want = self.left
             else:
-                return m
-
-        msg = [stamp + msg[0]] + map(f,msg[1:])
-        self.stream.write("\n".join(msg))
-        
-class NullOutStream(object):
-    def write(self, m):
-        pass
-
-
-class FileAppendOutStream(object):
-    def __init__(self, filename, overwrite=True):
-        if overwrite:
-            if os.path.exists(filename):
-                os.remove(filename)
-        self.filename = filename
-
-    def write(self, msg):
-        f = open(self.filename,'a')
-        f.write(msg)
-        f.close()
-            
-            
-        
+                want = min(n, self.left)
+                n -= want
+            data = self.stream.read(want)
+            if len(data) != want:
+                raise IOError("Client closed connection in the middle of a chunk")
+            parts.append(data)
+            self.left -= want
+            if self.left == 0 and self.stream.read(2) != '\r\n':
+                raise IOError("Chunk not followed by CRLF")
+        return ''.join(parts)
+
+
+class BlockPipe(object):
+    # A bounded, thread-safe pipe of string blocks.  One thread put()s blocks
+    # and then close()s the pipe; another reads it like a file.  put() blocks
+    # while max_blocks blocks are waiting, which bounds the memory held
+    # between a fast producer and a slow consumer.
+    #
+    # A consumer that stops early must call abort(), otherwise the producer
+    # may block forever.  A producer that fails calls fail(exception), which
+    # is raised in the consumer.
+
+    def __init__(self, max_blocks=4):
+        self.max_blocks = max_blocks
+        self.blocks = deque()
+        self.cv = Condition()
+        self.closed = False
+        self.aborted = False
+        self.exception = None
+        self.position = 0
+
+    def put(self, block):
+        # Returns False if the consumer has gone away
+        self.cv.acquire()
+        try:
+            while len(self.blocks) >= self.max_blocks and not self.aborted:
+                self.cv.wait()
+            if self.aborted:
+                return False
+            self.blocks.append(block)
+            self.cv.notifyAll()
+            return True
+        finally:
+            self.cv.release()
+
+    def close(self):
+        self.cv.acquire()
+        self.closed = True
+        self.cv.notifyAll()
+        self.cv.release()
+
+    def fail(self, exception):
+        self.cv.acquire()
+        self.exception = exception
+        self.cv.notifyAll()
+        self.cv.release()
+
+    def abort(self):
+        self.cv.acquire()
+        self.aborted = True
+        self.blocks.clear()
+        self.cv.notifyAll()
+        self.cv.release()
+
+    def next_block(self, limit=None):
+        # Returns up to limit bytes from the front of the pipe, or '' at the end
+        self.cv.acquire()
+        try:
+            while not self.blocks and not self.closed and self.exception is None:
+                self.cv.wait()
+            if self.exception is not None:
+                raise self.exception
+            if not self.blocks:
+                return ''
+            block = self.blocks.popleft()
+            if limit is not None and len(block) > limit:
+                self.blocks.appendleft(block[limit:])
+                block = block[:limit]
+            self.position += len(block)
+            self.cv.notifyAll()
+            return block
+        finally:
+            self.cv.release()
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            return ''.join(iter(self))
+        parts = []
+        while n > 0:
+            block = self.next_block(n)
+            if not block:
+                break
+            parts.append(block)
+            n -= len(block)
+        return ''.join(parts)
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        while True:
+            block = self.next_block()
+            if not block:
+                break
+            yield block
+
+
+class ReadAhead(BlockPipe):
+    # Reads a stream on a thread of its own, in blocks of the given sizes,
+    # staying up to max_blocks ahead of the consumer.  Several streams read
+    # through ReadAhead are fetched in parallel, while the consumer works
+    # on the blocks already in.  A consumer that stops early must abort().
+
+    def __init__(self, stream, sizes, max_blocks=2):
+        BlockPipe.__init__(self, max_blocks)
+        t = Thread(target=self.fill, args=(stream, sizes), name="racs-readahead")
+        t.daemon = True
+        t.start()
+
+    def fill(self, stream, sizes):
+        try:
+            for n in sizes:
+                if n == 0:
+                    continue
+                block = stream.read(n)
+                if not block or not self.put(block):
+                    # a short stream shows up as a short read downstream
+                    break
+            self.close()
+        except Exception, e:
+            self.fail(e)
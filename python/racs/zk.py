@@ -41,6 +41,7 @@ import sys
 # Reader/writer lock at (bucket+key) granularity
 
 from threading import *
+from racs.util.log import Logger
 try:
     import zookeeper as z
 except:
@@ -94,10 +95,12 @@ class ZK(object):
         self.port = port
         self.counter = random.randint(0,2**30)
         self.server = server
+        # the command line tester below runs without a server
+        self.log = getattr(server, 'log', None) or Logger()
         self.zcv = Condition() 
 
         def watcher(handle,type,state,path):
-            print "Z connected (%s:%s)" % (self.host, self.port)
+            self.log.info("Z connected (%s:%s)", self.host, self.port)
             self.zcv.acquire()
             self.connected = True
             self.zcv.notify()
@@ -110,7 +113,7 @@ class ZK(object):
         self.zcv.wait(10.0)
 
         if not self.connected:
-            print "Connection to Z cluster timed out - is a server running on %s:%s?" % (self.host,self.port)
+            self.log.error("Connection to Z cluster timed out - is a server running on %s:%s?", self.host, self.port)
             self.connected = False
             self.zcv.release()
             return
@@ -126,7 +129,7 @@ class ZK(object):
     def request_write_lock(self, bucket, key):
         # block until it is safe to write to bucket/key
         # return a function that indicates we have finished
-        print "acquire write lock %s/%s" % (bucket,key)
+        self.log.debug("acquire write lock %s/%s", bucket, key)
         try:
             return self._request_lock("write", bucket,key)
         except Exception, e:
@@ -134,7 +137,7 @@ class ZK(object):
             traceback.print_exc()
 
     def request_read_lock(self, bucket, key):
-        print "acquire read lock %s/%s" % (bucket,key)
+        self.log.debug("acquire read lock %s/%s", bucket, key)
         try:
             return self._request_lock("read",bucket,key)
         except Exception, e:
@@ -167,7 +170,7 @@ class ZK(object):
             self.counter += 1
         childdata = str(self) + "-"+ str(request_uid)
         self.create(lockbase, childdata, unsafe, z.EPHEMERAL | z.SEQUENCE)
-        print "--> created lock node %s" % locknode
+        self.log.debug("--> created lock node %s", locknode)
         
         try:
             children = self.get_children(locknode)
@@ -177,7 +180,7 @@ class ZK(object):
 
         children.sort(key = lambda x: int(x.split('-')[1]))
             
-        print "--> lock node children %s" % children
+        self.log.debug("--> lock node children %s", children)
         
         # Which child did I create?
         i = len(children)-1
@@ -191,7 +194,7 @@ class ZK(object):
         else:
             raise Exception("Can't find my child %s in locknode %s" % (self,locknode))
 
-        print "   --> created %s" % child
+        self.log.debug("   --> created %s", child)
         return self._check_request(child, ltype, locknode,children)
 
     def _check_request(self, child, ltype, locknode, children=None):
@@ -220,14 +223,12 @@ class ZK(object):
                     waitfor = c  # wait for /last/ read before us
             
         if proceed:
-            print "%s... I own lock %s" % (self,child)
-            print "%s... acquired lock! " % self
+            self.log.debug("%s... I own lock %s; acquired lock!", self, child)
             return lambda: self._release_lock(child,locknode)
         else:
             try:
                 holder,m = self.get(waitfor) # not actually necessary 
-                print "%s... I own lock %s"% (self,child)
-                print "%s... waiting for lock %s held by %s" % (self,waitfor,holder)
+                self.log.debug("%s... I own lock %s; waiting for lock %s held by %s", self, child, waitfor, holder)
             except Exception, e: 
                 import traceback
                 traceback.print_exc()